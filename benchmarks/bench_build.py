@@ -0,0 +1,324 @@
+"""Benchmarks of the environment build pipeline of penv.
+
+Synthetic embeddable python archives and wheels of realistic size are served
+from a local HTTP server, so the benchmarks run without network access on any
+OS. Each scenario is run several times and the wall time and the per-phase
+profile of the builds are written as JSON, which ``--compare`` reads back.
+
+    python benchmarks/bench_build.py --output results.json
+    python benchmarks/bench_build.py --output new.json --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import penv  # noqa: E402
+from penv import EmbeddableEnvBuilder  # noqa: E402
+from penv.download import Downloader  # noqa: E402
+from penv.profiling import Profiler  # noqa: E402
+from tests.http_server import RangeRequestHandler  # noqa: E402
+
+RESULTS_VERSION: int = 1
+PYTHON_VERSION: str = '3.12.1'
+PLATFORM_ARCH: str = 'amd64'
+# (name, size in KiB) modelled on python-3.12.1-embed-amd64.zip
+EMBEDDABLE_FILES: List[Tuple[str, int]] = [
+    ('python.exe', 100), ('pythonw.exe', 98), ('python3.dll', 65), ('python312.dll', 6400),
+    ('python312.zip', 2900), ('vcruntime140.dll', 106), ('vcruntime140_1.dll', 48),
+    ('libcrypto-3.dll', 5000), ('libssl-3.dll', 770), ('libffi-8.dll', 38), ('sqlite3.dll', 1500),
+    ('_asyncio.pyd', 64), ('_bz2.pyd', 82), ('_ctypes.pyd', 120), ('_decimal.pyd', 250), ('_elementtree.pyd', 170),
+    ('_hashlib.pyd', 60), ('_lzma.pyd', 155), ('_msi.pyd', 40), ('_multiprocessing.pyd', 30),
+    ('_overlapped.pyd', 45), ('_queue.pyd', 30), ('_socket.pyd', 75), ('_sqlite3.pyd', 90), ('_ssl.pyd', 175),
+    ('_uuid.pyd', 25), ('_wmi.pyd', 35), ('_zoneinfo.pyd', 40), ('pyexpat.pyd', 190), ('select.pyd', 30),
+    ('unicodedata.pyd', 1120), ('winsound.pyd', 30), ('LICENSE.txt', 33),
+]
+
+
+class BenchmarkBuilder(EmbeddableEnvBuilder):
+    """EmbeddableEnvBuilder which also runs outside of Windows
+
+    venv installs the activate.bat which is patched only on Windows.
+    """
+
+    def __init__(self, **kwargs):
+        with mock.patch('platform.system', return_value='Windows'):
+            super().__init__(**kwargs)
+
+    def _patch_scripts(self, context):
+        if os.path.exists(os.path.join(context.bin_path, 'activate.bat')):
+            super()._patch_scripts(context)
+
+
+def _payload(rng: random.Random, size: int) -> bytes:
+    """Half random and half repetitive bytes, which deflate about as well as DLLs"""
+    half = size // 2
+    text = (b'MZ\x90\x00' + bytes(range(64))) * (half // 68 + 1)
+    return rng.randbytes(size - half) + text[:half]
+
+
+def make_embeddable_zip(root: str, python_version: str, scale: float, seed: int = 0) -> str:
+    """Write a synthetic embeddable python archive under root/ftp/python/<version>/"""
+    rng = random.Random(seed)
+    directory = os.path.join(root, 'ftp', 'python', python_version)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'python-{python_version}-embed-{PLATFORM_ARCH}.zip')
+    short_version = ''.join(python_version.split('.')[:2])
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'python{short_version}._pth', f'python{short_version}.zip\n.\n\n# Uncomment to run site.main() automatically\n#import site\n')
+        for name, kib in EMBEDDABLE_FILES:
+            name = name.replace('312', short_version)
+            zf.writestr(name, _payload(rng, max(1, int(kib * 1024 * scale))))
+    return path
+
+
+def make_wheel(directory: str, name: str, version: str, files: int, file_size: int, rng: random.Random) -> str:
+    """Write a pure python wheel of files modules of about file_size bytes"""
+    path = os.path.join(directory, f'{name}-{version}-py3-none-any.whl')
+    dist_info = f'{name}-{version}.dist-info'
+    line = b'def function_%d(argument):\n    return argument * %d\n\n'
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'{name}/__init__.py', f'__version__ = {version!r}\n')
+        for i in range(files):
+            lines = (line % (n, rng.randrange(1000)) for n in range(max(1, file_size // len(line))))
+            zf.writestr(f'{name}/module_{i}.py', b''.join(lines))
+        zf.writestr(f'{dist_info}/METADATA', f'Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n')
+        zf.writestr(f'{dist_info}/WHEEL', 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n')
+        zf.writestr(f'{dist_info}/entry_points.txt', f'[console_scripts]\n{name} = {name}:main\n')
+        zf.writestr(f'{dist_info}/RECORD', '')
+    return path
+
+
+def make_wheelhouse(root: str, packages: int, scale: float, seed: int = 0) -> Tuple[str, str]:
+    """Write pip, setuptools and packages synthetic wheels and a requirements file for the latter"""
+    rng = random.Random(seed)
+    wheelhouse = os.path.join(root, 'wheelhouse')
+    os.makedirs(wheelhouse, exist_ok=True)
+    # about the number of files and the size of pip and setuptools
+    make_wheel(wheelhouse, 'pip', '99.0', max(1, int(900 * scale)), 2500, rng)
+    make_wheel(wheelhouse, 'setuptools', '99.0', max(1, int(800 * scale)), 3500, rng)
+    requirements = os.path.join(root, 'requirements.txt')
+    with open(requirements, 'w') as f:
+        for i in range(packages):
+            name = f'package_{i:03d}'
+            make_wheel(wheelhouse, name, '1.0', max(1, int(100 * scale)), 4000, rng)
+            f.write(f'{name}==1.0\n')
+    return wheelhouse, requirements
+
+
+class Fixture:
+    """The local server and the synthetic files shared by the scenarios"""
+
+    def __init__(self, root: str, scale: float, packages: int):
+        self.root = root
+        self.www = os.path.join(root, 'www')
+        make_embeddable_zip(self.www, PYTHON_VERSION, scale)
+        self.wheelhouse, self.requirements = make_wheelhouse(root, packages, scale)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=self.www))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def builder(self, cache_dir: Optional[str], profiler: Profiler, **kwargs) -> BenchmarkBuilder:
+        return BenchmarkBuilder(
+            python_version=PYTHON_VERSION,
+            platform_arch=PLATFORM_ARCH,
+            with_pip=True,
+            pip_bootstrap='wheels',
+            wheelhouse=self.wheelhouse,
+            cache_dir=cache_dir,
+            downloader=Downloader(),
+            python_mirrors=[f'{self.url}/ftp/python'],
+            profiler=profiler,
+            **kwargs,
+        )
+
+
+# name: (description, parameters)
+SCENARIOS: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    'no-cache': ('1 environment without a cache directory', {'cache': None, 'envs': 1}),
+    'cold-cache': ('1 environment with an empty cache', {'cache': 'cold', 'envs': 1}),
+    'warm-cache': ('1 environment cloned from the cached template', {'cache': 'warm', 'envs': 1}),
+    'warm-cache-no-template': (
+        '1 environment extracted from the cached archive',
+        {'cache': 'warm', 'envs': 1, 'use_templates': False},
+    ),
+    'cold-cache-many': ('8 environments concurrently with an empty cache', {'cache': 'cold', 'envs': 8}),
+    'warm-cache-many': ('8 environments concurrently from the cached template', {'cache': 'warm', 'envs': 8}),
+    'site-packages-cold': (
+        '1 environment with the requirements and an empty cache',
+        {'cache': 'cold', 'envs': 1, 'requirements': True},
+    ),
+    'site-packages-warm': (
+        '1 environment with the requirements cloned from the cached template',
+        {'cache': 'warm', 'envs': 1, 'requirements': True},
+    ),
+    'site-packages-warm-no-template': (
+        '1 environment with the requirements linked from the cached wheels',
+        {'cache': 'warm', 'envs': 1, 'requirements': True, 'use_templates': False},
+    ),
+}
+
+
+def _build(fixture: Fixture, cache_dir: Optional[str], envs_root: str, params: Dict[str, Any]) -> Tuple[float, Profiler]:
+    profiler = Profiler()
+    builder = fixture.builder(
+        cache_dir,
+        profiler,
+        use_templates=params.get('use_templates', True),
+        requirements=fixture.requirements if params.get('requirements') else None,
+    )
+    env_dirs = [os.path.join(envs_root, f'env{i}') for i in range(params['envs'])]
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=len(env_dirs)) as executor:
+            list(executor.map(builder.create, env_dirs))
+    finally:
+        builder.downloader.close()  # type: ignore
+    return time.perf_counter() - started, profiler
+
+
+def run_scenario(fixture: Fixture, name: str, repeat: int) -> Dict[str, Any]:
+    description, params = SCENARIOS[name]
+    runs: List[Dict[str, Any]] = []
+    warm_cache: Optional[str] = None
+    if params['cache'] == 'warm':
+        warm_cache = tempfile.mkdtemp(prefix='cache-', dir=fixture.root)
+        envs_root = tempfile.mkdtemp(prefix='prime-', dir=fixture.root)
+        _build(fixture, warm_cache, envs_root, {**params, 'envs': 1})
+        shutil.rmtree(envs_root)
+    for _ in range(repeat):
+        envs_root = tempfile.mkdtemp(prefix=f'{name}-', dir=fixture.root)
+        cache_dir = warm_cache
+        if params['cache'] == 'cold':
+            cache_dir = tempfile.mkdtemp(prefix='cache-', dir=fixture.root)
+        wall, profiler = _build(fixture, cache_dir, envs_root, params)
+        summary = profiler.summary()
+        runs.append({
+            'wall': wall,
+            'phases': {phase: entry['elapsed'] for phase, entry in summary.items()},
+            'counters': summary.get('create', {}).get('counters', {}),
+        })
+        shutil.rmtree(envs_root)
+        if params['cache'] == 'cold':
+            shutil.rmtree(cache_dir)  # type: ignore
+    if warm_cache is not None:
+        shutil.rmtree(warm_cache)
+    walls = [run['wall'] for run in runs]
+    phases = sorted({phase for run in runs for phase in run['phases']})
+    return {
+        'description': description,
+        'params': params,
+        'runs': runs,
+        'wall': {
+            'min': min(walls),
+            'median': statistics.median(walls),
+            'max': max(walls),
+        },
+        # summed over the environments of a run
+        'phases': {phase: statistics.median(run['phases'].get(phase, 0.0) for run in runs) for phase in phases},
+    }
+
+
+def run_benchmarks(
+    scenarios: List[str],
+    repeat: int = 3,
+    scale: float = 1.0,
+    packages: int = 40,
+    workdir: Optional[str] = None,
+) -> Dict[str, Any]:
+    root = tempfile.mkdtemp(prefix='penv-bench-', dir=workdir)
+    try:
+        fixture = Fixture(root, scale, packages)
+        try:
+            results = {}
+            for name in scenarios:
+                results[name] = run_scenario(fixture, name, repeat)
+                print(f"{name}: median {results[name]['wall']['median']:.3f}s", file=sys.stderr)
+        finally:
+            fixture.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        'version': RESULTS_VERSION,
+        'meta': {
+            'penv': penv.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'repeat': repeat,
+            'scale': scale,
+            'packages': packages,
+        },
+        'results': results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Iterator[str]:
+    """Yields a line per scenario with the median wall times and their ratio"""
+    if baseline.get('meta', {}).get('scale') != current['meta']['scale']:
+        yield 'warning: the results were measured with different --scale'
+    for name, result in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        median = result['wall']['median']
+        if base is None:
+            yield f'{name:32s} {median:9.3f}s (no baseline)'
+            continue
+        base_median = base['wall']['median']
+        ratio = median / base_median if base_median else float('inf')
+        yield f'{name:32s} {base_median:9.3f}s -> {median:9.3f}s  x{ratio:.2f}'
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks the environment builds of penv on local synthetic archives.')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), dest='scenarios', help='The scenarios to run (all by default)')
+    parser.add_argument('--repeat', default=3, type=int, help='The number of runs of each scenario')
+    parser.add_argument('--scale', default=1.0, type=float, help='The size of the synthetic archives and wheels relative to the real ones')
+    parser.add_argument('--packages', default=40, type=int, help='The number of wheels in the requirements of the site-packages scenarios')
+    parser.add_argument('--workdir', default=None, help='The directory to build in (a temporary directory by default)')
+    parser.add_argument('--output', default=None, help='The JSON file to write the results to')
+    parser.add_argument('--compare', default=None, help='A JSON file of earlier results to compare with')
+    options = parser.parse_args(args)
+    results = run_benchmarks(
+        options.scenarios or list(SCENARIOS),
+        repeat=options.repeat,
+        scale=options.scale,
+        packages=options.packages,
+        workdir=options.workdir,
+    )
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        for line in compare(results, baseline):
+            print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,9 @@
+import asyncio
+import copy
+import fnmatch
+import functools
+import hashlib
+import http.client
 import logging
 import os
 import platform
@@ -5,14 +11,75 @@ import re
 import shutil
 import subprocess
 import sys
-from typing import Optional, Union
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, TypeVar, Union
 from types import SimpleNamespace
 from venv import EnvBuilder
+from .archive import SLIM_EXCLUDES, ArchiveSource, sync_zip
+from .bytecode import INVALIDATION_MODES, compileall_args, count_bytecode
+from .cache import ArchiveCache, cache_main, parse_size, remove_stale_downloads, sha256_file
+from .clone import clone_main
+from .daemon import create_remote, serve_main
+from .download import DEFAULT_CONNECTIONS, Downloader, DownloadError, RangeFile, SingleFlight, download
+from .hashes import HashIndex, HashMismatch, hashes_main
+from .lock import LOCKS_DIR, shared_lock
+from .manifest import MANIFEST_FILE, load_manifest, record_files, save_manifest, verify_main
+from .mirrors import GET_PIP_MIRRORS, MIRRORS_FILE, PYTHON_MIRRORS, MirrorList
+from .pack import pack_main
+from .profiling import PhaseRecord, Profiler
+from .releases import RELEASES_FILE, ReleaseIndex, is_exact, short_version
+from .store import STORE_PREFIX, PackageStore, store_main
+from .template import LINK_MODES, TemplateCache, find_patch_points, remove_file, remove_tree
+from .wheel import (
+    WheelInfo,
+    WheelStore,
+    ensurepip_wheel_dir,
+    find_wheels,
+    install_wheel,
+    install_wheels,
+    parse_requirements,
+    select_wheels,
+)
 
 __version__ = '0.0.0'
 
 CORE_VENV_DEPS = ('pip', 'setuptools')
+PIP_BOOTSTRAP_MODES = ('get-pip', 'wheels')
+WHEEL_STORE_DIR = 'wheels'
+# where downloads are made without a cache directory, so that the next run resumes an interrupted one
+DOWNLOADS_DIR = os.path.join(tempfile.gettempdir(), 'penv-downloads')
+# scripts which setup_scripts and post_setup write for every environment
+REGENERATED_SCRIPTS = ('activate*', 'deactivate*')
+# builder options which EmbeddableEnvBuilder.derive can replace per environment
+TARGET_OPTIONS = (
+    'clear', 'upgrade', 'with_pip', 'prompt', 'python_version', 'platform_arch', 'use_templates', 'link_mode',
+    'pip_bootstrap', 'wheelhouse', 'requirements', 'compile_bytecode', 'invalidation_mode', 'slim', 'exclude',
+)
+# times an archive evicted from the cache while it is extracted is fetched again
+CACHE_READ_ATTEMPTS = 3
+# files which an upgrade leaves alone when they exist; the ._pth of the previous minor version is removed
+UPGRADE_KEEP = ('python{short_version}._pth', 'Lib/site-packages/*')
 logger = logging.getLogger(__name__)
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def _phase(name: str) -> Callable[[F], F]:
+    """Profile a builder method taking the context (or the env_dir) as the phase name"""
+    def decorator(method: F) -> F:
+        @functools.wraps(method)
+        def wrapper(self, target, *args, **kwargs):
+            if isinstance(target, (str, bytes, os.PathLike)):
+                env_dir = os.fsdecode(target)
+            else:
+                env_dir = getattr(target, 'env_dir', '')
+            with self.profiler.phase(name, env_dir):
+                return method(self, target, *args, **kwargs)
+        return wrapper  # type: ignore
+    return decorator
 
 
 class EmbeddableEnvBuilder(EnvBuilder):
@@ -26,13 +93,56 @@ class EmbeddableEnvBuilder(EnvBuilder):
         python_version: str = platform.python_version(),
         platform_arch: str = platform.machine().lower(),
         cache_dir: Optional[str] = None,
+        downloader: Optional[Downloader] = None,
+        cache_max_size: Optional[int] = None,
+        use_templates: bool = True,
+        link_mode: str = 'auto',
+        pip_bootstrap: str = 'get-pip',
+        wheelhouse: Optional[str] = None,
+        requirements: Optional[str] = None,
+        compile_bytecode: bool = False,
+        invalidation_mode: str = 'timestamp',
+        profiler: Optional[Profiler] = None,
+        python_mirrors: Optional[Sequence[str]] = None,
+        get_pip_mirrors: Optional[Sequence[str]] = None,
+        package_store: Optional[str] = None,
+        slim: bool = False,
+        exclude: Optional[Sequence[str]] = None,
+        hash_index: Optional[str] = None,
     ):
         # validation
         assert platform.system() == "Windows", "Only Windows is supported"
+        assert link_mode in LINK_MODES, f"link_mode must be one of {LINK_MODES}"
+        assert pip_bootstrap in PIP_BOOTSTRAP_MODES, f"pip_bootstrap must be one of {PIP_BOOTSTRAP_MODES}"
+        assert invalidation_mode in INVALIDATION_MODES, f"invalidation_mode must be one of {INVALIDATION_MODES}"
         # set attributes
+        # e.g. 3.12 or >=3.11,<3.13 until resolve_python_version
         self.python_version = python_version
         self.platform_arch = platform_arch
         self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self.downloader = downloader
+        self.use_templates = use_templates
+        self.link_mode = link_mode
+        self.pip_bootstrap = pip_bootstrap
+        self.wheelhouse = wheelhouse
+        self.requirements = requirements
+        self.compile_bytecode = compile_bytecode
+        self.invalidation_mode = invalidation_mode
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.package_store = package_store
+        self.slim = slim
+        self.exclude = list(exclude or [])
+        # the pinned hashes which downloads must match before they are used
+        self.hash_index = HashIndex.load(hash_index) if hash_index else None
+        # the latencies of the mirrors are remembered in the cache directory
+        mirrors_state = os.path.join(cache_dir, MIRRORS_FILE) if cache_dir else None
+        self.python_mirrors = MirrorList(python_mirrors or PYTHON_MIRRORS, state_path=mirrors_state)
+        self.get_pip_mirrors = MirrorList(get_pip_mirrors or GET_PIP_MIRRORS, state_path=mirrors_state)
+        # downloads and templates shared by concurrent create() calls
+        self._flights = SingleFlight()
+        self._artifacts_lock = threading.Lock()
+        self._artifacts_dir: Optional[str] = None
         super().__init__(
             system_site_packages=False,
             clear=clear,
@@ -43,6 +153,351 @@ class EmbeddableEnvBuilder(EnvBuilder):
             upgrade_deps=False,
         )
 
+    def _artifacts_root(self) -> str:
+        """Returns the temporary directory of the downloads of this builder"""
+        with self._artifacts_lock:
+            if self._artifacts_dir is None:
+                self._artifacts_dir = tempfile.mkdtemp(prefix='penv-')
+                weakref.finalize(self, shutil.rmtree, self._artifacts_dir, True)
+            return self._artifacts_dir
+
+    def _artifact(self, url: str, name: str, mirrors: Sequence[str] = ()) -> str:
+        """Download url (failing over to mirrors) once for this builder and returns the local path
+
+        The download is made in DOWNLOADS_DIR under the lock of name, so that an
+        interrupted one is resumed by the next builder which downloads name.
+        With a hash index, the download is kept by its pinned SHA-256, so that it
+        is fetched and checked again when the pin changes; an unpinned name is
+        refused even if it was downloaded before.
+        """
+        expected = self.hash_index.expected(name) if self.hash_index is not None else None
+        path = os.path.join(self._artifacts_root(), *([expected] if expected else []), name)
+
+        def fetch() -> str:
+            if not os.path.exists(path):
+                tmp_path = os.path.join(DOWNLOADS_DIR, name)
+                locks_dir = os.path.join(DOWNLOADS_DIR, LOCKS_DIR)
+                os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+                with shared_lock(os.path.join(locks_dir, f'{name}.lock')):
+                    if expected is None:
+                        download(url, tmp_path, self.downloader, mirrors=mirrors)
+                    else:
+                        # hashed while it streams in rather than read again
+                        hasher = hashlib.sha256()
+                        download(url, tmp_path, self.downloader, hasher=hasher, mirrors=mirrors)
+                        if hasher.hexdigest() != expected:
+                            os.remove(tmp_path)
+                            raise HashMismatch(
+                                f'{url} has the SHA-256 {hasher.hexdigest()} instead of the pinned {expected}'
+                            )
+                        self.profiler.count('files_verified')
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp_path, path)
+                remove_stale_downloads(DOWNLOADS_DIR, locks_dir)
+                self.profiler.count('bytes_downloaded', os.path.getsize(path))
+                logger.debug(f"Downloaded {url}")
+            return path
+
+        return self._flights.do((url, expected), fetch)
+
+    def _cached_archive(self, zip_name: str, url: str, mirrors: Sequence[str] = ()) -> str:
+        """Returns the path of zip_name in the cache directory, downloading it if needed"""
+        assert self.cache_dir is not None
+        cache = ArchiveCache(self.cache_dir, max_size=self.cache_max_size)
+        expected = self.hash_index.expected(zip_name) if self.hash_index is not None else None
+
+        def fetch() -> str:
+            cached_path = cache.lookup(zip_name, expected)
+            if cached_path is not None:
+                self.profiler.count('cache_hits')
+                logger.info(
+                    f"Use cached embeddable python {zip_name} in {self.cache_dir}"
+                )
+                return cached_path
+            # other processes sharing the cache wait for this download instead of starting their own
+            with cache.lock(zip_name):
+                cached_path = cache.lookup(zip_name, expected)
+                if cached_path is not None:
+                    self.profiler.count('cache_hits')
+                    logger.info(f"Use embeddable python {zip_name} cached by another process")
+                    return cached_path
+                logger.info(f"Caching embeddable python {zip_name} in {self.cache_dir}")
+                cached_path = cache.fetch(
+                    zip_name,
+                    url,
+                    self.downloader,
+                    mirrors=mirrors,
+                    python_version=self.python_version,
+                    platform_arch=self.platform_arch,
+                    expected_sha256=expected,
+                )
+            self.profiler.count('cache_misses')
+            self.profiler.count('bytes_downloaded', os.path.getsize(cached_path))
+            logger.debug(f"Downloaded {url}")
+            return cached_path
+
+        return self._flights.do(('cache', zip_name), fetch)
+
+    def resolve_python_version(self) -> str:
+        """Replace a partial python_version like 3.12 with the latest matching release and returns it"""
+        spec = self.python_version
+        if not is_exact(spec):
+            releases = ReleaseIndex(
+                self.python_mirrors,
+                path=os.path.join(self.cache_dir, RELEASES_FILE) if self.cache_dir else None,
+                downloader=self.downloader,
+            )
+            self.python_version = self._flights.do(
+                ('python_version', spec, self.platform_arch),
+                lambda: releases.resolve(spec, self.platform_arch),
+            )
+        return self.python_version
+
+    def excludes(self) -> List[str]:
+        """Returns the patterns of the members of the embeddable python which are not extracted"""
+        return [*SLIM_EXCLUDES, *self.exclude] if self.slim else list(self.exclude)
+
+    def _remote_archive(self, urls: Sequence[str]) -> Optional[RangeFile]:
+        """Returns the first of urls which can be read with range requests, or None"""
+        downloader = self.downloader if self.downloader is not None else Downloader()
+        for url in urls:
+            if not url.startswith(('http://', 'https://')):
+                continue
+            try:
+                return RangeFile(url, downloader)
+            except (DownloadError, http.client.HTTPException, OSError) as e:
+                logger.debug(f"Can not read {url} with range requests: {e!r}")
+        if self.downloader is None:
+            downloader.close()
+        return None
+
+    def _template_key(self) -> str:
+        pip = f'pip-{self.pip_bootstrap}' if self.with_pip else 'nopip'
+        key = f'{self.python_version}-{self.platform_arch}-{pip}'
+        if self.requirements:
+            key += f'-req-{sha256_file(self.requirements)[:16]}'
+        # the wheels picked from the wheelhouse change with it even when the requirements do not
+        wheels = [
+            *(self._bootstrap_wheels().values() if self.with_pip and self.pip_bootstrap == 'wheels' else []),
+            *(self._requirement_wheels() if self.requirements else []),
+        ]
+        if wheels:
+            picked = chr(0).join(sorted(f'{os.path.basename(info.path)}:{os.path.getsize(info.path)}' for info in wheels))
+            key += f"-whl-{hashlib.sha256(picked.encode('utf-8')).hexdigest()[:16]}"
+        if self.compile_bytecode:
+            key += f'-pyc-{self.invalidation_mode}'
+        if self.excludes():
+            key += f"-slim-{hashlib.sha256(chr(0).join(sorted(self.excludes())).encode('utf-8')).hexdigest()[:16]}"
+        if self.hash_index is not None:
+            # templates built from checked downloads are neither shared with unchecked builds nor with other pins
+            pinned = [f'python-{self.python_version}-embed-{self.platform_arch}.zip']
+            if self.with_pip and self.pip_bootstrap == 'get-pip':
+                pinned.append('get-pip.py')
+            pins = chr(0).join(f"{name}={self.hash_index.files.get(name, '')}" for name in pinned)
+            key += f"-pinned-{hashlib.sha256(pins.encode('utf-8')).hexdigest()[:16]}"
+        return key
+
+    def create(self, env_dir: Union[str, bytes, os.PathLike[str], os.PathLike[bytes]]) -> None:
+        """
+        Create a virtual environment in a directory.
+
+        With a cache directory, the environment is cloned from a finished
+        template for the same python version, architecture and pip setting,
+        which is built on first use. The files of the finished environment
+        are recorded in its manifest for ``penv verify``.
+        A partial python version is resolved first (see resolve_python_version),
+        and the hash index is read again if its file changed.
+        With a package store, the files of Lib/site-packages are linked from it
+        afterwards (see link_package_store).
+        The phases are recorded by the profiler.
+        """
+        env_dir = os.path.abspath(os.fsdecode(env_dir))
+        with self.profiler.phase('create', env_dir):
+            self.resolve_python_version()
+            if self.hash_index is not None:
+                self.hash_index.reload()
+            self._create(env_dir)
+            if self.package_store:
+                self.link_package_store(env_dir)
+
+    def derive(self, **options: Any) -> 'EmbeddableEnvBuilder':
+        """Returns a copy of this builder with options (see TARGET_OPTIONS) replaced
+
+        The copy shares the downloads, templates in flight and downloader of
+        this builder, so the artifacts needed by both are fetched once. It has
+        a profiler of its own, which calls the callback of this builder's one.
+        """
+        unknown = set(options) - set(TARGET_OPTIONS)
+        assert not unknown, f"options must be among {TARGET_OPTIONS}, not {sorted(unknown)}"
+        assert options.get('link_mode', self.link_mode) in LINK_MODES, f"link_mode must be one of {LINK_MODES}"
+        assert options.get('pip_bootstrap', self.pip_bootstrap) in PIP_BOOTSTRAP_MODES, \
+            f"pip_bootstrap must be one of {PIP_BOOTSTRAP_MODES}"
+        assert options.get('invalidation_mode', self.invalidation_mode) in INVALIDATION_MODES, \
+            f"invalidation_mode must be one of {INVALIDATION_MODES}"
+        # created before copying so that the copies share it
+        self._artifacts_root()
+        builder = copy.copy(self)
+        builder.exclude = list(self.exclude)
+        builder.profiler = Profiler(self.profiler.callback)
+        for name, value in options.items():
+            setattr(builder, name, value)
+        if 'exclude' in options:
+            builder.exclude = list(options['exclude'] or [])
+        return builder
+
+    def create_many(
+        self,
+        targets: Iterable[Union[str, os.PathLike, Tuple[Union[str, os.PathLike], Mapping[str, Any]]]],
+        executor: Optional[Executor] = None,
+        max_workers: Optional[int] = None,
+        progress: Optional[Callable[[PhaseRecord], None]] = None,
+    ) -> List['Future[None]']:
+        """
+        Create environments concurrently and returns a future per target.
+
+        A target is a directory or a (directory, options) pair whose options
+        replace those of this builder for that environment (see derive).
+        The environments are created on executor, or on a pool of max_workers
+        threads, and the downloads and templates they need are fetched and
+        built once. progress is called with the record of each phase of the
+        targets as it ends, from the threads creating them; the record of
+        the ``create`` phase ends an environment. An exception raised by
+        progress is logged and does not fail the environment.
+        """
+        jobs = []
+        for target in targets:
+            env_dir, options = target if isinstance(target, tuple) else (target, {})
+            jobs.append((self.derive(**options) if options else self, env_dir))
+        unsubscribes = []
+        if progress is not None:
+            env_dirs = {os.path.abspath(os.fsdecode(env_dir)) for _, env_dir in jobs}
+            # the derived builders have profilers of their own
+            for profiler in {id(builder.profiler): builder.profiler for builder, _ in jobs}.values():
+                unsubscribes.append(profiler.subscribe(lambda record: progress(record) if record.env_dir in env_dirs else None))
+        pool = executor if executor is not None else ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [pool.submit(builder.create, env_dir) for builder, env_dir in jobs]
+        finally:
+            if executor is None:
+                # the threads exit once the environments are created
+                pool.shutdown(wait=False)
+        if unsubscribes:
+            remaining = [len(futures)]
+            lock = threading.Lock()
+
+            def done(_: 'Future[None]') -> None:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        for unsubscribe in unsubscribes:
+                            unsubscribe()
+
+            for future in futures:
+                future.add_done_callback(done)
+        return futures
+
+    async def acreate_many(
+        self,
+        targets: Iterable[Union[str, os.PathLike, Tuple[Union[str, os.PathLike], Mapping[str, Any]]]],
+        executor: Optional[Executor] = None,
+        max_workers: Optional[int] = None,
+        progress: Optional[Callable[[PhaseRecord], None]] = None,
+    ) -> List[Optional[BaseException]]:
+        """create_many for asyncio: waits for all targets and returns the exception of each (None if created)"""
+        futures = self.create_many(targets, executor=executor, max_workers=max_workers, progress=progress)
+        return await asyncio.gather(*(asyncio.wrap_future(f) for f in futures), return_exceptions=True)
+
+    def _create(self, env_dir: str) -> None:
+        if not self.cache_dir or not self.use_templates or self.upgrade:
+            super().create(env_dir)
+            self._record_files(env_dir)
+            return
+        templates = TemplateCache(self.cache_dir)
+        key = self._template_key()
+
+        def build() -> dict:
+            meta = templates.load(key)
+            if meta is None:
+                # built once among the processes sharing the cache
+                with templates.lock(key):
+                    meta = templates.load(key)
+                    if meta is None:
+                        return build_template()
+            self.profiler.count('template_hits')
+            logger.info(f"Use environment template {key}")
+            return meta
+
+        def build_template() -> dict:
+            self.profiler.count('template_misses')
+            logger.info(f"Building environment template {key}")
+            tree = templates.build_dir(key)
+            try:
+                super(EmbeddableEnvBuilder, self).create(tree)
+                # scanned once for both the manifest of the tree and the template
+                patch_files = [rel for rel in find_patch_points(tree) if rel != MANIFEST_FILE]
+                self._record_files(tree, patch_files=patch_files)
+                return templates.publish(key, tree, patch_files=patch_files)
+            except BaseException:
+                templates.discard(tree)
+                raise
+
+        with self.profiler.phase('template', env_dir):
+            meta = self._flights.do(('template', key), build)
+        context = self.ensure_directories(env_dir)
+        scripts = [
+            name for name in os.listdir(meta['tree'])
+            if any(fnmatch.fnmatch(name.lower(), pattern) for pattern in REGENERATED_SCRIPTS)
+        ]
+        with self.profiler.phase('clone', env_dir):
+            counts = templates.clone(meta, env_dir, mode=self.link_mode, skip=[*scripts, MANIFEST_FILE])
+            # a file of its own rather than a (read-only) link, as it is rewritten below
+            save_manifest(env_dir, load_manifest(meta['tree']) or {})
+            self.profiler.count('files_cloned', sum(counts.values()))
+        logger.debug(f"Cloned template {key} to {env_dir}: {counts}")
+        self.setup_scripts(context)
+        self._patch_scripts(context)
+        # only the patched and regenerated files differ from the template's index
+        self._record_files(env_dir, patch_files=sorted({
+            *(rel for rel in meta['patch_files'] if rel != MANIFEST_FILE and rel not in scripts),
+            *find_patch_points(env_dir, only=scripts),
+        }))
+
+    @_phase('manifest')
+    def _record_files(self, env_dir: str, patch_files: Optional[List[str]] = None) -> None:
+        # the files which refer to the location of the environment are recorded for `penv clone`;
+        # without a template they are unknown (None) and only scanned for by a clone of the environment
+        record_files(env_dir, extra={'origin': os.path.abspath(env_dir), 'patch_files': patch_files})
+
+    @_phase('store')
+    def link_package_store(self, env_dir: str) -> None:
+        """Replace the files of Lib/site-packages with links to their copy in the package store
+
+        The hashes are taken from the manifest, which is updated to the linked files.
+        """
+        assert self.package_store is not None
+        manifest = load_manifest(env_dir)
+        if manifest is None or 'files' not in manifest:
+            raise ValueError(f'{env_dir} has no file index to link to the package store')
+        files = {rel: record for rel, record in manifest['files'].items() if rel.startswith(STORE_PREFIX)}
+        counts = PackageStore(self.package_store, self.link_mode).link(env_dir, files)
+        save_manifest(env_dir, manifest)
+        self.profiler.count('files_stored', counts['added'])
+        self.profiler.count('files_linked', counts['linked'] + counts['shared'])
+        logger.info(
+            f"Linked {len(files)} files of {env_dir} to the package store: "
+            f"{counts['added']} added, {counts['linked'] + counts['shared']} shared"
+        )
+
+    def clear_directory(self, path: Union[str, bytes, os.PathLike[str], os.PathLike[bytes]]) -> None:
+        # files linked from the package store or a template are read-only
+        for name in os.listdir(os.fsdecode(path)):
+            fn = os.path.join(os.fsdecode(path), name)
+            if os.path.islink(fn) or os.path.isfile(fn):
+                remove_file(fn)
+            elif os.path.isdir(fn):
+                remove_tree(fn)
+
+    @_phase('ensure_directories')
     def ensure_directories(
         self,
         env_dir: Union[str, bytes, os.PathLike[str], os.PathLike[bytes]],
@@ -113,50 +568,81 @@ class EmbeddableEnvBuilder(EnvBuilder):
         env.pop('PYTHONPATH', None)
         kwargs['cwd'] = context.env_dir
         kwargs['executable'] = context.env_exec_cmd
-        subprocess.check_output(args, **kwargs)
+        started = time.monotonic()
+        try:
+            subprocess.check_output(args, **kwargs)
+        finally:
+            self.profiler.count('subprocesses')
+            self.profiler.count('subprocess_time', time.monotonic() - started)
 
+    @_phase('setup_python')
     def setup_python(self, context: SimpleNamespace) -> None:
+        self.resolve_python_version()
         # download and extract the embeddable python
         zip_name: str = f'python-{self.python_version}-embed-{self.platform_arch}.zip'
-        if self.cache_dir and os.path.exists(os.path.join(self.cache_dir, zip_name)):
-            logger.info(
-                f"Use cached embeddable python {zip_name} in {self.cache_dir}"
-            )
-            try:
-                shutil.copyfile(
-                    os.path.join(self.cache_dir, zip_name),
-                    zip_name,
-                )
-            except shutil.SameFileError:
-                logger.warning(
-                    f"shutil.copyfile has raised SameFileError: {zip_name}"
-                )
-                pass
-        else:
-            url = f'https://www.python.org/ftp/python/{self.python_version}/{zip_name}'
-            subprocess.run(['curl', '-fsLO', url], check=True)
-            logger.debug(f"Downloaded {url}")
+        excludes = self.excludes()
+        remote: Optional[RangeFile] = None
+        zip_source: ArchiveSource
+        with self.profiler.phase('download', context.env_dir):
+            # the fastest mirror first
+            url, *mirrors = self.python_mirrors.urls(f'{self.python_version}/{zip_name}')
             if self.cache_dir:
-                logger.info(f"Caching embeddable python {zip_name} in {self.cache_dir}")
+                zip_source = self._cached_archive(zip_name, url, mirrors)
+            else:
+                # only the members extracted are transferred, unless the whole archive is to be verified
+                remote = self._remote_archive([url, *mirrors]) if excludes and self.hash_index is None else None
+                zip_source = remote if remote is not None else self._artifact(url, zip_name, mirrors)
+        manifest = load_manifest(context.env_dir) if self.upgrade else None
+        with self.profiler.phase('extract', context.env_dir):
+            for attempt in range(1, CACHE_READ_ATTEMPTS + 1):
                 try:
-                    shutil.copyfile(
-                        zip_name,
-                        os.path.join(self.cache_dir, zip_name),
+                    # on upgrade, only rewrite the files which differ from the archive the environment was made from
+                    entries, written, removed = sync_zip(
+                        zip_source,
+                        context.env_dir,
+                        manifest.get('archive') if manifest is not None else None,
+                        skip=[
+                            pattern.format(short_version=short_version(self.python_version))
+                            for pattern in UPGRADE_KEEP
+                        ] if manifest is not None else (),
+                        exclude=excludes,
                     )
-                except shutil.SameFileError:
-                    logger.warning(f"shutil.copyfile has raised SameFileError: {zip_name}")
-                    pass
-        # extract the embeddable python
-        shutil.unpack_archive(zip_name, context.env_dir)
+                    break
+                except FileNotFoundError:
+                    # evicted from the cache by another process since the lookup
+                    if not self.cache_dir or os.path.exists(zip_source) or attempt == CACHE_READ_ATTEMPTS:  # type: ignore
+                        raise
+                    logger.warning(f"{zip_name} was evicted from the cache while it was extracted; fetching it again")
+                    zip_source = self._cached_archive(zip_name, url, mirrors)
+            if manifest is not None:
+                logger.info(
+                    f"Upgraded {context.env_dir} from {manifest.get('python_version')} to {self.python_version}: "
+                    f"{len(written)} files written, {len(removed)} removed, {len(entries) - len(written)} unchanged"
+                )
+            else:
+                logger.debug(f"Extracted {zip_name} to {context.env_dir}")
+            self.profiler.count('files_extracted', len(written))
+            self.profiler.count('bytes_extracted', sum(entries[key]['size'] for key in written))
+        if remote is not None:
+            self.profiler.count('bytes_downloaded', remote.transferred)
+            logger.info(f"Transferred {remote.transferred} of the {remote.size} bytes of {remote.url}")
+            if self.downloader is None:
+                remote.downloader.close()
         os.makedirs(os.path.join(context.env_dir, 'Include'), exist_ok=True)
         os.makedirs(os.path.join(context.env_dir, 'Lib', 'site-packages'), exist_ok=True)
         os.makedirs(os.path.join(context.env_dir, 'Scripts'), exist_ok=True)
-        logger.debug(f"Extracted {zip_name} to {context.env_dir}")
-        # remove the zip file
-        os.remove(zip_name)
+        save_manifest(context.env_dir, {
+            **(manifest or {}),
+            'python_version': self.python_version,
+            'platform_arch': self.platform_arch,
+            'archive': entries,
+        })
         # rewrite the pth file
-        short_version = ''.join(self.python_version.split(".")[:-1])
-        pth_file = os.path.join(context.env_dir, f'python{short_version}._pth')
+        pth_name = f'python{short_version(self.python_version)}._pth'
+        if pth_name not in written:
+            logger.debug(f"Kept {pth_name}")
+            return
+        pth_file = os.path.join(context.env_dir, pth_name)
         with open(pth_file, 'r') as f:
             contents: str = f.read().replace('#import site', 'import site')
             contents = contents + '\n' + os.path.join('.', 'Lib', 'site-packages') + '\n'
@@ -164,13 +650,15 @@ class EmbeddableEnvBuilder(EnvBuilder):
             f.write(contents)
         logger.debug(f"Rewrote {pth_file}")
 
+    @_phase('setup_pip')
     def _setup_pip(self, context: SimpleNamespace) -> None:
+        if self.pip_bootstrap == 'wheels':
+            self._setup_pip_from_wheels(context)
+            return
         # use get-pip.py
         # download and extract get-pip
-        url: str = 'https://bootstrap.pypa.io/get-pip.py'
-        get_pip_path: str = os.path.join(context.env_dir, 'get-pip.py')
-        subprocess.run(['curl', '-fsL', url, '-o', get_pip_path], check=True)
-        logger.debug(f"Downloaded {url}")
+        url, *mirrors = self.get_pip_mirrors.urls('get-pip.py')
+        get_pip_path: str = self._artifact(url, 'get-pip.py', mirrors)
         # run get-pip
         self._call_new_python(context, get_pip_path, stderr=subprocess.STDOUT)  # type: ignore
         # subprocess.run([context.env_exe, get_pip_path], check=True)
@@ -181,7 +669,97 @@ class EmbeddableEnvBuilder(EnvBuilder):
         # pip_dir: str = os.path.dirname(pip.__file__)
         # shutil.copytree(pip_dir, os.path.join(context.env_dir, 'Lib', 'site-packages', 'pip'))
 
+    def _bootstrap_wheels(self) -> Dict[str, WheelInfo]:
+        """Returns the wheels of CORE_VENV_DEPS in the wheelhouse or the host's ensurepip bundle"""
+        dirs = [d for d in (self.wheelhouse, ensurepip_wheel_dir()) if d]
+        return find_wheels(dirs, CORE_VENV_DEPS, self.python_version, self.platform_arch)
+
+    def _requirement_wheels(self) -> List[WheelInfo]:
+        """Returns the wheels in the wheelhouse for the requirements file"""
+        assert self.requirements is not None
+        if not self.wheelhouse:
+            raise ValueError('Installing requirements needs a wheelhouse')
+        return select_wheels(
+            parse_requirements(self.requirements),
+            [self.wheelhouse],
+            self.python_version,
+            self.platform_arch,
+        )
+
+    def _setup_pip_from_wheels(self, context: SimpleNamespace) -> None:
+        """Install CORE_VENV_DEPS by unpacking wheels from the wheelhouse or the host's ensurepip bundle"""
+        dirs = [d for d in (self.wheelhouse, ensurepip_wheel_dir()) if d]
+        wheels = self._bootstrap_wheels()
+        if 'pip' not in wheels:
+            raise FileNotFoundError(f"No pip wheel found in {dirs}")
+        for name in CORE_VENV_DEPS:
+            if name not in wheels:
+                logger.warning(f"No {name} wheel found in {dirs}; skipped")
+        site_packages = os.path.join(context.env_dir, 'Lib', 'site-packages')
+        scripts_dir = os.path.join(context.env_dir, 'Scripts')
+        # pip first: its vendored distlib provides the launchers of the entry point scripts
+        for name in sorted(wheels, key=lambda n: n != 'pip'):
+            install_wheel(
+                wheels[name].path,
+                context.env_dir,
+                site_packages,
+                scripts_dir,
+                context.env_exe,
+                platform_arch=self.platform_arch,
+            )
+            logger.debug(f"Installed {os.path.basename(wheels[name].path)}")
+
+    @_phase('setup_scripts')
+    def setup_scripts(self, context: SimpleNamespace) -> None:
+        super().setup_scripts(context)
+
+    @_phase('post_setup')
     def post_setup(self, context: SimpleNamespace) -> None:
+        self._patch_scripts(context)
+        if self.requirements:
+            self.install_requirements(context)
+        if self.compile_bytecode:
+            self.compile_site_packages(context)
+
+    @_phase('install_requirements')
+    def install_requirements(self, context: SimpleNamespace) -> None:
+        """Install the wheels for the requirements file from the wheelhouse in-process"""
+        wheels = self._requirement_wheels()
+        store = WheelStore(os.path.join(self.cache_dir, WHEEL_STORE_DIR), self.link_mode) if self.cache_dir else None
+        installed = install_wheels(
+            [info.path for info in wheels],
+            context.env_dir,
+            os.path.join(context.env_dir, 'Lib', 'site-packages'),
+            os.path.join(context.env_dir, 'Scripts'),
+            context.env_exe,
+            platform_arch=self.platform_arch,
+            store=store,
+        )
+        logger.info(f"Installed {len(wheels)} wheels ({len(installed)} files) into {context.env_dir}")
+
+    @_phase('compile')
+    def compile_site_packages(self, context: SimpleNamespace) -> int:
+        """Precompile Lib/site-packages with the new python and returns the number of pycs written"""
+        site_packages = os.path.join(context.env_dir, 'Lib', 'site-packages')
+        before = count_bytecode(site_packages)
+        started = time.monotonic()
+        try:
+            self._call_new_python(
+                context,
+                *compileall_args(site_packages, self.invalidation_mode),
+                stderr=subprocess.STDOUT,
+            )
+        except subprocess.CalledProcessError as e:
+            # a module which does not compile (e.g. python 2 only test data)
+            # is imported from source as before
+            output = e.output.decode(errors='replace') if isinstance(e.output, bytes) else e.output
+            logger.warning(f"Some modules in {site_packages} could not be compiled:\n{output}")
+        compiled = count_bytecode(site_packages) - before
+        elapsed = time.monotonic() - started
+        logger.info(f"Compiled {compiled} files in {site_packages} in {elapsed:.2f}s ({self.invalidation_mode})")
+        return compiled
+
+    def _patch_scripts(self, context: SimpleNamespace) -> None:
         contents: str = ''
         # modify activate.bat
         activate_bat_path: str = os.path.join(context.bin_path, 'activate.bat')
@@ -217,7 +795,310 @@ class EmbeddableEnvBuilder(EnvBuilder):
         logger.debug(f"Modified {activate_path}")
 
 
+def _create_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='Creates virtual Python environments in one or more target directories.',
+        epilog=(
+            'Once an environment has been created, you may wish to '
+            'activate it, e.g. by sourcing an activate script in its bin directory.'
+        ),
+    )
+    parser.add_argument(
+        'dirs',
+        metavar='ENV_DIR',
+        nargs='+',
+        help='A directory to create the environment in.',
+    )
+    parser.add_argument(
+        '--clear',
+        default=False,
+        action='store_true',
+        dest='clear',
+        help=(
+            'Delete the contents of the environment directory if it '
+            'already exists, before environment creation.'
+        ),
+    )
+    parser.add_argument(
+        '--upgrade',
+        default=False,
+        action='store_true',
+        dest='upgrade',
+        help=(
+            'Upgrade the environment directory to use this version '
+            'of Python, assuming Python has been upgraded in-place.'
+        ),
+    )
+    parser.add_argument(
+        '--without-pip',
+        dest='with_pip',
+        default=True,
+        action='store_false',
+        help=(
+            'Skips installing or upgrading pip in the '
+            'virtual environment (pip is bootstrapped by default)'
+        ),
+    )
+    parser.add_argument(
+        '--pip-bootstrap',
+        default='get-pip',
+        choices=PIP_BOOTSTRAP_MODES,
+        dest='pip_bootstrap',
+        help=(
+            'How pip is installed: run get-pip.py, or unpack the pip and setuptools wheels '
+            'from --wheelhouse or the ensurepip bundle without network access.'
+        ),
+    )
+    parser.add_argument(
+        '--wheelhouse',
+        default=None,
+        dest='wheelhouse',
+        help='A directory of wheels used by --pip-bootstrap wheels and --requirements',
+    )
+    parser.add_argument(
+        '--requirements',
+        default=None,
+        dest='requirements',
+        help=(
+            'A requirements file of NAME or NAME==VERSION lines. The matching wheels '
+            'in --wheelhouse are installed in parallel without running pip.'
+        ),
+    )
+    parser.add_argument(
+        '--prompt',
+        help='Provides an alternative prompt prefix for this environment.',
+    )
+    parser.add_argument(
+        '--python-version',
+        default=platform.python_version(),
+        dest='python_version',
+        help=(
+            'The version of Python to use: X.Y.Z, or X.Y or a specifier like ">=3.11,<3.13" '
+            'for the latest matching release with an embeddable build.'
+        ),
+    )
+    parser.add_argument(
+        '--platform-arch',
+        default=platform.machine().lower(),
+        dest='platform_arch',
+        help='The platform architecture to use',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        dest='cache_dir',
+        help='The directory to cache the embeddable python',
+    )
+    parser.add_argument(
+        '--slim',
+        default=False,
+        action='store_true',
+        dest='slim',
+        help=f"Leave out the members of the embeddable python which environments rarely need: {', '.join(SLIM_EXCLUDES)}",
+    )
+    parser.add_argument(
+        '--exclude',
+        default=None,
+        action='append',
+        metavar='PATTERN',
+        dest='exclude',
+        help=(
+            'Leave out the members of the embeddable python matching this fnmatch pattern (e.g. _sqlite3.pyd); '
+            'may be repeated. Without --cache-dir, excluded members are not even downloaded from servers '
+            'supporting range requests.'
+        ),
+    )
+    parser.add_argument(
+        '--cache-max-size',
+        default=None,
+        type=parse_size,
+        dest='cache_max_size',
+        help=(
+            'The maximum size of the cache directory, e.g. 500M. '
+            'The least recently used archives are evicted beyond it.'
+        ),
+    )
+    parser.add_argument(
+        '--no-template',
+        default=True,
+        action='store_false',
+        dest='use_templates',
+        help=(
+            'Do not clone the environment from a pre-built template '
+            'in the cache directory.'
+        ),
+    )
+    parser.add_argument(
+        '--link-mode',
+        default='auto',
+        choices=LINK_MODES,
+        dest='link_mode',
+        help=(
+            'How files are cloned from a template: reflink (copy-on-write), '
+            'hardlink, copy, or auto to use the first one the file system supports.'
+        ),
+    )
+    parser.add_argument(
+        '--compile',
+        default=False,
+        action='store_true',
+        dest='compile_bytecode',
+        help=(
+            'Precompile the modules in Lib/site-packages on a process pool '
+            'so that the first run does not compile them.'
+        ),
+    )
+    parser.add_argument(
+        '--invalidation-mode',
+        default='timestamp',
+        choices=INVALIDATION_MODES,
+        dest='invalidation_mode',
+        help=(
+            'How the pycs written by --compile are checked against their source. '
+            'unchecked-hash pycs stay valid when the environment is moved or unpacked elsewhere.'
+        ),
+    )
+    parser.add_argument(
+        '--jobs',
+        default=1,
+        type=int,
+        dest='jobs',
+        help=(
+            'The number of environments created concurrently. '
+            'Downloads needed by several of them are shared.'
+        ),
+    )
+    parser.add_argument(
+        '--connections',
+        default=DEFAULT_CONNECTIONS,
+        type=int,
+        dest='connections',
+        help='The number of parallel connections used for each download',
+    )
+    parser.add_argument(
+        '--python-mirror',
+        default=None,
+        action='append',
+        dest='python_mirrors',
+        help=(
+            'A mirror of https://www.python.org/ftp/python (http, https or file URL) to download '
+            'the embeddable python from; may be repeated. The fastest responding mirror is used '
+            'and a failing or stalled download is resumed from the others.'
+        ),
+    )
+    parser.add_argument(
+        '--get-pip-mirror',
+        default=None,
+        action='append',
+        dest='get_pip_mirrors',
+        help='A mirror of https://bootstrap.pypa.io to download get-pip.py from; may be repeated.',
+    )
+    parser.add_argument(
+        '--hash-index',
+        default=None,
+        dest='hash_index',
+        help=(
+            'A JSON file of the SHA-256 of the embeddable pythons and get-pip.py (see `penv hashes`). '
+            'Downloads are hashed while they stream in, and those which do not match are neither '
+            'unpacked nor run.'
+        ),
+    )
+    parser.add_argument(
+        '--package-store',
+        default=None,
+        dest='package_store',
+        help=(
+            'A directory keeping each file of Lib/site-packages once by its hash, linked into the '
+            'environments by --link-mode. `penv store gc` removes the files no environment uses.'
+        ),
+    )
+    parser.add_argument(
+        '--profile-json',
+        default=None,
+        dest='profile_json',
+        help=(
+            'Write the wall time and counters (bytes downloaded and extracted, '
+            'cache hits, subprocess time) of each build phase to this JSON file.'
+        ),
+    )
+    parser.add_argument(
+        '--daemon',
+        default=None,
+        dest='daemon',
+        help=(
+            'Have the daemon started by `penv serve` at HOST:PORT (or a Unix socket path) '
+            'create the environments with its warm caches.'
+        ),
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    return parser
+
+
+def _check_options(options) -> None:
+    if options.upgrade and options.clear:
+        raise ValueError('you cannot supply --upgrade and --clear together.')
+    if options.requirements and not options.wheelhouse:
+        raise ValueError('you must supply --wheelhouse with --requirements.')
+
+
+def _parse_options(args):
+    options = _create_parser().parse_args(args)
+    _check_options(options)
+    return options
+
+
+def _create_builder(options) -> EmbeddableEnvBuilder:
+    return EmbeddableEnvBuilder(
+        python_version=options.python_version,
+        platform_arch=options.platform_arch,
+        cache_dir=options.cache_dir,
+        cache_max_size=options.cache_max_size,
+        use_templates=options.use_templates,
+        link_mode=options.link_mode,
+        pip_bootstrap=options.pip_bootstrap,
+        wheelhouse=options.wheelhouse,
+        requirements=options.requirements,
+        compile_bytecode=options.compile_bytecode,
+        invalidation_mode=options.invalidation_mode,
+        downloader=Downloader(connections=options.connections),
+        python_mirrors=options.python_mirrors,
+        get_pip_mirrors=options.get_pip_mirrors,
+        package_store=options.package_store,
+        slim=options.slim,
+        exclude=options.exclude,
+        hash_index=options.hash_index,
+        clear=options.clear,
+        upgrade=options.upgrade,
+        with_pip=options.with_pip,
+        prompt=options.prompt,
+        profiler=Profiler(),
+    )
+
+
+SUBCOMMANDS = {
+    'cache': cache_main,
+    'clone': clone_main,
+    'hashes': hashes_main,
+    'verify': verify_main,
+    'pack': pack_main,
+    'serve': serve_main,
+    'store': store_main,
+}
+
+
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[args[0]](args[1:])
     compatible = True
     if os.name != 'nt':
         raise Exception("Only Windows is supported")
@@ -228,96 +1109,32 @@ def main(args=None):
     if not compatible:
         raise ValueError('This script is only for use with Python >= 3.5')
     else:
-        import argparse
-
-        parser = argparse.ArgumentParser(
-            prog=__name__,
-            description='Creates virtual Python environments in one or more target directories.',
-            epilog=(
-                'Once an environment has been created, you may wish to '
-                'activate it, e.g. by sourcing an activate script in its bin directory.'
-            ),
-        )
-        parser.add_argument(
-            'dirs',
-            metavar='ENV_DIR',
-            nargs='+',
-            help='A directory to create the environment in.',
-        )
-        parser.add_argument(
-            '--clear',
-            default=False,
-            action='store_true',
-            dest='clear',
-            help=(
-                'Delete the contents of the environment directory if it '
-                'already exists, before environment creation.'
-            ),
-        )
-        parser.add_argument(
-            '--upgrade',
-            default=False,
-            action='store_true',
-            dest='upgrade',
-            help=(
-                'Upgrade the environment directory to use this version '
-                'of Python, assuming Python has been upgraded in-place.'
-            ),
-        )
-        parser.add_argument(
-            '--without-pip',
-            dest='with_pip',
-            default=True,
-            action='store_false',
-            help=(
-                'Skips installing or upgrading pip in the '
-                'virtual environment (pip is bootstrapped by default)'
-            ),
-        )
-        parser.add_argument(
-            '--prompt',
-            help='Provides an alternative prompt prefix for this environment.',
-        )
-        parser.add_argument(
-            '--python-version',
-            default=platform.python_version(),
-            dest='python_version',
-            help='The version of Python to use',
-        )
-        parser.add_argument(
-            '--platform-arch',
-            default=platform.machine().lower(),
-            dest='platform_arch',
-            help='The platform architecture to use',
-        )
-        parser.add_argument(
-            '--cache-dir',
-            default=None,
-            dest='cache_dir',
-            help='The directory to cache the embeddable python',
-        )
-        parser.add_argument(
-            '--log-level',
-            default='INFO',
-            dest='log_level',
-            help='The logging level',
-        )
-
-        options = parser.parse_args(args)
-        if options.upgrade and options.clear:
-            raise ValueError('you cannot supply --upgrade and --clear together.')
+        options = _parse_options(args)
         logging.basicConfig(level=getattr(logging, options.log_level))
-        builder = EmbeddableEnvBuilder(
-            python_version=options.python_version,
-            platform_arch=options.platform_arch,
-            cache_dir=options.cache_dir,
-            clear=options.clear,
-            upgrade=options.upgrade,
-            with_pip=options.with_pip,
-            prompt=options.prompt,
-        )
-        for d in options.dirs:
-            builder.create(d)
+        if options.daemon:
+            failed = create_remote(options.daemon, options)
+            if failed:
+                raise Exception(f"Failed to create {len(failed)} of {len(options.dirs)} environments: {', '.join(failed)}")
+            return
+        builder = _create_builder(options)
+        try:
+            futures = builder.create_many(options.dirs, max_workers=max(1, options.jobs))
+            dirs = dict(zip(futures, options.dirs))
+            failed_dirs = set()
+            for future in as_completed(futures):
+                e = future.exception()
+                if e is not None:
+                    failed_dirs.add(dirs[future])
+                    logger.error(f"Failed to create {dirs[future]}: {e}")
+                else:
+                    logger.info(f"Created {dirs[future]}")
+        finally:
+            if options.profile_json:
+                builder.profiler.dump(options.profile_json)
+                logger.info(f"Wrote the build profile to {options.profile_json}")
+        failed = [d for d in options.dirs if d in failed_dirs]
+        if failed:
+            raise Exception(f"Failed to create {len(failed)} of {len(options.dirs)} environments: {', '.join(failed)}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+"""Extraction of embeddable python archives."""
+import fnmatch
+import io
+import logging
+import mmap
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Dict, Iterable, List, Optional, Tuple, Union
+from .download import RangeFile
+from .template import remove_file
+
+DEFAULT_EXTRACT_WORKERS: int = min(8, (os.cpu_count() or 1) + 2)
+COPY_BUFFER_SIZE: int = 1024 * 1024
+# members of the embeddable python which --slim leaves out
+SLIM_EXCLUDES = (
+    'LICENSE.txt',
+    'pythonw.exe',
+    '_msi.pyd',
+    'winsound.pyd',
+    '_sqlite3.pyd',
+    'sqlite3.dll',
+    '_tkinter.pyd',
+    'tcl*.dll',
+    'tk*.dll',
+    '_test*.pyd',
+    '_ctypes_test.pyd',
+    'xxlimited*.pyd',
+)
+# members without which the embeddable python does not start; never excluded
+REQUIRED_MEMBERS = ('python.exe', 'python*.dll', 'python*._pth', 'python*.zip')
+
+logger = logging.getLogger(__name__)
+
+ArchiveSource = Union[str, 'os.PathLike[str]', IO[bytes], mmap.mmap, RangeFile]
+# {relative path: {'size': ..., 'crc32': ...}} as recorded in the central directory
+ArchiveEntries = Dict[str, Dict[str, int]]
+
+
+class _MmapReader(io.RawIOBase):
+    """File object view of an mmap (mmap has no seekable() before Python 3.13)"""
+
+    def __init__(self, m: mmap.mmap):
+        self._m = m
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:  # type: ignore
+        data = self._m.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._m.seek(offset, whence)  # type: ignore
+        return self._m.tell()
+
+    def tell(self) -> int:
+        return self._m.tell()
+
+
+def _member_parts(name: str) -> List[str]:
+    return [
+        p for p in name.replace('\\', '/').split('/')
+        if p not in ('', '.', '..') and not (len(p) == 2 and p[1] == ':')
+    ]
+
+
+def member_path(dest: str, name: str) -> str:
+    """Returns the path where the member name is extracted into dest
+
+    Absolute paths, drive letters and '..' components are dropped like
+    ``zipfile.ZipFile.extract`` does.
+    """
+    return os.path.join(dest, *_member_parts(name))
+
+
+def member_key(name: str) -> str:
+    """Returns the '/' separated path of the member name relative to dest"""
+    return '/'.join(_member_parts(name))
+
+
+def is_excluded(key: str, exclude: Iterable[str]) -> bool:
+    """Whether the member key matches one of the fnmatch patterns exclude (case-insensitively)
+
+    A pattern without '/' matches the file name in any directory.
+    REQUIRED_MEMBERS are never excluded.
+    """
+    key = key.lower()
+    name = key.rsplit('/', 1)[-1]
+
+    def matches(pattern: str) -> bool:
+        pattern = pattern.lower()
+        return fnmatch.fnmatchcase(key, pattern) or ('/' not in pattern and fnmatch.fnmatchcase(name, pattern))
+
+    return any(matches(p) for p in exclude) and not any(fnmatch.fnmatchcase(key, p.lower()) for p in REQUIRED_MEMBERS)
+
+
+def member_spans(zf: zipfile.ZipFile, infos: Iterable[zipfile.ZipInfo]) -> List[Tuple[int, int]]:
+    """Returns the byte ranges [begin, end] of the archive holding the local headers and data of infos"""
+    offsets = sorted({info.header_offset for info in zf.infolist()} | {getattr(zf, 'start_dir')})
+    following = dict(zip(offsets, offsets[1:]))
+    return [(info.header_offset, following[info.header_offset] - 1) for info in infos]
+
+
+def extract_zip(
+    source: ArchiveSource,
+    dest: str,
+    members: Optional[Iterable[str]] = None,
+    max_workers: int = DEFAULT_EXTRACT_WORKERS,
+) -> int:
+    """Extract a zip archive into dest without copying it first
+
+    source may be a path (e.g. the archive in the cache) or a seekable binary
+    file object such as an mmap or an in-memory download. From a RangeFile,
+    only the members extracted are transferred. Members are decompressed
+    concurrently on a thread pool; zlib releases the GIL.
+    Returns the number of bytes written.
+    """
+    if isinstance(source, mmap.mmap):
+        source = _MmapReader(source)  # type: ignore
+    os.makedirs(dest, exist_ok=True)
+    with zipfile.ZipFile(source) as zf:  # type: ignore
+        infos: List[zipfile.ZipInfo] = zf.infolist()
+        if members is not None:
+            wanted = set(members)
+            infos = [info for info in infos if info.filename in wanted]
+        files = [info for info in infos if not info.is_dir()]
+        if isinstance(source, RangeFile):
+            source.prefetch(member_spans(zf, files))
+        # create the directories up front so that the workers do not race on them
+        dirs = {os.path.dirname(member_path(dest, info.filename)) for info in files}
+        dirs.update(member_path(dest, info.filename) for info in infos if info.is_dir())
+        for d in sorted(dirs):
+            os.makedirs(d, exist_ok=True)
+        if max_workers <= 1 or len(files) <= 1:
+            written = sum(_extract_member(zf, info, dest) for info in files)
+        else:
+            written = _extract_parallel(source, zf, files, dest, max_workers)
+    logger.debug(f"Extracted {len(files)} files ({written} bytes) to {dest}")
+    return written
+
+
+def _extract_parallel(
+    source: ArchiveSource,
+    zf: zipfile.ZipFile,
+    files: List[zipfile.ZipInfo],
+    dest: str,
+    max_workers: int,
+) -> int:
+    # a path can be opened by every worker, avoiding the lock ZipFile
+    # holds around its shared file object
+    local = threading.local()
+    opened: List[zipfile.ZipFile] = []
+    opened_lock = threading.Lock()
+
+    def worker_zipfile() -> zipfile.ZipFile:
+        if not isinstance(source, (str, os.PathLike)):
+            return zf
+        if not hasattr(local, 'zf'):
+            local.zf = zipfile.ZipFile(source)
+            with opened_lock:
+                opened.append(local.zf)
+        return local.zf
+
+    # largest first so that one big member does not finish last
+    files = sorted(files, key=lambda info: info.file_size, reverse=True)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(lambda info: _extract_member(worker_zipfile(), info, dest), info)
+                for info in files
+            ]
+            return sum(future.result() for future in futures)
+    finally:
+        for z in opened:
+            z.close()
+
+
+def _extract_member(zf: zipfile.ZipFile, info: zipfile.ZipInfo, dest: str) -> int:
+    target = member_path(dest, info.filename)
+    with zf.open(info) as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    return info.file_size
+
+
+def _open_source(source: ArchiveSource) -> zipfile.ZipFile:
+    if isinstance(source, mmap.mmap):
+        source = _MmapReader(source)  # type: ignore
+    return zipfile.ZipFile(source)  # type: ignore
+
+
+def archive_entries(source: ArchiveSource, exclude: Iterable[str] = ()) -> ArchiveEntries:
+    """Returns the size and CRC-32 of each file of a zip archive not matching exclude (see is_excluded)
+
+    Only the central directory is read; nothing is decompressed.
+    """
+    patterns = list(exclude)
+    with _open_source(source) as zf:
+        return {
+            member_key(info.filename): {'size': info.file_size, 'crc32': info.CRC}
+            for info in zf.infolist()
+            if not info.is_dir() and not is_excluded(member_key(info.filename), patterns)
+        }
+
+
+def sync_zip(
+    source: ArchiveSource,
+    dest: str,
+    previous: Optional[ArchiveEntries] = None,
+    skip: Iterable[str] = (),
+    max_workers: int = DEFAULT_EXTRACT_WORKERS,
+    exclude: Iterable[str] = (),
+) -> Tuple[ArchiveEntries, List[str], List[str]]:
+    """Bring dest, extracted from the archive previous, up to date with the archive source
+
+    Only the members whose size or CRC-32 differ from previous, or which are
+    missing from dest, are extracted; files of previous which are no longer
+    in the archive are removed. Existing files matching one of the fnmatch
+    patterns skip (on their '/' separated relative path) are left alone.
+    Changed files are replaced rather than rewritten, so files hardlinked
+    into dest are never modified in place. Members matching exclude (see
+    is_excluded) are left out as if they were not in the archive.
+    Returns the entries of source and the relative paths written and removed.
+    """
+    previous = previous or {}
+    patterns = list(skip)
+    entries = archive_entries(source, exclude)
+
+    def skipped(key: str) -> bool:
+        return any(fnmatch.fnmatch(key, pattern) for pattern in patterns)
+
+    def unchanged(key: str, entry: Dict[str, int]) -> bool:
+        if previous.get(key) != entry:
+            return False
+        try:
+            return os.stat(member_path(dest, key)).st_size == entry['size']
+        except OSError:
+            return False
+
+    written: List[str] = []
+    for key, entry in entries.items():
+        target = member_path(dest, key)
+        if skipped(key) and os.path.exists(target):
+            continue
+        if previous and unchanged(key, entry):
+            continue
+        if os.path.lexists(target):
+            remove_file(target)
+        written.append(key)
+    removed: List[str] = []
+    for key in sorted(set(previous) - set(entries)):
+        target = member_path(dest, key)
+        if skipped(key) or not os.path.lexists(target):
+            continue
+        remove_file(target)
+        removed.append(key)
+    if written:
+        wanted = set(written)
+        with _open_source(source) as zf:
+            names = [info.filename for info in zf.infolist() if member_key(info.filename) in wanted]
+        extract_zip(source, dest, members=names, max_workers=max_workers)
+    else:
+        os.makedirs(dest, exist_ok=True)
+    logger.debug(f"Synced {dest}: {len(written)} written, {len(removed)} removed, {len(entries) - len(written)} kept")
+    return entries, written, removed
@@ -0,0 +1,35 @@
+"""Precompilation of the bytecode of an environment."""
+import os
+from typing import List
+
+# py_compile.PycInvalidationMode as spelled by ``compileall --invalidation-mode``
+INVALIDATION_MODES = ('timestamp', 'checked-hash', 'unchecked-hash')
+PYCACHE_DIR: str = '__pycache__'
+
+
+def count_bytecode(root: str) -> int:
+    """Returns the number of pyc files in the __pycache__ directories under root"""
+    count = 0
+    for dirpath, _, files in os.walk(root):
+        if os.path.basename(dirpath) != PYCACHE_DIR:
+            continue
+        count += sum(1 for name in files if name.endswith('.pyc'))
+    return count
+
+
+def compileall_args(path: str, invalidation_mode: str = 'timestamp', workers: int = 0) -> List[str]:
+    """Returns the interpreter arguments which compile every module under path
+
+    compileall runs the compilation on a process pool of workers processes,
+    0 meaning one per CPU. Hash-based pycs (PEP 552) do not depend on the
+    modification time of their source, so unchecked-hash pycs stay valid
+    wherever the environment is copied or unpacked to.
+    """
+    if invalidation_mode not in INVALIDATION_MODES:
+        raise ValueError(f'Unknown invalidation mode: {invalidation_mode}')
+    args = ['-m', 'compileall', '-q', '-j', str(workers)]
+    if invalidation_mode != 'timestamp':
+        # the option exists since Python 3.7; leave it out for the default
+        args += ['--invalidation-mode', invalidation_mode]
+    args.append(path)
+    return args
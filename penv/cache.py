@@ -0,0 +1,369 @@
+"""Content-addressed cache of embeddable python archives."""
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, TypeVar
+from .download import PART_SUFFIX, STATE_SUFFIX, Downloader, download
+from .hashes import HashMismatch
+from .lock import LOCKS_DIR, FileLock, is_free, shared_lock
+
+INDEX_FILE: str = 'index.json'
+OBJECTS_DIR: str = 'objects'
+TMP_DIR: str = 'tmp'
+INDEX_VERSION: int = 1
+HASH_CHUNK_SIZE: int = 1024 * 1024
+# interrupted downloads are kept this many seconds to be resumed
+STALE_TMP_AGE: float = 7 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+# serializes the read-modify-write cycles of the index among threads;
+# ArchiveCache.index_lock does among processes
+_index_lock = threading.RLock()
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def _locked(method: F) -> F:
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with _index_lock, self.index_lock:
+            return method(self, *args, **kwargs)
+    return wrapper  # type: ignore
+
+
+class CacheEntry(NamedTuple):
+    name: str
+    sha256: str
+    size: int
+    python_version: Optional[str]
+    platform_arch: Optional[str]
+    last_used: float
+    # whether the object was found to have the SHA-256 pinned in a hash index
+    verified: bool = False
+
+
+def parse_size(value: str) -> int:
+    """Parse a size like '500M' or '2G' into bytes"""
+    match = re.fullmatch(r'\s*(\d+)\s*([kKmMgGtT]?)i?[bB]?\s*', value)
+    if match is None:
+        raise ValueError(f'Invalid size: {value!r}')
+    number, unit = match.groups()
+    return int(number) * 1024 ** ' KMGT'.index(unit.upper() or ' ')
+
+
+def remove_stale_downloads(tmp_dir: str, locks_dir: str, max_age: float = STALE_TMP_AGE) -> int:
+    """Remove the files of interrupted downloads in tmp_dir which were not touched for max_age seconds
+
+    A file is kept while the lock of its download (``<name>.lock`` in locks_dir)
+    is held. Returns the number of removed files.
+    """
+    removed = 0
+    if not os.path.isdir(tmp_dir):
+        return removed
+    now = time.time()
+    for file_name in os.listdir(tmp_dir):
+        path = os.path.join(tmp_dir, file_name)
+        name = file_name
+        for suffix in (STATE_SUFFIX, PART_SUFFIX):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        try:
+            if now - os.path.getmtime(path) < max_age or not is_free(os.path.join(locks_dir, f'{name}.lock')):
+                continue
+            os.remove(path)
+        except OSError as e:
+            logger.debug(f"Can not remove the stale download {path}: {e!r}")
+            continue
+        removed += 1
+        logger.debug(f"Removed the stale download {path}")
+    return removed
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ArchiveCache:
+    """Cache archives by SHA-256 under ``objects/`` with a JSON index.
+
+    The index maps an archive name (e.g. ``python-3.12.1-embed-amd64.zip``)
+    to its hash, size, python version, platform and last-used time.
+    When ``max_size`` is set, the least recently used entries are evicted
+    until the cached objects fit into it.
+    Several processes may share the cache directory: the index is updated
+    under a lock file and objects are published by renaming finished files.
+    """
+
+    def __init__(self, cache_dir: str, max_size: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_dir, INDEX_FILE)
+        self.objects_dir = os.path.join(cache_dir, OBJECTS_DIR)
+        self.tmp_dir = os.path.join(cache_dir, TMP_DIR)
+        self.index_lock = FileLock(os.path.join(cache_dir, LOCKS_DIR, f'{INDEX_FILE}.lock'))
+
+    def lock(self, name: str) -> FileLock:
+        """Returns the lock under which name is downloaded, so that processes wait for each other's download"""
+        return shared_lock(os.path.join(self.cache_dir, LOCKS_DIR, f'{name}.lock'))
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning(f"Ignoring corrupted cache index {self.index_path}")
+            return {}
+        if data.get('version') != INDEX_VERSION:
+            logger.warning(f"Ignoring cache index with unknown version {data.get('version')}")
+            return {}
+        return data.get('entries', {})
+
+    def _save(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def entries(self) -> List[CacheEntry]:
+        """Returns the entries from the most recently used"""
+        return sorted(
+            (CacheEntry(name=name, **entry) for name, entry in self._load().items()),
+            key=lambda e: e.last_used,
+            reverse=True,
+        )
+
+    @_locked
+    def lookup(self, name: str, expected_sha256: Optional[str] = None) -> Optional[str]:
+        """Returns the path of the cached archive and marks it as used
+
+        With expected_sha256, an entry with another hash is dropped so that the
+        archive is downloaded and checked again. An entry not verified yet is
+        re-hashed once and marked as verified, so later lookups read nothing.
+        """
+        entries = self._load()
+        entry = entries.get(name)
+        if entry is None:
+            return None
+        path = self.object_path(entry['sha256'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            logger.warning(f"Dropping broken cache entry {name}")
+            del entries[name]
+            self._save(entries)
+            return None
+        if expected_sha256 is not None and not (entry['sha256'] == expected_sha256 and entry.get('verified')):
+            if entry['sha256'] != expected_sha256 or sha256_file(path) != expected_sha256:
+                logger.warning(f"Dropping cache entry {name} which does not have the pinned SHA-256")
+                del entries[name]
+                self._save(entries)
+                return None
+            entry['verified'] = True
+        entry['last_used'] = time.time()
+        self._save(entries)
+        return path
+
+    @_locked
+    def add(
+        self,
+        name: str,
+        path: str,
+        sha256: Optional[str] = None,
+        python_version: Optional[str] = None,
+        platform_arch: Optional[str] = None,
+        verified: bool = False,
+    ) -> str:
+        """Move the file at path into the cache and returns its new path"""
+        if sha256 is None:
+            sha256 = sha256_file(path)
+        size = os.path.getsize(path)
+        dest = self.object_path(sha256)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+        entries = self._load()
+        entries[name] = {
+            'sha256': sha256,
+            'size': size,
+            'python_version': python_version,
+            'platform_arch': platform_arch,
+            'last_used': time.time(),
+            'verified': verified,
+        }
+        self._save(entries)
+        if self.max_size is not None:
+            self.prune(self.max_size, keep=name)
+        return dest
+
+    def fetch(
+        self,
+        name: str,
+        url: str,
+        downloader: Optional[Downloader] = None,
+        python_version: Optional[str] = None,
+        platform_arch: Optional[str] = None,
+        mirrors: Sequence[str] = (),
+        expected_sha256: Optional[str] = None,
+    ) -> str:
+        """Download url (failing over to mirrors) into the cache, hashing it while it streams in
+
+        With expected_sha256, a download with another hash is deleted and
+        HashMismatch is raised; otherwise the entry is marked as verified.
+        The download is made under the lock of name into ``tmp/<name>``, so that
+        an interrupted download is resumed by the next fetch of name.
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with self.lock(name):
+            hasher = hashlib.sha256()
+            download(url, tmp_path, downloader, hasher=hasher, mirrors=mirrors)
+            if expected_sha256 is not None and hasher.hexdigest() != expected_sha256:
+                os.remove(tmp_path)
+                raise HashMismatch(
+                    f'{url} has the SHA-256 {hasher.hexdigest()} instead of the pinned {expected_sha256}'
+                )
+            return self.add(
+                name,
+                tmp_path,
+                sha256=hasher.hexdigest(),
+                python_version=python_version,
+                platform_arch=platform_arch,
+                verified=expected_sha256 is not None,
+            )
+
+    def _remove_unreferenced(self, entries: Dict[str, Dict[str, Any]]) -> int:
+        referenced = {entry['sha256'] for entry in entries.values()}
+        freed = 0
+        if not os.path.isdir(self.objects_dir):
+            return freed
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for sha256 in os.listdir(prefix_dir):
+                if sha256 not in referenced:
+                    path = os.path.join(prefix_dir, sha256)
+                    try:
+                        size = os.path.getsize(path)
+                        os.remove(path)
+                    except OSError as e:
+                        # e.g. still open in another process on Windows; removed by a later prune
+                        logger.debug(f"Can not remove unreferenced cache object {sha256} yet: {e!r}")
+                        continue
+                    freed += size
+                    logger.debug(f"Removed unreferenced cache object {sha256}")
+        return freed
+
+    @_locked
+    def prune(self, max_size: Optional[int] = None, keep: Optional[str] = None) -> List[str]:
+        """Evict the least recently used entries until the cache fits into max_size
+
+        Objects which are no longer referenced by the index are removed as well,
+        and so are the interrupted downloads left in ``tmp/`` for STALE_TMP_AGE.
+        Returns the names of the evicted entries.
+        """
+        entries = self._load()
+        evicted: List[str] = []
+        if max_size is not None:
+            sizes: Dict[str, int] = {}
+            for entry in entries.values():
+                sizes[entry['sha256']] = entry['size']
+            total = sum(sizes.values())
+            for name in sorted(entries, key=lambda n: entries[n]['last_used']):
+                if total <= max_size:
+                    break
+                if name == keep:
+                    continue
+                sha256 = entries.pop(name)['sha256']
+                evicted.append(name)
+                if all(e['sha256'] != sha256 for e in entries.values()):
+                    total -= sizes[sha256]
+                logger.info(f"Evicted {name} from the cache")
+        self._save(entries)
+        self._remove_unreferenced(entries)
+        remove_stale_downloads(self.tmp_dir, os.path.join(self.cache_dir, LOCKS_DIR))
+        return evicted
+
+    @_locked
+    def verify(self) -> List[str]:
+        """Re-hash every cached object and drop the entries which do not match
+
+        Returns the names of the dropped entries.
+        """
+        entries = self._load()
+        broken: List[str] = []
+        checked: Dict[str, bool] = {}
+        for name, entry in sorted(entries.items()):
+            sha256 = entry['sha256']
+            if sha256 not in checked:
+                path = self.object_path(sha256)
+                checked[sha256] = (
+                    os.path.isfile(path) and os.path.getsize(path) == entry['size'] and sha256_file(path) == sha256
+                )
+            if not checked[sha256]:
+                broken.append(name)
+        for name in broken:
+            logger.warning(f"Cache entry {name} is corrupted")
+            del entries[name]
+        self._save(entries)
+        self._remove_unreferenced(entries)
+        return broken
+
+
+def cache_main(args=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='penv cache',
+        description='Inspects and maintains the embeddable python cache.',
+    )
+    parser.add_argument(
+        'command',
+        choices=['list', 'prune', 'verify'],
+        help='list the cached archives, evict them down to --max-size, or re-hash them.',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        required=True,
+        dest='cache_dir',
+        help='The directory to cache the embeddable python',
+    )
+    parser.add_argument(
+        '--max-size',
+        default=None,
+        type=parse_size,
+        dest='max_size',
+        help='The maximum size of the cache, e.g. 500M (only for prune)',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level))
+    cache = ArchiveCache(options.cache_dir)
+    if options.command == 'list':
+        for entry in cache.entries():
+            last_used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.last_used))
+            print(f'{entry.name}\t{entry.size}\t{entry.sha256}\t{last_used}')
+    elif options.command == 'prune':
+        for name in cache.prune(options.max_size):
+            print(f'evicted {name}')
+    elif options.command == 'verify':
+        broken = cache.verify()
+        for name in broken:
+            print(f'corrupted {name}')
+        if broken:
+            raise ValueError(f'{len(broken)} corrupted cache entries were removed')
@@ -0,0 +1,82 @@
+"""Copies of an environment made by linking its files and re-patching its location."""
+import logging
+import os
+import time
+from typing import Dict
+from .manifest import MANIFEST_FILE, load_manifest, record_files, save_manifest
+from .template import LINK_MODES, clone_relocated, find_patch_points
+
+logger = logging.getLogger(__name__)
+
+
+def clone_env(src: str, dst: str, mode: str = 'auto') -> Dict[str, int]:
+    """Clone the environment src into dst without building it again
+
+    The files are linked (see Cloner) and only those recorded as referring
+    to the location of src when it was created are rewritten, so the time
+    taken depends on the number of files rather than their size. An
+    environment without that record, e.g. one created without a template,
+    is scanned for them first.
+    Returns how many files were cloned by each method and how many were patched.
+    """
+    src, dst = os.path.abspath(src), os.path.abspath(dst)
+    manifest = load_manifest(src)
+    if manifest is None:
+        raise ValueError(f'{src} is not an environment created by penv (no {MANIFEST_FILE})')
+    if os.path.exists(dst) and os.listdir(dst):
+        raise ValueError(f'{dst} is not empty')
+    if manifest.get('patch_files') is not None:
+        origin: str = manifest['origin']
+        patch_files = manifest['patch_files']
+    else:
+        logger.info(f"Scanning {src} for the files which refer to its location")
+        origin = src
+        patch_files = [rel for rel in find_patch_points(src) if rel != MANIFEST_FILE]
+    counts = clone_relocated(src, dst, origin, patch_files, mode=mode, skip=[MANIFEST_FILE])
+    # the records of the linked files still match, so only the patched files are hashed again
+    save_manifest(dst, manifest)
+    record_files(dst, extra={'origin': dst, 'patch_files': patch_files})
+    return counts
+
+
+def clone_main(args=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='penv clone',
+        description=(
+            'Copies an environment to another directory by linking its files and rewriting '
+            'only those which refer to its location. No network access is needed.'
+        ),
+    )
+    parser.add_argument(
+        'src',
+        metavar='SRC',
+        help='The environment directory to clone.',
+    )
+    parser.add_argument(
+        'dst',
+        metavar='DST',
+        help='The new environment directory, which must not exist or be empty.',
+    )
+    parser.add_argument(
+        '--link-mode',
+        default='auto',
+        choices=LINK_MODES,
+        dest='link_mode',
+        help=(
+            'How files are cloned: reflink (copy-on-write), hardlink, copy, '
+            'or auto to use the first one the file system supports.'
+        ),
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level))
+    started = time.monotonic()
+    counts = clone_env(options.src, options.dst, mode=options.link_mode)
+    logger.info(f"Cloned {options.src} to {options.dst} in {time.monotonic() - started:.2f}s: {counts}")
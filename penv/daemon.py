@@ -0,0 +1,312 @@
+"""Long-lived penv process creating environments for thin clients over a local socket.
+
+Requests and replies are JSON lines. A request carries the options of
+``penv`` as the client parsed them, with its defaults and absolute paths, and
+the token of the daemon; the daemon replies with a line per environment as it
+finishes and a last line with the failed ones.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+from .download import Downloader
+from .mirrors import MIRRORS_FILE, PYTHON_MIRRORS, MirrorList
+from .profiling import Profiler
+from .releases import RELEASES_FILE, ReleaseIndex, is_exact
+
+if TYPE_CHECKING:
+    from . import EmbeddableEnvBuilder
+
+DEFAULT_DAEMON_ADDRESS: str = '127.0.0.1:7439'
+# a shared secret which clients must send; the daemon generates one unless it is set
+TOKEN_ENV: str = 'PENV_DAEMON_TOKEN'
+# the token files of the running daemons; in the profile of the user, which only they can read on Windows
+TOKEN_DIR: str = os.path.join(os.path.expanduser('~'), '.penv')
+# options relative to the working directory of the client
+PATH_OPTIONS = ('cache_dir', 'wheelhouse', 'requirements', 'profile_json', 'package_store', 'hash_index')
+# options which do not change how environments are built
+REQUEST_OPTIONS = ('dirs', 'jobs', 'profile_json', 'log_level', 'daemon')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    """Returns ('tcp', (host, port)) for HOST:PORT and ('unix', path) otherwise"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return 'tcp', (host or '127.0.0.1', int(port))
+    if sys.platform == 'win32':
+        raise ValueError(f'Expected HOST:PORT as the daemon address on Windows, not {address!r}')
+    return 'unix', address
+
+
+def token_path(address: str) -> str:
+    """Returns the file which the daemon at address keeps its token in"""
+    kind, target = parse_address(address)
+    if kind == 'tcp':
+        name = f'daemon-{target[0]}-{target[1]}'
+    else:
+        name = f"daemon-{hashlib.sha256(os.path.abspath(target).encode('utf-8')).hexdigest()[:16]}"
+    return os.path.join(TOKEN_DIR, f'{name}.token')
+
+
+def write_token(path: str, token: str) -> None:
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w') as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+
+
+def read_token(address: str) -> Optional[str]:
+    """Returns the token for the daemon at address from the environment or its token file"""
+    if os.environ.get(TOKEN_ENV):
+        return os.environ[TOKEN_ENV]
+    try:
+        with open(token_path(address), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _rebase(options: Any, cwd: str) -> None:
+    options.dirs = [os.path.join(cwd, d) for d in options.dirs]
+    for name in PATH_OPTIONS:
+        value = getattr(options, name)
+        if value:
+            setattr(options, name, os.path.join(cwd, value))
+
+
+def _builder_key(options: Any) -> str:
+    return json.dumps(
+        {name: value for name, value in vars(options).items() if name not in REQUEST_OPTIONS},
+        sort_keys=True,
+    )
+
+
+class Daemon:
+    """Serves creation requests with builders kept alive between them
+
+    A builder is kept per distinct set of build options, so its downloads,
+    connections and mirror ranking are reused by later requests. A partial
+    --python-version is resolved for every request against a release index
+    which expires like in a single run, and the builder of the release it
+    resolved to before is dropped once a newer one comes out. Environments
+    are created on a shared pool of jobs threads; the --jobs of a request
+    limits how many of its own run at once.
+
+    Requests must carry the token, which is generated unless it is given and
+    written to a file only the user can read (see token_path).
+    """
+
+    def __init__(self, jobs: Optional[int] = None, token: Optional[str] = None):
+        self.executor = ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1)
+        self.token = token or secrets.token_urlsafe(32)
+        self.token_path: Optional[str] = None
+        self.builders: Dict[str, 'EmbeddableEnvBuilder'] = {}
+        # the release indexes by python mirrors and cache directory
+        self.releases: Dict[str, ReleaseIndex] = {}
+        # the key of the builder which the build options of a request resolved to last
+        self.resolved: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _python_version(self, options: Any) -> str:
+        """Returns the release which the --python-version of a request resolves to now"""
+        if is_exact(options.python_version):
+            return options.python_version
+        key = json.dumps([options.python_mirrors, options.cache_dir])
+        if key not in self.releases:
+            mirrors_state = os.path.join(options.cache_dir, MIRRORS_FILE) if options.cache_dir else None
+            self.releases[key] = ReleaseIndex(
+                MirrorList(options.python_mirrors or PYTHON_MIRRORS, state_path=mirrors_state),
+                path=os.path.join(options.cache_dir, RELEASES_FILE) if options.cache_dir else None,
+                downloader=Downloader(connections=options.connections),
+            )
+        return self.releases[key].resolve(options.python_version, options.platform_arch)
+
+    def _builder(self, options: Any) -> 'EmbeddableEnvBuilder':
+        from . import _create_builder
+
+        with self._lock:
+            spec_key = _builder_key(options)
+            options.python_version = self._python_version(options)
+            key = _builder_key(options)
+            previous = self.resolved.get(spec_key)
+            self.resolved[spec_key] = key
+            if previous not in (None, key) and previous not in self.resolved.values():
+                # requests still creating with it keep their reference
+                logger.info(f"Dropping the builder for python {self.builders[previous].python_version}")
+                del self.builders[previous]
+            if key not in self.builders:
+                logger.info(f"New builder for python {options.python_version} {options.platform_arch}")
+                self.builders[key] = _create_builder(options)
+            return self.builders[key]
+
+    async def start(self, address: str) -> asyncio.Server:
+        kind, target = parse_address(address)
+        if kind == 'tcp':
+            server = await asyncio.start_server(self.handle, *target)
+            # the port which was picked for port 0
+            address = ':'.join(str(part) for part in server.sockets[0].getsockname()[:2])
+        else:
+            if os.path.exists(target):
+                # left behind by a daemon which was killed
+                os.remove(target)
+            server = await asyncio.start_unix_server(self.handle, path=target)
+        self.token_path = token_path(address)
+        write_token(self.token_path, self.token)
+        logger.info(f"penv daemon listening on {address} with its token in {self.token_path}")
+        return server
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        if self.token_path is not None and os.path.exists(self.token_path):
+            os.remove(self.token_path)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async def reply(message: Dict[str, Any]) -> None:
+            writer.write(json.dumps(message).encode() + b'\n')
+            await writer.drain()
+
+        try:
+            request = json.loads(await reader.readline())
+            if not hmac.compare_digest(str(request.get('token', '')), self.token):
+                raise ValueError('invalid token')
+            await self.serve_request(request, reply)
+        except Exception as e:
+            logger.error(f"Failed to serve a request: {e!r}")
+            await reply({'done': True, 'error': str(e) or type(e).__name__})
+        finally:
+            writer.close()
+
+    async def serve_request(self, request: Dict[str, Any], reply: Any) -> None:
+        from . import _check_options, _create_parser
+
+        names = set(vars(_create_parser().parse_args(['env'])))
+        if not isinstance(request.get('options'), dict) or set(request['options']) != names:
+            raise ValueError('invalid options')
+        options = argparse.Namespace(**request['options'])
+        _check_options(options)
+        for path in [*options.dirs, *(getattr(options, name) for name in PATH_OPTIONS)]:
+            if path and not os.path.isabs(path):
+                raise ValueError(f'expected an absolute path, not {path!r}')
+        loop = asyncio.get_running_loop()
+        # resolving a partial python version may have to ask the mirrors
+        builder = await loop.run_in_executor(self.executor, self._builder, options)
+        semaphore = asyncio.Semaphore(max(1, options.jobs))
+        failed: List[str] = []
+
+        async def create(env_dir: str) -> None:
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    await loop.run_in_executor(self.executor, builder.create, env_dir)
+                except Exception as e:
+                    failed.append(env_dir)
+                    logger.error(f"Failed to create {env_dir}: {e}")
+                    await reply({'env_dir': env_dir, 'ok': False, 'error': str(e), 'elapsed': time.monotonic() - started})
+                    return
+                logger.info(f"Created {env_dir}")
+                await reply({'env_dir': env_dir, 'ok': True, 'elapsed': time.monotonic() - started})
+
+        try:
+            await asyncio.gather(*(create(d) for d in options.dirs))
+        finally:
+            # the records are dropped either way so that the daemon does not grow
+            records = builder.profiler.pop(options.dirs)
+            if options.profile_json:
+                profiler = Profiler()
+                profiler.records.extend(records)
+                profiler.dump(options.profile_json)
+        await reply({'done': True, 'failed': [d for d in options.dirs if d in failed]})
+
+
+async def serve(address: str, jobs: Optional[int] = None, token: Optional[str] = None) -> None:
+    daemon = Daemon(jobs=jobs, token=token)
+    server = await daemon.start(address)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        daemon.close()
+
+
+def request(address: str, options: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Sends parsed penv options to the daemon at address and yields its replies"""
+    kind, target = parse_address(address)
+    if kind == 'tcp':
+        sock = socket.create_connection(target)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)  # type: ignore
+        sock.connect(target)
+    message: Dict[str, Any] = {'options': options}
+    token = read_token(address)
+    if token is not None:
+        message['token'] = token
+    with sock, sock.makefile('rwb') as stream:
+        stream.write(json.dumps(message).encode() + b'\n')
+        stream.flush()
+        for line in stream:
+            yield json.loads(line)
+
+
+def create_remote(address: str, options: Any) -> List[str]:
+    """Has the daemon at address create the environments of the parsed options and returns the failed ones"""
+    options = argparse.Namespace(**vars(options))
+    _rebase(options, os.getcwd())
+    for reply in request(address, vars(options)):
+        if reply.get('done'):
+            if 'error' in reply:
+                raise ValueError(f"penv daemon at {address}: {reply['error']}")
+            return reply['failed']
+        if reply['ok']:
+            logger.info(f"Created {reply['env_dir']} in {reply['elapsed']:.2f}s")
+        else:
+            logger.error(f"Failed to create {reply['env_dir']}: {reply['error']}")
+    raise ValueError(f'penv daemon at {address} closed the connection')
+
+
+def serve_main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='penv serve',
+        description=(
+            'Runs a daemon which creates environments for `penv --daemon ADDRESS ...` '
+            'and keeps its downloads and caches warm between requests.'
+        ),
+    )
+    parser.add_argument(
+        '--address',
+        default=DEFAULT_DAEMON_ADDRESS,
+        dest='address',
+        help='HOST:PORT or the path of a Unix socket to listen on',
+    )
+    parser.add_argument(
+        '--jobs',
+        default=None,
+        type=int,
+        dest='jobs',
+        help='The number of environments created concurrently (the number of CPUs by default)',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level))
+    try:
+        asyncio.run(serve(options.address, jobs=options.jobs, token=os.environ.get(TOKEN_ENV) or None))
+    except KeyboardInterrupt:
+        logger.info("penv daemon stopped")
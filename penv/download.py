@@ -0,0 +1,652 @@
+"""In-process HTTP downloader used to fetch embeddable pythons and get-pip.py."""
+import bisect
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Tuple, TypeVar
+from urllib.parse import urljoin, urlsplit
+from urllib.request import url2pathname
+
+DEFAULT_CONNECTIONS: int = 4
+DEFAULT_SEGMENT_SIZE: int = 4 * 1024 * 1024
+DEFAULT_CHUNK_SIZE: int = 64 * 1024
+DEFAULT_TIMEOUT: float = 30.0
+MAX_REDIRECTS: int = 5
+# reads of a RangeFile outside the prefetched spans fetch at least this many bytes
+MIN_RANGE_READ: int = 64 * 1024
+PART_SUFFIX: str = '.part'
+STATE_SUFFIX: str = '.part.json'
+
+logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def file_url_path(url: str) -> str:
+    """Returns the local path of a file:// URL (including UNC paths)"""
+    parts = urlsplit(url)
+    path = parts.path
+    if parts.netloc and parts.netloc != 'localhost':
+        path = f'//{parts.netloc}{path}'
+    return url2pathname(path)
+
+
+class DownloadProgress(NamedTuple):
+    url: str
+    downloaded: int
+    total: Optional[int]
+    elapsed: float
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second since the download started"""
+        return self.downloaded / self.elapsed if self.elapsed > 0 else 0.0
+
+
+ProgressCallback = Callable[[DownloadProgress], None]
+
+
+class _StreamHasher:
+    """Feed a hashlib object with the bytes of a file while it is being downloaded.
+
+    Bytes arriving at the current hash position are hashed as they stream in.
+    Segments which are finished ahead of that position are read back from the
+    (still hot) part file once the position reaches them.
+    """
+
+    def __init__(self, hasher: Any, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.hasher = hasher
+        self.path = path
+        self.chunk_size = chunk_size
+        self.position = 0
+        self._completed: List[Tuple[int, int]] = []
+        self._lock = threading.Lock()
+
+    def feed(self, offset: int, data: bytes) -> None:
+        with self._lock:
+            # a transfer restarted on another mirror overlaps the bytes hashed already
+            if offset <= self.position < offset + len(data):
+                self.hasher.update(data[self.position - offset:])
+                self.position = offset + len(data)
+                self._drain()
+
+    def discard(self) -> None:
+        """Forget the finished segments which have not been hashed, e.g. when the part file is restarted"""
+        with self._lock:
+            self._completed = []
+
+    def complete(self, begin: int, end: int) -> None:
+        """Mark the bytes [begin, end] as written to the part file"""
+        with self._lock:
+            self._completed.append((begin, end))
+            self._drain()
+
+    def _drain(self) -> None:
+        progressed = True
+        while progressed:
+            progressed = False
+            for begin, end in self._completed:
+                if begin <= self.position <= end:
+                    with open(self.path, 'rb') as f:
+                        f.seek(self.position)
+                        remaining = end - self.position + 1
+                        while remaining > 0:
+                            chunk = f.read(min(self.chunk_size, remaining))
+                            if not chunk:
+                                raise DownloadError(f'Short read while hashing {self.path}')
+                            self.hasher.update(chunk)
+                            remaining -= len(chunk)
+                    self.position = end + 1
+                    progressed = True
+            self._completed = [(b, e) for b, e in self._completed if e >= self.position]
+
+
+class _ConnectionPool:
+    """Keep-alive connections shared by the worker threads of a Downloader"""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._idle: Dict[Tuple[str, str], 'queue.LifoQueue[http.client.HTTPConnection]'] = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, scheme: str, netloc: str) -> 'queue.LifoQueue[http.client.HTTPConnection]':
+        with self._lock:
+            return self._idle.setdefault((scheme, netloc), queue.LifoQueue())
+
+    def acquire(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        try:
+            return self._queue(scheme, netloc).get_nowait()
+        except queue.Empty:
+            return self.connect(scheme, netloc)
+
+    def connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise DownloadError(f'Unsupported URL scheme: {scheme}')
+
+    def release(self, scheme: str, netloc: str, conn: http.client.HTTPConnection) -> None:
+        self._queue(scheme, netloc).put(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            queues = list(self._idle.values())
+            self._idle.clear()
+        for q in queues:
+            while not q.empty():
+                q.get_nowait().close()
+
+
+class Downloader:
+    """Fetch a URL into a local file.
+
+    Large files served with ``Accept-Ranges: bytes`` are split into segments
+    which are fetched concurrently over keep-alive connections. The data is
+    written into ``<dest>.part`` and the finished segments are recorded in
+    ``<dest>.part.json`` so that an interrupted download can be resumed.
+    Other files are streamed, and resumed from the end of the part file if
+    its state shows that it holds the beginning of the same file.
+    """
+
+    def __init__(
+        self,
+        connections: int = DEFAULT_CONNECTIONS,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        timeout: float = DEFAULT_TIMEOUT,
+        progress: Optional[ProgressCallback] = None,
+    ):
+        assert connections >= 1, "connections must be positive"
+        assert segment_size >= 1, "segment_size must be positive"
+        self.connections = connections
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.progress = progress
+        self._pool = _ConnectionPool(timeout=timeout)
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def __enter__(self) -> 'Downloader':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[str, http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Send a request following redirects.
+
+        Returns the final url, the connection and the response.
+        The caller must read the response and release the connection.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn = self._pool.acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # a stale keep-alive connection; retry once on a fresh one
+                conn.close()
+                conn = self._pool.connect(parts.scheme, parts.netloc)
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                self._finish(url, conn, response)
+                if not location:
+                    raise DownloadError(f'Redirect without Location: {url}')
+                url = urljoin(url, location)
+                continue
+            return url, conn, response
+        raise DownloadError(f'Too many redirects: {url}')
+
+    def _finish(self, url: str, conn: http.client.HTTPConnection, response: http.client.HTTPResponse) -> None:
+        parts = urlsplit(url)
+        if response.will_close:
+            conn.close()
+        else:
+            self._pool.release(parts.scheme, parts.netloc, conn)
+
+    def _probe(self, url: str) -> Tuple[str, Optional[int], bool, Optional[str]]:
+        """Returns the final url, the size, whether ranges are supported and the ETag"""
+        url, conn, response = self._request('HEAD', url)
+        response.read()
+        self._finish(url, conn, response)
+        if response.status >= 400:
+            raise DownloadError(f'HTTP {response.status} for {url}')
+        length = response.getheader('Content-Length')
+        size = int(length) if length is not None else None
+        ranges = response.getheader('Accept-Ranges', '').lower() == 'bytes'
+        return url, size, ranges, response.getheader('ETag')
+
+    def fetch_range(self, url: str, begin: int, end: int) -> bytes:
+        """Returns the bytes [begin, end] of url fetched with a range request"""
+        url, conn, response = self._request('GET', url, headers={'Range': f'bytes={begin}-{end}'})
+        try:
+            if response.status != 206:
+                raise DownloadError(f'Range request refused ({response.status}) for {url}')
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+        self._finish(url, conn, response)
+        if len(data) != end - begin + 1:
+            raise DownloadError(f'Got {len(data)} bytes instead of {end - begin + 1} from {url}')
+        return data
+
+    def fetch(self, url: str, dest: str, hasher: Optional[Any] = None, mirrors: Sequence[str] = ()) -> int:
+        """Download url to dest and return the number of bytes in dest
+
+        If a hashlib object is given as hasher, it is updated with the contents
+        of dest while the download is streaming in.
+        mirrors are URLs of the same file: when the transfer from url fails or
+        stalls for longer than the timeout, it is resumed from them in turn.
+        url and mirrors may be file:// URLs.
+        """
+        start = time.monotonic()
+        done = [0]
+        lock = threading.Lock()
+        part_path = dest + PART_SUFFIX
+        stream_hasher = _StreamHasher(hasher, part_path, self.chunk_size) if hasher is not None else None
+        candidates = [url, *mirrors]
+
+        def advance(offset: int, data: bytes, total: Optional[int]) -> None:
+            if stream_hasher is not None:
+                stream_hasher.feed(offset, data)
+            with lock:
+                done[0] += len(data)
+                progress = DownloadProgress(url, done[0], total, time.monotonic() - start)
+            if self.progress is not None:
+                self.progress(progress)
+
+        def resumed(begin: int, end: int, total: Optional[int]) -> None:
+            if stream_hasher is not None:
+                stream_hasher.complete(begin, end)
+            with lock:
+                done[0] += end - begin + 1
+
+        # the size reported first; a mirror with another size serves another file
+        expected_size: Optional[int] = None
+        for i, url in enumerate(candidates):
+            done[0] = 0
+            # the finished segments are reported again by the transfer which resumes them
+            if stream_hasher is not None:
+                stream_hasher.discard()
+            try:
+                if urlsplit(url).scheme == 'file':
+                    self._fetch_file(url, part_path, advance, expected_size)
+                    break
+                url, size, ranges, etag = self._probe(url)
+                if expected_size is not None and size is not None and size != expected_size:
+                    raise DownloadError(f'{url} has {size} bytes instead of {expected_size}')
+                expected_size = expected_size if size is None else size
+                if size is not None and ranges and size > self.segment_size and self.connections > 1:
+                    self._fetch_segmented(url, part_path, size, etag, advance, resumed, stream_hasher)
+                else:
+                    self._fetch_stream(url, part_path, size, ranges, etag, advance, resumed)
+                break
+            except (DownloadError, http.client.HTTPException, OSError) as e:
+                if i == len(candidates) - 1:
+                    raise
+                logger.warning(f"Download from {url} failed ({e!r}); switching to {candidates[i + 1]}")
+        os.replace(part_path, dest)
+        elapsed = time.monotonic() - start
+        written = os.path.getsize(dest)
+        logger.info(
+            f"Downloaded {url} ({written} bytes in {elapsed:.2f}s, "
+            f"{written / elapsed if elapsed > 0 else 0:.0f} bytes/sec)"
+        )
+        return written
+
+    @staticmethod
+    def _saved_state(part_path: str, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Returns the saved state of part_path if it was left by a transfer of the same file in the same mode"""
+        state_path = part_path[:-len(PART_SUFFIX)] + STATE_SUFFIX
+        if not (os.path.exists(part_path) and os.path.exists(state_path)):
+            return None
+        try:
+            with open(state_path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # another mirror serves the same file with its own ETag
+        keys = [k for k in state if k not in ('url', 'done') and (k != 'etag' or saved.get('url') == state['url'])]
+        if isinstance(saved, dict) and all(saved.get(k) == state[k] for k in keys):
+            return saved
+        return None
+
+    def _fetch_file(
+        self,
+        url: str,
+        part_path: str,
+        advance: Callable[[int, bytes, Optional[int]], None],
+        expected_size: Optional[int] = None,
+    ) -> None:
+        path = file_url_path(url)
+        if not os.path.isfile(path):
+            raise DownloadError(f'File not found: {url}')
+        size = os.path.getsize(path)
+        if expected_size is not None and size != expected_size:
+            raise DownloadError(f'{url} has {size} bytes instead of {expected_size}')
+        offset = 0
+        state_path = part_path[:-len(PART_SUFFIX)] + STATE_SUFFIX
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        with open(path, 'rb') as src, open(part_path, 'wb') as f:
+            for chunk in iter(lambda: src.read(self.chunk_size), b''):
+                f.write(chunk)
+                advance(offset, chunk, size)
+                offset += len(chunk)
+
+    def _fetch_stream(
+        self,
+        url: str,
+        part_path: str,
+        size: Optional[int],
+        ranges: bool,
+        etag: Optional[str],
+        advance: Callable[[int, bytes, Optional[int]], None],
+        resumed: Callable[[int, int, Optional[int]], None],
+    ) -> None:
+        state_path = part_path[:-len(PART_SUFFIX)] + STATE_SUFFIX
+        state: Dict[str, Any] = {'mode': 'stream', 'url': url, 'size': size, 'etag': etag}
+        offset = 0
+        # only a part left by a transfer of the same file is resumed
+        if ranges and size is not None and self._saved_state(part_path, state) is not None:
+            offset = os.path.getsize(part_path)
+            if offset > size:
+                offset = 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        url, conn, response = self._request('GET', url, headers=headers)
+        try:
+            if response.status >= 400:
+                raise DownloadError(f'HTTP {response.status} for {url}')
+            if response.status != 206:
+                offset = 0
+            if offset:
+                logger.debug(f"Resuming {url} from byte {offset}")
+                resumed(0, offset - 1, size)
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                # a server without ranges leaves a part which another mirror can resume
+                if size is not None:
+                    with open(state_path, 'w') as state_file:
+                        json.dump(state, state_file)
+                elif os.path.exists(state_path):
+                    os.remove(state_path)
+                while True:
+                    # what has arrived so far, so that a stalled transfer keeps its bytes
+                    chunk = response.read1(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    advance(offset, chunk, size)
+                    offset += len(chunk)
+        except BaseException:
+            conn.close()
+            raise
+        self._finish(url, conn, response)
+        if size is not None and os.path.getsize(part_path) != size:
+            raise DownloadError(f'Incomplete download of {url}')
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def _fetch_segmented(
+        self,
+        url: str,
+        part_path: str,
+        size: int,
+        etag: Optional[str],
+        advance: Callable[[int, bytes, Optional[int]], None],
+        resumed: Callable[[int, int, Optional[int]], None],
+        stream_hasher: Optional[_StreamHasher] = None,
+    ) -> None:
+        state_path = part_path[:-len(PART_SUFFIX)] + STATE_SUFFIX
+        segments: List[Tuple[int, int]] = [
+            (begin, min(begin + self.segment_size, size) - 1)
+            for begin in range(0, size, self.segment_size)
+        ]
+        done: List[int] = []
+        state: Dict[str, Any] = {
+            'mode': 'segmented', 'url': url, 'size': size, 'etag': etag, 'segment_size': self.segment_size,
+            'done': done,
+        }
+        saved = self._saved_state(part_path, state)
+        if saved is not None:
+            try:
+                done.extend(int(i) for i in saved['done'] if 0 <= int(i) < len(segments))
+                logger.debug(f"Resuming {url} with {len(done)} finished segments")
+            except (ValueError, KeyError, TypeError):
+                pass
+        if not done:
+            with open(part_path, 'wb') as part:
+                part.truncate(size)
+        state_lock = threading.Lock()
+        done_segments = set(done)
+        for i in sorted(done_segments):
+            begin, end = segments[i]
+            resumed(begin, end, size)
+
+        def save_state() -> None:
+            with open(state_path, 'w') as f:
+                json.dump(state, f)
+
+        def fetch_segment(index: int) -> None:
+            begin, end = segments[index]
+            headers = {'Range': f'bytes={begin}-{end}'}
+            seg_url, conn, response = self._request('GET', url, headers=headers)
+            try:
+                if response.status != 206:
+                    raise DownloadError(f'Range request refused ({response.status}) for {url}')
+                with open(part_path, 'r+b') as f:
+                    f.seek(begin)
+                    offset = begin
+                    while offset <= end:
+                        chunk = response.read(min(self.chunk_size, end - offset + 1))
+                        if not chunk:
+                            raise DownloadError(f'Connection closed early while fetching {url}')
+                        f.write(chunk)
+                        advance(offset, chunk, size)
+                        offset += len(chunk)
+            except BaseException:
+                conn.close()
+                raise
+            self._finish(seg_url, conn, response)
+            if stream_hasher is not None:
+                stream_hasher.complete(begin, end)
+            with state_lock:
+                done.append(index)
+                save_state()
+
+        save_state()
+        pending = [i for i in range(len(segments)) if i not in done_segments]
+        with ThreadPoolExecutor(max_workers=min(self.connections, len(pending) or 1)) as executor:
+            futures = [executor.submit(fetch_segment, i) for i in pending]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # do not wait for the segments which have not started
+                for future in futures:
+                    future.cancel()
+                raise
+        os.remove(state_path)
+
+
+class RangeFile(io.RawIOBase):
+    """Seekable read-only file whose bytes are fetched from url with range requests
+
+    Reads are served from the spans fetched by prefetch (concurrently, on
+    the connections of the downloader); the bytes of other reads are
+    fetched when they are read. This is how only the central directory and
+    the wanted members of a remote zip are transferred.
+    Raises DownloadError if the server does not support range requests.
+    """
+
+    def __init__(self, url: str, downloader: Downloader):
+        super().__init__()
+        self.downloader = downloader
+        self.url, size, ranges, _ = downloader._probe(url)
+        if size is None or not ranges:
+            raise DownloadError(f'{self.url} does not support range requests')
+        self.size = size
+        # bytes transferred so far
+        self.transferred = 0
+        self._position = 0
+        # non-overlapping (begin, data) spans sorted by begin
+        self._spans: List[Tuple[int, bytes]] = []
+        self._lock = threading.Lock()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, b) -> int:  # type: ignore
+        n = max(0, min(len(b), self.size - self._position))
+        data = self._read(self._position, n)
+        b[:n] = data
+        self._position += n
+        return n
+
+    def _add(self, begin: int, data: bytes) -> None:
+        with self._lock:
+            bisect.insort(self._spans, (begin, data))
+            self.transferred += len(data)
+
+    def _missing(self, begin: int, end: int) -> List[Tuple[int, int]]:
+        """Returns the parts of [begin, end] which no span holds"""
+        gaps: List[Tuple[int, int]] = []
+        position = begin
+        with self._lock:
+            spans = list(self._spans)
+        for span_begin, data in spans:
+            span_end = span_begin + len(data) - 1
+            if span_end < position:
+                continue
+            if span_begin > end:
+                break
+            if span_begin > position:
+                gaps.append((position, span_begin - 1))
+            position = max(position, span_end + 1)
+        if position <= end:
+            gaps.append((position, end))
+        return gaps
+
+    def _read(self, begin: int, n: int) -> bytes:
+        if n <= 0:
+            return b''
+        end = begin + n - 1
+        for gap_begin, gap_end in self._missing(begin, end):
+            if gap_end == end:
+                # read ahead, e.g. for the small reads of a zip's headers
+                following = self._missing(gap_begin, min(self.size, gap_begin + MIN_RANGE_READ) - 1)
+                gap_end = max(gap_end, following[0][1]) if following else gap_end
+            self._add(gap_begin, self.downloader.fetch_range(self.url, gap_begin, gap_end))
+        buffer = bytearray(n)
+        with self._lock:
+            spans = list(self._spans)
+        for span_begin, data in spans:
+            span_end = span_begin + len(data) - 1
+            if span_end < begin or span_begin > end:
+                continue
+            lo, hi = max(begin, span_begin), min(end, span_end)
+            buffer[lo - begin:hi - begin + 1] = data[lo - span_begin:hi - span_begin + 1]
+        return bytes(buffer)
+
+    def prefetch(self, spans: Iterable[Tuple[int, int]]) -> None:
+        """Fetch the byte ranges [begin, end] of spans which are not held yet"""
+        merged: List[List[int]] = []
+        for begin, end in sorted(spans):
+            if merged and begin <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
+        parts = [
+            (begin, min(begin + self.downloader.segment_size, gap_end + 1) - 1)
+            for span_begin, span_end in merged
+            for gap_begin, gap_end in self._missing(span_begin, span_end)
+            for begin in range(gap_begin, gap_end + 1, self.downloader.segment_size)
+        ]
+        if not parts:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.downloader.connections, len(parts))) as executor:
+            for (begin, _), data in zip(parts, executor.map(lambda p: self.downloader.fetch_range(self.url, *p), parts)):
+                self._add(begin, data)
+        logger.debug(f"Prefetched {sum(e - b + 1 for b, e in parts)} bytes of {self.url} in {len(parts)} ranges")
+
+
+def download(
+    url: str,
+    dest: str,
+    downloader: Optional[Downloader] = None,
+    hasher: Optional[Any] = None,
+    mirrors: Sequence[str] = (),
+) -> int:
+    """Download url (or failing that, mirrors) to dest with a Downloader (a new one if not given)"""
+    if downloader is not None:
+        return downloader.fetch(url, dest, hasher=hasher, mirrors=mirrors)
+    with Downloader() as d:
+        return d.fetch(url, dest, hasher=hasher, mirrors=mirrors)
+
+
+class SingleFlight:
+    """Run a function once per key among concurrent callers
+
+    Callers arriving while the function for their key is running wait for it
+    and share its result (or exception) instead of running it again.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if future is None:
+                future = self._calls[key] = Future()
+        if leader:
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        else:
+            logger.debug(f"Waiting for the in-flight {key}")
+        return future.result()
@@ -0,0 +1,148 @@
+"""Pinned SHA-256 hashes which downloads are checked against before they are used."""
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Optional
+from .download import download
+from .manifest import hash_file
+
+HASH_INDEX_VERSION: int = 1
+
+logger = logging.getLogger(__name__)
+
+
+class HashMismatch(ValueError):
+    pass
+
+
+class HashIndex:
+    """The SHA-256 of downloads by file name, e.g. python-3.12.1-embed-amd64.zip or get-pip.py
+
+    The index is a JSON file like
+    ``{"version": 1, "files": {"get-pip.py": "<sha256>", ...}}`` which can be
+    shipped with the environments and refreshed from a trusted URL.
+    """
+
+    def __init__(self, files: Optional[Dict[str, str]] = None, path: Optional[str] = None):
+        self.files: Dict[str, str] = {name: sha256.lower() for name, sha256 in (files or {}).items()}
+        self.path = path
+        # the modification time of path when the index was loaded from it
+        self.mtime: Optional[int] = None
+
+    @classmethod
+    def parse(cls, data: str, path: Optional[str] = None) -> 'HashIndex':
+        index = json.loads(data)
+        if not isinstance(index, dict) or index.get('version') != HASH_INDEX_VERSION:
+            raise ValueError(f'{path or "The hash index"} is not a version {HASH_INDEX_VERSION} hash index')
+        return cls(index.get('files', {}), path=path)
+
+    @classmethod
+    def load(cls, path: str) -> 'HashIndex':
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as f:
+            index = cls.parse(f.read(), path=path)
+        index.mtime = mtime
+        return index
+
+    def reload(self) -> bool:
+        """Read the index from its file again if the file changed since it was loaded, and returns whether it did"""
+        assert self.path is not None, "the hash index has no path"
+        if os.stat(self.path).st_mtime_ns == self.mtime:
+            return False
+        index = self.load(self.path)
+        self.files, self.mtime = index.files, index.mtime
+        logger.info(f"Reloaded the hash index {self.path}")
+        return True
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path or self.path
+        assert path is not None, "the hash index has no path"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': HASH_INDEX_VERSION, 'files': self.files}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def expected(self, name: str) -> str:
+        """Returns the pinned SHA-256 of name; an unpinned download is refused"""
+        sha256 = self.files.get(name)
+        if sha256 is None:
+            raise HashMismatch(
+                f'{name} is not pinned in the hash index {self.path or ""}; '
+                f'add it with `penv hashes add` once it has been audited'
+            )
+        return sha256
+
+    def check(self, name: str, sha256: str) -> None:
+        """Raises HashMismatch unless sha256 is the pinned SHA-256 of name"""
+        expected = self.expected(name)
+        if sha256.lower() != expected:
+            raise HashMismatch(f'{name} has the SHA-256 {sha256} instead of the pinned {expected}')
+
+    def update(self, other: 'HashIndex') -> int:
+        """Add the hashes of other, which replace pins of the same names, and returns how many changed"""
+        changed = 0
+        for name, sha256 in other.files.items():
+            if self.files.get(name) != sha256:
+                if name in self.files:
+                    logger.warning(f"The pinned SHA-256 of {name} changed from {self.files[name]} to {sha256}")
+                self.files[name] = sha256
+                changed += 1
+        return changed
+
+
+def hashes_main(args=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='penv hashes',
+        description='Maintains the hash index which --hash-index checks downloads against.',
+    )
+    parser.add_argument(
+        'command',
+        choices=['list', 'add', 'refresh'],
+        help=(
+            'list the pinned hashes, add the hashes of audited files, '
+            'or refresh the index from the hash index at a URL.'
+        ),
+    )
+    parser.add_argument(
+        'sources',
+        metavar='SOURCE',
+        nargs='*',
+        help='The files to add, or the URL to refresh from.',
+    )
+    parser.add_argument(
+        '--hash-index',
+        required=True,
+        dest='hash_index',
+        help='The hash index file',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level))
+    index = HashIndex.load(options.hash_index) if os.path.exists(options.hash_index) else HashIndex()
+    if options.command == 'list':
+        for name, sha256 in sorted(index.files.items()):
+            print(f'{name}\t{sha256}')
+        return
+    if options.command == 'add':
+        for path in options.sources:
+            index.files[os.path.basename(path)] = hash_file(path)
+    elif options.command == 'refresh':
+        if len(options.sources) != 1:
+            raise ValueError('refresh takes the URL of a hash index')
+        with tempfile.TemporaryDirectory(prefix='penv-') as tmp_dir:
+            path = os.path.join(tmp_dir, 'hashes.json')
+            download(options.sources[0], path)
+            with open(path, 'r') as f:
+                changed = index.update(HashIndex.parse(f.read(), path=options.sources[0]))
+        logger.info(f"Refreshed {changed} hashes from {options.sources[0]}")
+    index.save(options.hash_index)
@@ -0,0 +1,125 @@
+"""Cross-process file locks guarding the shared cache directory."""
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+LOCKS_DIR: str = 'locks'
+POLL_INTERVAL: float = 0.05
+
+logger = logging.getLogger(__name__)
+_shared_locks: Dict[str, 'FileLock'] = {}
+_shared_locks_lock = threading.Lock()
+
+if sys.platform == 'win32':
+    import msvcrt
+
+    def _try_lock(fd: int) -> bool:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock(fd: int) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _unlock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock:
+    """Exclusive lock on path, held against other processes and threads
+
+    The lock is re-entrant within the thread holding it. The operating system
+    drops it when the holding process dies, so a killed build never leaves
+    the cache locked. Lock files are never removed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd: Optional[int] = None
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait up to timeout seconds (forever if None) for the lock and returns whether it was acquired"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        if self._depth:
+            self._depth += 1
+            return True
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            waiting = False
+            while not _try_lock(fd):
+                if deadline is not None and time.monotonic() >= deadline:
+                    os.close(fd)
+                    self._lock.release()
+                    return False
+                if not waiting:
+                    logger.info(f"Waiting for another process holding {self.path}")
+                    waiting = True
+                time.sleep(POLL_INTERVAL)
+        except BaseException:
+            self._lock.release()
+            raise
+        self._fd = fd
+        self._depth = 1
+        return True
+
+    def release(self) -> None:
+        assert self._depth > 0, "release of an unlocked FileLock"
+        self._depth -= 1
+        if not self._depth and self._fd is not None:
+            try:
+                _unlock(self._fd)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        self._lock.release()
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def shared_lock(path: str) -> FileLock:
+    """Returns the FileLock of path shared by this process, so that nested callers re-enter it"""
+    path = os.path.abspath(path)
+    with _shared_locks_lock:
+        lock = _shared_locks.get(path)
+        if lock is None:
+            lock = _shared_locks[path] = FileLock(path)
+        return lock
+
+
+def is_free(path: str) -> bool:
+    """Returns whether no process or thread (including this one) holds the lock on path"""
+    if not os.path.exists(path):
+        return True
+    lock = shared_lock(path)
+    if not lock.acquire(timeout=0):
+        return False
+    # re-entered by this thread
+    free = lock._depth == 1
+    lock.release()
+    return free
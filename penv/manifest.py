@@ -0,0 +1,222 @@
+"""Manifest of the files of an environment recorded when it is created."""
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional
+from .template import replace_file
+
+MANIFEST_FILE: str = 'penv-manifest.json'
+MANIFEST_VERSION: int = 1
+HASH_BUFFER_SIZE: int = 256 * 1024
+DEFAULT_HASH_WORKERS: int = min(32, (os.cpu_count() or 1) + 4)
+# written by the interpreter when modules are first imported
+RUNTIME_DIR: str = '__pycache__'
+
+logger = logging.getLogger(__name__)
+
+
+def load_manifest(env_dir: str) -> Optional[Dict[str, Any]]:
+    """Returns the manifest of env_dir or None if it has none (or an unreadable one)"""
+    path = os.path.join(env_dir, MANIFEST_FILE)
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logger.warning(f"Ignoring corrupted manifest {path}")
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.warning(f"Ignoring manifest with unknown version {manifest.get('version')}")
+        return None
+    return manifest
+
+
+def save_manifest(env_dir: str, manifest: Dict[str, Any]) -> None:
+    """Write the manifest of env_dir
+
+    The manifest is replaced rather than rewritten, so a manifest hardlinked
+    from elsewhere is left untouched, even when it is read-only.
+    """
+    path = os.path.join(env_dir, MANIFEST_FILE)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({**manifest, 'version': MANIFEST_VERSION}, f, indent=2, sort_keys=True)
+    replace_file(tmp_path, path)
+
+
+class VerifyResult(NamedTuple):
+    env_dir: str
+    missing: List[str]
+    modified: List[str]
+    extra: List[str]
+    checked: int
+    hashed: int
+
+    @property
+    def ok(self) -> bool:
+        return not (self.missing or self.modified or self.extra)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {**self._asdict(), 'ok': self.ok}
+
+
+def _scan(root: str) -> Dict[str, os.stat_result]:
+    """Returns the stat of every file under root by its '/' separated relative path"""
+    found: Dict[str, os.stat_result] = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                rel = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel)
+                elif rel != MANIFEST_FILE and not rel.startswith(f'{MANIFEST_FILE}.'):
+                    # DirEntry.stat() is served from the directory listing on Windows
+                    found[rel] = entry.stat(follow_symlinks=False)
+    return found
+
+
+def hash_file(path: str, buffer_size: int = HASH_BUFFER_SIZE) -> str:
+    """Returns the SHA-256 of the file at path read through one buffer of buffer_size bytes"""
+    h = hashlib.sha256()
+    buffer = memoryview(bytearray(buffer_size))
+    with open(path, 'rb', buffering=0) as f:
+        for n in iter(lambda: f.readinto(buffer), 0):
+            h.update(buffer[:n])
+    return h.hexdigest()
+
+
+def stat_matches(record: Dict[str, Any], st: os.stat_result) -> bool:
+    """Whether a file with st still has the size and modification time of its record, so its hash can be trusted"""
+    return record.get('size') == st.st_size and record.get('mtime_ns') == st.st_mtime_ns
+
+
+def _hash_files(root: str, rels: List[str], max_workers: int) -> Dict[str, Optional[str]]:
+    def digest(rel: str) -> Optional[str]:
+        try:
+            return hash_file(os.path.join(root, *rel.split('/')))
+        except FileNotFoundError:
+            return None
+
+    if not rels:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(rels)))) as executor:
+        return dict(zip(rels, executor.map(digest, rels)))
+
+
+def index_files(
+    env_dir: str,
+    previous: Optional[Dict[str, Dict[str, Any]]] = None,
+    max_workers: int = DEFAULT_HASH_WORKERS,
+) -> Dict[str, Dict[str, Any]]:
+    """Returns the size, modification time and SHA-256 of every file in env_dir
+
+    Records of previous whose size and modification time still match are
+    reused, so only new or rewritten files are hashed.
+    """
+    previous = previous or {}
+    stats = _scan(env_dir)
+    files: Dict[str, Dict[str, Any]] = {}
+    suspects: List[str] = []
+    for rel, st in stats.items():
+        record = previous.get(rel)
+        if record is not None and stat_matches(record, st):
+            files[rel] = record
+        else:
+            suspects.append(rel)
+    for rel, sha256 in _hash_files(env_dir, suspects, max_workers).items():
+        if sha256 is not None:
+            st = stats[rel]
+            files[rel] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}
+    logger.debug(f"Indexed {len(files)} files in {env_dir} ({len(suspects)} hashed)")
+    return files
+
+
+def record_files(
+    env_dir: str,
+    max_workers: int = DEFAULT_HASH_WORKERS,
+    extra: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Add the index of the files of env_dir (and the fields of extra) to its manifest and returns the manifest"""
+    manifest = load_manifest(env_dir) or {}
+    manifest.update(extra or {})
+    manifest['files'] = index_files(env_dir, manifest.get('files'), max_workers)
+    save_manifest(env_dir, manifest)
+    return manifest
+
+
+def verify_env(env_dir: str, max_workers: int = DEFAULT_HASH_WORKERS) -> VerifyResult:
+    """Compare the files of env_dir against its manifest
+
+    Files whose size and modification time match the manifest are trusted;
+    the others are hashed on a thread pool. Files in __pycache__ directories
+    which are not in the manifest are written by the interpreter at run time
+    and are not reported as extra.
+    """
+    manifest = load_manifest(env_dir)
+    if manifest is None or 'files' not in manifest:
+        raise ValueError(f'{env_dir} has no file index in {MANIFEST_FILE}')
+    files: Dict[str, Dict[str, Any]] = manifest['files']
+    stats = _scan(env_dir)
+    missing = sorted(rel for rel in files if rel not in stats)
+    extra = sorted(
+        rel for rel in stats
+        if rel not in files and RUNTIME_DIR not in rel.split('/')[:-1]
+    )
+    suspects = [rel for rel, st in stats.items() if rel in files and not stat_matches(files[rel], st)]
+    modified: List[str] = []
+    for rel, sha256 in _hash_files(env_dir, suspects, max_workers).items():
+        if sha256 is None:
+            missing.append(rel)
+        elif sha256 != files[rel]['sha256']:
+            modified.append(rel)
+    return VerifyResult(
+        env_dir=env_dir,
+        missing=sorted(missing),
+        modified=sorted(modified),
+        extra=extra,
+        checked=len(files),
+        hashed=len(suspects),
+    )
+
+
+def verify_main(args=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='penv verify',
+        description='Checks environments against the manifest recorded when they were created.',
+    )
+    parser.add_argument(
+        'env_dirs',
+        metavar='ENV_DIR',
+        nargs='+',
+        help='The environment directories to verify.',
+    )
+    parser.add_argument(
+        '--jobs',
+        default=DEFAULT_HASH_WORKERS,
+        type=int,
+        dest='jobs',
+        help='The number of files hashed concurrently',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='WARNING',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level))
+    results = [verify_env(env_dir, max_workers=options.jobs) for env_dir in options.env_dirs]
+    # one JSON report per line
+    for result in results:
+        print(json.dumps(result.as_dict(), sort_keys=True))
+    failed = [result.env_dir for result in results if not result.ok]
+    if failed:
+        raise ValueError(f'{len(failed)} of {len(results)} environments do not match their manifest: {", ".join(failed)}')
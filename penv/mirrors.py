@@ -0,0 +1,155 @@
+"""Mirrors of the python.org and bootstrap.pypa.io downloads, ranked by response time."""
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+from .download import file_url_path
+
+PYTHON_MIRRORS = ('https://www.python.org/ftp/python',)
+GET_PIP_MIRRORS = ('https://bootstrap.pypa.io',)
+MIRRORS_FILE: str = 'mirrors.json'
+# seconds for which a ranking of the mirrors is reused
+DEFAULT_MIRROR_TTL: float = 3600
+DEFAULT_PROBE_TIMEOUT: float = 5
+
+logger = logging.getLogger(__name__)
+# serializes the read-modify-write cycles of the mirrors file among threads
+_state_lock = threading.Lock()
+
+
+def mirror_url(mirror: str, path: str) -> str:
+    return f"{mirror.rstrip('/')}/{path.lstrip('/')}"
+
+
+def head_status(url: str, timeout: float = DEFAULT_PROBE_TIMEOUT) -> Optional[int]:
+    """Returns the status of a HEAD request for url, or None if no response was received"""
+    parts = urlsplit(url)
+    if parts.scheme == 'file':
+        return 200 if os.path.isfile(file_url_path(url)) else 404
+    if parts.scheme not in ('http', 'https'):
+        return None
+    conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = conn_class(parts.netloc, timeout=timeout)
+    try:
+        conn.request('HEAD', parts.path or '/', headers={'User-Agent': 'penv'})
+        response = conn.getresponse()
+        response.read()
+    except (http.client.HTTPException, OSError) as e:
+        logger.debug(f"HEAD request for {url} failed: {e!r}")
+        return None
+    finally:
+        conn.close()
+    return response.status
+
+
+def probe(url: str, timeout: float = DEFAULT_PROBE_TIMEOUT) -> Optional[float]:
+    """Returns the seconds url took to answer a HEAD request, or None if it failed"""
+    started = time.monotonic()
+    status = head_status(url, timeout)
+    if status is None or status >= 400:
+        logger.debug(f"Probe of {url} failed: {status}")
+        return None
+    return time.monotonic() - started
+
+
+class MirrorList:
+    """Orders mirrors serving the same files by how fast they respond
+
+    The mirrors are probed concurrently with a HEAD request for the file
+    asked for, and the latencies are reused for ttl seconds, in memory and in
+    state_path if given. A failed probe is remembered for the file it asked
+    for only, as a mirror may just lack that file (e.g. one version); the
+    mirror is ranked last for that file, so it remains a last resort for
+    failing over, and keeps its latency for the others. A single mirror is
+    never probed.
+    """
+
+    def __init__(
+        self,
+        mirrors: Sequence[str],
+        state_path: Optional[str] = None,
+        ttl: float = DEFAULT_MIRROR_TTL,
+        timeout: float = DEFAULT_PROBE_TIMEOUT,
+    ):
+        assert mirrors, "at least one mirror is required"
+        self.mirrors = list(mirrors)
+        self.state_path = state_path
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, Dict[str, Any]] = {}
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self.state_path is None:
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, latencies: Dict[str, Dict[str, Any]]) -> None:
+        if self.state_path is None:
+            return
+        with _state_lock:
+            state = self._load()
+            state.update(latencies)
+            tmp_path = f'{self.state_path}.{os.getpid()}.{threading.get_ident()}'
+            try:
+                os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.state_path)
+            except OSError as e:
+                logger.debug(f"Could not save the mirror latencies to {self.state_path}: {e!r}")
+
+    def latencies(self, path: str) -> Dict[str, Optional[float]]:
+        """Returns the latency of each mirror for path (None if it failed), probing those without a fresh one"""
+        with self._lock:
+            now = time.time()
+            known = {**self._load(), **self._latencies}
+            entries = {mirror: known[mirror] if isinstance(known.get(mirror), dict) else {} for mirror in self.mirrors}
+
+            def failed(entry: Dict[str, Any]) -> bool:
+                failed_at = entry.get('failed', {}).get(path)
+                return failed_at is not None and now - failed_at <= self.ttl
+
+            def fresh(entry: Dict[str, Any]) -> bool:
+                return failed(entry) or (entry.get('latency') is not None and now - entry.get('probed', 0) <= self.ttl)
+
+            stale = [mirror for mirror in self.mirrors if not fresh(entries[mirror])]
+            if stale:
+                with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+                    results = list(executor.map(lambda m: probe(mirror_url(m, path), self.timeout), stale))
+                probed = {}
+                for mirror, latency in zip(stale, results):
+                    entry = dict(entries[mirror])
+                    # the failures of other files which have not expired yet
+                    failures = {p: t for p, t in entry.get('failed', {}).items() if p != path and now - t <= self.ttl}
+                    if latency is not None:
+                        entry.update(latency=latency, probed=now)
+                    else:
+                        failures[path] = now
+                    entry['failed'] = failures
+                    probed[mirror] = entries[mirror] = entry
+                logger.debug(f"Probed mirrors for {path}: {probed}")
+                self._save(probed)
+            self._latencies.update(entries)
+            return {mirror: None if failed(entries[mirror]) else entries[mirror].get('latency') for mirror in self.mirrors}
+
+    def urls(self, path: str) -> List[str]:
+        """Returns the URLs of path on the mirrors, the fastest first"""
+        if len(self.mirrors) == 1:
+            return [mirror_url(self.mirrors[0], path)]
+        latencies = self.latencies(path)
+        ranked: List[str] = sorted(
+            self.mirrors,
+            key=lambda mirror: (latencies[mirror] is None, latencies[mirror] or 0.0),
+        )
+        return [mirror_url(mirror, path) for mirror in ranked]
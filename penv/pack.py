@@ -0,0 +1,477 @@
+"""Export of an environment as a distributable zip or tar archive."""
+import collections
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, Any, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from .manifest import MANIFEST_FILE, MANIFEST_VERSION, index_files, load_manifest
+
+PACK_FORMATS = ('zip', 'tar', 'tar.gz')
+DEFAULT_PACK_WORKERS: int = os.cpu_count() or 1
+DEFAULT_COMPRESS_LEVEL: int = 6
+READ_CHUNK_SIZE: int = 1024 * 1024
+# compressed members up to this size are kept in memory, larger ones spill to disk
+SPOOL_MAX_SIZE: int = 1024 * 1024
+# tar.gz streams are compressed in blocks of this size as concatenated gzip members
+GZIP_BLOCK_SIZE: int = 1024 * 1024
+# sizes, offsets and member counts from which zip needs its zip64 extensions
+ZIP64_LIMIT: int = 0xFFFFFFFF
+ZIP_MAX_ENTRIES: int = 0xFFFF
+
+logger = logging.getLogger(__name__)
+
+
+class PackResult(NamedTuple):
+    files: int
+    # identical files stored once (tar) or compressed once (zip, whose members can not share their data)
+    duplicates: int
+    bytes_in: int
+    bytes_out: int
+
+
+def pack_format(output: str) -> str:
+    """Returns the archive format implied by the file name output"""
+    name = output.lower()
+    if name.endswith(('.tar.gz', '.tgz')):
+        return 'tar.gz'
+    if name.endswith('.tar'):
+        return 'tar'
+    return 'zip'
+
+
+def _source_date_epoch() -> Optional[int]:
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    return int(value) if value else None
+
+
+def _bounded_map(executor: ThreadPoolExecutor, fn, items: List[Any], window: int) -> Iterator[Any]:
+    """Like executor.map but with at most window calls submitted ahead of the consumer"""
+    pending: Deque['Future[Any]'] = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class _Compressed(NamedTuple):
+    crc: int
+    compress_type: int
+    compress_size: int
+    data: IO[bytes]
+
+
+def _deflate(path: str, level: int) -> _Compressed:
+    """Raw-deflate the file at path into a spooled temporary file"""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            spool.write(compressor.compress(chunk))
+    spool.write(compressor.flush())
+    compress_size = spool.tell()
+    if compress_size >= size:
+        # incompressible (e.g. already compressed archives): store it as is
+        spool.seek(0)
+        spool.truncate()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, spool, READ_CHUNK_SIZE)
+        compress_type, compress_size = zipfile.ZIP_STORED, size
+    else:
+        compress_type = zipfile.ZIP_DEFLATED
+    spool.seek(0)
+    return _Compressed(crc, compress_type, compress_size, spool)  # type: ignore
+
+
+def _deflate_data(data: bytes, level: int) -> _Compressed:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return _Compressed(zlib.crc32(data), zipfile.ZIP_DEFLATED, len(compressed), io.BytesIO(compressed))
+
+
+class _ZipWriter:
+    """Writes a zip of members compressed elsewhere
+
+    zipfile.ZipFile only writes the members it compresses itself, so the
+    headers are written here, once, as the sizes are known up front.
+    The zip64 extensions are used where the sizes, offsets or the number
+    of members need them.
+    """
+
+    def __init__(self, fileobj: IO[bytes]):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.members: List[Tuple[zipfile.ZipInfo, bytes]] = []
+
+    def _write(self, data: bytes) -> None:
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    @staticmethod
+    def _dos_date_time(zinfo: zipfile.ZipInfo) -> Tuple[int, int]:
+        year, month, day, hour, minute, second = zinfo.date_time
+        return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+    def add(self, zinfo: zipfile.ZipInfo, compressed: _Compressed) -> None:
+        """Append zinfo with the data of compressed, which is read from its current position"""
+        zinfo.compress_type = compressed.compress_type
+        zinfo.compress_size = compressed.compress_size
+        zinfo.CRC = compressed.crc
+        zinfo.header_offset = self.offset
+        try:
+            name = zinfo.filename.encode('ascii')
+            flag_bits = 0
+        except UnicodeEncodeError:
+            name = zinfo.filename.encode('utf-8')
+            flag_bits = 0x800
+        zinfo.flag_bits = flag_bits
+        zip64 = zinfo.file_size >= ZIP64_LIMIT or zinfo.compress_size >= ZIP64_LIMIT
+        extra = struct.pack('<2H2Q', 1, 16, zinfo.file_size, zinfo.compress_size) if zip64 else b''
+        date, time_ = self._dos_date_time(zinfo)
+        self._write(struct.pack(
+            '<4s2B4HL2L2H', b'PK\x03\x04', 45 if zip64 else 20, 0, flag_bits, zinfo.compress_type, time_, date,
+            zinfo.CRC, 0xFFFFFFFF if zip64 else zinfo.compress_size, 0xFFFFFFFF if zip64 else zinfo.file_size,
+            len(name), len(extra),
+        ))
+        self._write(name + extra)
+        for chunk in iter(lambda: compressed.data.read(READ_CHUNK_SIZE), b''):
+            self._write(chunk)
+        self.members.append((zinfo, name))
+
+    def close(self) -> int:
+        """Write the central directory and returns the size of the zip"""
+        start = self.offset
+        for zinfo, name in self.members:
+            sizes = [zinfo.file_size, zinfo.compress_size, zinfo.header_offset]
+            large = [value for value in sizes if value >= ZIP64_LIMIT]
+            extra = struct.pack(f'<2H{len(large)}Q', 1, 8 * len(large), *large) if large else b''
+            file_size, compress_size, header_offset = (0xFFFFFFFF if value >= ZIP64_LIMIT else value for value in sizes)
+            date, time_ = self._dos_date_time(zinfo)
+            version = 45 if large else 20
+            self._write(struct.pack(
+                '<4s4B4HL2L5H2L', b'PK\x01\x02', version, zinfo.create_system, version, 0, zinfo.flag_bits,
+                zinfo.compress_type, time_, date, zinfo.CRC, compress_size, file_size, len(name), len(extra), 0, 0,
+                0, zinfo.external_attr, header_offset,
+            ))
+            self._write(name + extra)
+        count, size = len(self.members), self.offset - start
+        if count >= ZIP_MAX_ENTRIES or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            end64 = self.offset
+            self._write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, size, start))
+            self._write(struct.pack('<4sLQL', b'PK\x06\x07', 0, end64, 1))
+        entries = 0xFFFF if count >= ZIP_MAX_ENTRIES else count
+        self._write(struct.pack(
+            '<4s4H2LH', b'PK\x05\x06', 0, 0, entries, entries,
+            0xFFFFFFFF if size >= ZIP64_LIMIT else size, 0xFFFFFFFF if start >= ZIP64_LIMIT else start, 0,
+        ))
+        self.fileobj.flush()
+        return self.offset
+
+
+class _ParallelGzipWriter(io.RawIOBase):
+    """Writes a gzip stream compressed in blocks on a thread pool
+
+    The blocks are independent gzip members, which gzip and tarfile read as
+    one stream (like pigz does). The output only depends on the input.
+    """
+
+    def __init__(self, fileobj: IO[bytes], executor: ThreadPoolExecutor, level: int, window: int):
+        self._fileobj = fileobj
+        self._executor = executor
+        self._level = level
+        self._window = window
+        self._buffer = bytearray()
+        self._pending: Deque['Future[bytes]'] = collections.deque()
+        self.bytes_out = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:  # type: ignore
+        self._buffer += b
+        while len(self._buffer) >= GZIP_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:GZIP_BLOCK_SIZE]))
+            del self._buffer[:GZIP_BLOCK_SIZE]
+        return len(b)
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._executor.submit(gzip.compress, block, self._level, mtime=0))
+        while len(self._pending) >= self._window:
+            self._drain()
+
+    def _drain(self) -> None:
+        data = self._pending.popleft().result()
+        self._fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._drain()
+        super().close()
+
+
+def _collect(env_dir: str) -> Tuple[List[str], Dict[str, Dict[str, Any]], Dict[str, Any]]:
+    """Returns the directories, the files and the manifest of env_dir"""
+    dirs: List[str] = []
+    for root, names, _ in os.walk(env_dir):
+        for name in names:
+            dirs.append(os.path.relpath(os.path.join(root, name), env_dir).replace(os.sep, '/'))
+    manifest = load_manifest(env_dir) or {}
+    # the recorded hashes are reused for the files whose stat still matches
+    files = index_files(env_dir, manifest.get('files'))
+    return sorted(dirs), files, {**manifest, 'files': files}
+
+
+def pack_env(
+    env_dir: str,
+    output: str,
+    archive_format: Optional[str] = None,
+    prefix: Optional[str] = None,
+    level: int = DEFAULT_COMPRESS_LEVEL,
+    max_workers: int = DEFAULT_PACK_WORKERS,
+) -> PackResult:
+    """Pack env_dir into the archive output ('-' for standard output)
+
+    Members are written in sorted order under prefix (the name of env_dir by
+    default) with the manifest of the environment, so packing the same
+    environment twice gives the same archive; set SOURCE_DATE_EPOCH to also
+    fix the timestamps. Files are compressed on max_workers threads with a
+    bounded number of them in flight. In tar archives identical files are
+    stored once, as hardlinks to the first one. Zip has no such links (each
+    member's local header carries its own name, which readers check), so
+    identical files are only compressed once and stored under every name.
+    """
+    archive_format = archive_format or pack_format(output)
+    if archive_format not in PACK_FORMATS:
+        raise ValueError(f'Unknown archive format: {archive_format}')
+    env_dir = os.path.abspath(env_dir)
+    if prefix is None:
+        prefix = os.path.basename(env_dir)
+    dirs, files, manifest = _collect(env_dir)
+    manifest_data = json.dumps({**manifest, 'version': MANIFEST_VERSION}, indent=2, sort_keys=True).encode()
+    epoch = _source_date_epoch()
+    if epoch is None:
+        # the manifest is dated like the newest file so that it does not change the archive
+        manifest_mtime = max((record['mtime_ns'] // 10 ** 9 for record in files.values()), default=0)
+    else:
+        manifest_mtime = epoch
+    window = max(2, 2 * max_workers)
+    started = time.monotonic()
+    fileobj: IO[bytes] = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if archive_format == 'zip':
+                result = _pack_zip(env_dir, fileobj, prefix, dirs, files, manifest_data, manifest_mtime, epoch, level, executor, window)
+            else:
+                result = _pack_tar(env_dir, fileobj, prefix, dirs, files, manifest_data, manifest_mtime, epoch, level, executor, window, archive_format == 'tar.gz')
+    finally:
+        if fileobj is not sys.stdout.buffer:
+            fileobj.close()
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Packed {result.files} files ({result.duplicates} duplicates) of {env_dir} into {output}: "
+        f"{result.bytes_in} -> {result.bytes_out} bytes in {elapsed:.2f}s"
+    )
+    return result
+
+
+def _arcname(prefix: str, rel: str) -> str:
+    return f'{prefix}/{rel}' if prefix else rel
+
+
+def _pack_zip(
+    env_dir: str,
+    fileobj: IO[bytes],
+    prefix: str,
+    dirs: List[str],
+    files: Dict[str, Dict[str, Any]],
+    manifest_data: bytes,
+    manifest_mtime: int,
+    epoch: Optional[int],
+    level: int,
+    executor: ThreadPoolExecutor,
+    window: int,
+) -> PackResult:
+    def date_time(mtime: float) -> Tuple[int, int, int, int, int, int]:
+        # zip can not represent times before 1980
+        return time.localtime(max(epoch if epoch is not None else mtime, 315532800))[:6]  # type: ignore
+
+    def member(rel: str) -> zipfile.ZipInfo:
+        path = os.path.join(env_dir, *rel.split('/'))
+        zinfo = zipfile.ZipInfo.from_file(path, _arcname(prefix, rel))
+        zinfo.date_time = date_time(os.stat(path).st_mtime)
+        return zinfo
+
+    def compress(rel: str) -> _Compressed:
+        return _deflate(os.path.join(env_dir, *rel.split('/')), level)
+
+    writer = _ZipWriter(fileobj)
+    for rel in dirs:
+        zinfo = zipfile.ZipInfo(_arcname(prefix, rel) + '/', date_time(os.stat(os.path.join(env_dir, rel)).st_mtime))
+        zinfo.external_attr = 0o40775 << 16 | 0x10
+        writer.add(zinfo, _Compressed(0, zipfile.ZIP_STORED, 0, io.BytesIO()))
+    rels = sorted(files)
+    # the compressed data of identical files is kept until their last member is written
+    remaining = collections.Counter(files[rel]['sha256'] for rel in rels)
+    first: Dict[str, str] = {}
+    for rel in rels:
+        first.setdefault(files[rel]['sha256'], rel)
+    compressed_files = _bounded_map(executor, compress, list(first.values()), window)
+    held: Dict[str, _Compressed] = {}
+    duplicates = 0
+    for rel in rels:
+        sha256 = files[rel]['sha256']
+        if sha256 in held:
+            duplicates += 1
+        else:
+            held[sha256] = next(compressed_files)
+        compressed = held[sha256]
+        compressed.data.seek(0)
+        writer.add(member(rel), compressed)
+        remaining[sha256] -= 1
+        if not remaining[sha256]:
+            held.pop(sha256).data.close()
+    zinfo = zipfile.ZipInfo(_arcname(prefix, MANIFEST_FILE), date_time(manifest_mtime))
+    zinfo.external_attr = 0o644 << 16
+    zinfo.file_size = len(manifest_data)
+    writer.add(zinfo, _deflate_data(manifest_data, level))
+    bytes_out = writer.close()
+    return PackResult(len(rels), duplicates, sum(files[rel]['size'] for rel in rels), bytes_out)
+
+
+def _pack_tar(
+    env_dir: str,
+    fileobj: IO[bytes],
+    prefix: str,
+    dirs: List[str],
+    files: Dict[str, Dict[str, Any]],
+    manifest_data: bytes,
+    manifest_mtime: int,
+    epoch: Optional[int],
+    level: int,
+    executor: ThreadPoolExecutor,
+    window: int,
+    compress: bool,
+) -> PackResult:
+    def normalized(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        tarinfo.mtime = epoch if epoch is not None else int(tarinfo.mtime)
+        return tarinfo
+
+    target: IO[bytes] = _ParallelGzipWriter(fileobj, executor, level, window) if compress else fileobj  # type: ignore
+    first: Dict[str, str] = {}
+    duplicates = 0
+    bytes_in = 0
+    with tarfile.open(fileobj=target, mode='w|', format=tarfile.PAX_FORMAT) as tf:
+        for rel in dirs:
+            tf.addfile(normalized(tf.gettarinfo(os.path.join(env_dir, rel), _arcname(prefix, rel))))
+        for rel in sorted(files):
+            path = os.path.join(env_dir, *rel.split('/'))
+            tarinfo = normalized(tf.gettarinfo(path, _arcname(prefix, rel)))
+            sha256 = files[rel]['sha256']
+            if sha256 in first:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = first[sha256]
+                tarinfo.size = 0
+                tf.addfile(tarinfo)
+                duplicates += 1
+                continue
+            first[sha256] = tarinfo.name
+            bytes_in += tarinfo.size
+            with open(path, 'rb') as f:
+                tf.addfile(tarinfo, f)
+        tarinfo = tarfile.TarInfo(_arcname(prefix, MANIFEST_FILE))
+        tarinfo.size = len(manifest_data)
+        tarinfo.mode = 0o644
+        tarinfo.mtime = manifest_mtime
+        tf.addfile(tarinfo, io.BytesIO(manifest_data))
+    if compress:
+        target.close()
+        bytes_out = target.bytes_out  # type: ignore
+    else:
+        bytes_out = fileobj.tell() if fileobj.seekable() else 0
+    return PackResult(len(files), duplicates, bytes_in, bytes_out)
+
+
+def pack_main(args=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='penv pack',
+        description='Packs an environment into a zip or tar archive.',
+    )
+    parser.add_argument(
+        'env_dir',
+        metavar='ENV_DIR',
+        help='The environment directory to pack.',
+    )
+    parser.add_argument(
+        'output',
+        metavar='OUTPUT',
+        help='The archive to write, or - for the standard output.',
+    )
+    parser.add_argument(
+        '--format',
+        default=None,
+        choices=PACK_FORMATS,
+        dest='archive_format',
+        help='The archive format (by default from the extension of OUTPUT, else zip)',
+    )
+    parser.add_argument(
+        '--prefix',
+        default=None,
+        dest='prefix',
+        help='The directory in the archive which holds the environment (by default the name of ENV_DIR)',
+    )
+    parser.add_argument(
+        '--level',
+        default=DEFAULT_COMPRESS_LEVEL,
+        type=int,
+        dest='level',
+        help='The compression level from 0 to 9',
+    )
+    parser.add_argument(
+        '--jobs',
+        default=DEFAULT_PACK_WORKERS,
+        type=int,
+        dest='jobs',
+        help='The number of compression threads',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    # keep the standard output clean for the archive
+    logging.basicConfig(level=getattr(logging, options.log_level), stream=sys.stderr)
+    pack_env(
+        options.env_dir,
+        options.output,
+        archive_format=options.archive_format,
+        prefix=options.prefix,
+        level=options.level,
+        max_workers=options.jobs,
+    )
@@ -0,0 +1,117 @@
+"""Per-phase timing and counters of environment builds."""
+import contextlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+PROFILE_VERSION: int = 1
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseRecord(NamedTuple):
+    env_dir: str
+    phase: str
+    # seconds since the profiler was created
+    start: float
+    elapsed: float
+    counters: Dict[str, Any]
+
+
+class Profiler:
+    """Records the wall time and counters of the phases of environment builds
+
+    Phases nest; a counter is added to every phase running in the calling
+    thread, so e.g. the bytes downloaded show up in both ``download`` and
+    ``create``. callback is called with each record when its phase ends;
+    an exception it raises is logged rather than failing the build.
+    Environments may be built concurrently from several threads.
+    """
+
+    def __init__(self, callback: Optional[Callable[[PhaseRecord], None]] = None):
+        self.callback = callback
+        self.records: List[PhaseRecord] = []
+        self._listeners: List[Callable[[PhaseRecord], None]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.monotonic()
+
+    def _stack(self) -> List[Dict[str, Any]]:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def phase(self, name: str, env_dir: str) -> Iterator[Dict[str, Any]]:
+        counters: Dict[str, Any] = {}
+        stack = self._stack()
+        stack.append(counters)
+        started = time.monotonic()
+        try:
+            yield counters
+        except BaseException as e:
+            counters['error'] = type(e).__name__
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            stack.pop()
+            record = PhaseRecord(env_dir, name, started - self._origin, elapsed, counters)
+            with self._lock:
+                self.records.append(record)
+            for listener in [self.callback, *self._listeners]:
+                if listener is None:
+                    continue
+                try:
+                    listener(record)
+                except Exception as e:
+                    logger.error(f"A callback failed on the {name} phase of {env_dir}: {e!r}")
+
+    def subscribe(self, listener: Callable[[PhaseRecord], None]) -> Callable[[], None]:
+        """Call listener with each record as its phase ends, until the returned function is called"""
+        with self._lock:
+            self._listeners.append(listener)
+
+        def unsubscribe() -> None:
+            with self._lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+
+        return unsubscribe
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add value to the counter name of the phases running in this thread"""
+        for counters in self._stack():
+            counters[name] = counters.get(name, 0) + value
+
+    def pop(self, env_dirs: Iterable[str]) -> List[PhaseRecord]:
+        """Remove and return the records of env_dirs, so that a long-lived process does not keep them"""
+        env_dirs = set(env_dirs)
+        with self._lock:
+            popped = [record for record in self.records if record.env_dir in env_dirs]
+            self.records = [record for record in self.records if record.env_dir not in env_dirs]
+        return popped
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the number of runs, the total time and the summed counters of each phase"""
+        summary: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            entry = summary.setdefault(record.phase, {'count': 0, 'elapsed': 0.0, 'counters': {}})
+            entry['count'] += 1
+            entry['elapsed'] += record.elapsed
+            for key, value in record.counters.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    entry['counters'][key] = entry['counters'].get(key, 0) + value
+        return summary
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            records = [record._asdict() for record in self.records]
+        return {'version': PROFILE_VERSION, 'records': records, 'summary': self.summary()}
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
@@ -0,0 +1,217 @@
+"""Resolution of partial python versions against the releases on python.org."""
+import http.client
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from .download import Downloader, DownloadError, download, file_url_path
+from .mirrors import MirrorList, head_status
+
+RELEASES_FILE: str = 'releases.json'
+RELEASES_VERSION: int = 1
+# seconds for which the list of releases is reused before it is fetched again
+DEFAULT_RELEASES_TTL: float = 24 * 3600
+# the statuses which tell for sure that a mirror has no such build
+MISSING_STATUSES = (404, 410)
+VERSION_RE = re.compile(r'\d+\.\d+\.\d+')
+# the release directories in the listing of https://www.python.org/ftp/python/
+LISTING_RE = re.compile(r'href="(\d+\.\d+\.\d+)/"')
+CLAUSE_RE = re.compile(r'(?P<op>==|!=|<=|>=|~=|<|>)?\s*(?P<version>\d+(?:\.\d+){0,2})(?P<wildcard>\.\*)?')
+
+logger = logging.getLogger(__name__)
+
+
+def version_tuple(version: str) -> Tuple[int, ...]:
+    return tuple(int(part) for part in version.split('.'))
+
+
+def short_version(version: str) -> str:
+    """Returns e.g. '312' for '3.12.1', as in python312.dll and python312._pth"""
+    return ''.join(version.split('.')[:2])
+
+
+def is_exact(spec: str) -> bool:
+    """Whether spec is an X.Y.Z version which needs no resolution"""
+    return VERSION_RE.fullmatch(spec.strip()) is not None
+
+
+def _clause_matches(version: Tuple[int, ...], op: str, bound: Tuple[int, ...], wildcard: bool) -> bool:
+    padded = bound + (0,) * (3 - len(bound))
+    if op == '~=':
+        return version >= padded and version[:len(bound) - 1] == bound[:-1]
+    if op in ('==', '!='):
+        # a bare X.Y means its latest patch release like X.Y.*
+        equal = version[:len(bound)] == bound if wildcard or len(bound) < 3 else version == padded
+        return equal if op == '==' else not equal
+    return {
+        '<': version < padded,
+        '<=': version <= padded,
+        '>': version > padded,
+        '>=': version >= padded,
+    }[op]
+
+
+def parse_spec(spec: str) -> List[Tuple[str, Tuple[int, ...], bool]]:
+    """Parse a specifier like '3.12', '==3.12.*' or '>=3.11,<3.13' into (operator, version, wildcard) clauses"""
+    clauses = []
+    for clause in spec.split(','):
+        match = CLAUSE_RE.fullmatch(clause.strip())
+        if match is None:
+            raise ValueError(f'Invalid python version specifier: {spec!r}')
+        op = match.group('op') or '=='
+        bound = version_tuple(match.group('version'))
+        wildcard = match.group('wildcard') is not None
+        if (wildcard and op not in ('==', '!=')) or (op == '~=' and len(bound) < 2):
+            raise ValueError(f'Invalid python version specifier: {spec!r}')
+        clauses.append((op, bound, wildcard))
+    return clauses
+
+
+def version_matches(version: str, spec: str) -> bool:
+    """Whether the X.Y.Z version satisfies spec"""
+    parsed = version_tuple(version)
+    return all(_clause_matches(parsed, op, bound, wildcard) for op, bound, wildcard in parse_spec(spec))
+
+
+class ReleaseIndex:
+    """The python releases on the python mirrors with their embeddable builds
+
+    The versions are read from the directory listing of the first mirror
+    which answers and kept in path (when given) for ttl seconds. Whether the
+    embeddable build of a version exists for an architecture is checked
+    once with a HEAD request and recorded too, so that resolving a version
+    again is a local lookup. Only a definite answer is recorded: when no
+    mirror could be asked, the build is assumed to exist and is checked
+    again next time. Without network access, an expired index is used as
+    it is. An index held in memory expires as well, so that a long-lived
+    process picks up new releases.
+    """
+
+    def __init__(
+        self,
+        mirrors: MirrorList,
+        path: Optional[str] = None,
+        downloader: Optional[Downloader] = None,
+        ttl: float = DEFAULT_RELEASES_TTL,
+    ):
+        self.mirrors = mirrors
+        self.path = path
+        self.downloader = downloader
+        self.ttl = ttl
+        self._index: Optional[Dict[str, Any]] = None
+        self._offline = False
+
+    def _load(self) -> Optional[Dict[str, Any]]:
+        if self.path is None:
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if index.get('version') == RELEASES_VERSION else None
+
+    def _save(self, index: Dict[str, Any]) -> None:
+        if self.path is None:
+            return
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.debug(f"Could not save the release index to {self.path}: {e!r}")
+
+    def _list_versions(self, url: str) -> List[str]:
+        if urlsplit(url).scheme == 'file':
+            path = file_url_path(url)
+            return [name for name in os.listdir(path) if VERSION_RE.fullmatch(name)]
+        with tempfile.TemporaryDirectory(prefix='penv-') as tmp_dir:
+            listing = os.path.join(tmp_dir, 'listing.html')
+            download(url, listing, self.downloader)
+            with open(listing, 'r', encoding='utf-8', errors='replace') as f:
+                return sorted(set(LISTING_RE.findall(f.read())))
+
+    def _fetch_versions(self) -> List[str]:
+        errors = []
+        for url in self.mirrors.urls(''):
+            try:
+                versions = self._list_versions(url)
+            except (DownloadError, http.client.HTTPException, OSError) as e:
+                errors.append(f'{url}: {e!r}')
+                continue
+            if versions:
+                logger.debug(f"Listed {len(versions)} python releases on {url}")
+                return sorted(versions, key=version_tuple)
+            errors.append(f'{url}: no releases')
+        raise DownloadError(f"Could not list the python releases ({'; '.join(errors)})")
+
+    def load(self) -> Dict[str, Any]:
+        """Returns the index, fetching the list of releases if it is missing or expired"""
+        if self._index is not None and time.time() - self._index.get('fetched', 0) <= self.ttl:
+            return self._index
+        self._offline = False
+        # the expired index in memory is still better than none without network access
+        index = self._load() or self._index
+        if index is None or time.time() - index.get('fetched', 0) > self.ttl:
+            try:
+                index = {
+                    'version': RELEASES_VERSION,
+                    'fetched': time.time(),
+                    'versions': self._fetch_versions(),
+                    'builds': {},
+                }
+                self._save(index)
+            except DownloadError as e:
+                if index is None:
+                    raise ValueError(f'No release index to resolve python versions with: {e}') from e
+                logger.warning(f"Using the expired release index in {self.path}: {e}")
+                self._offline = True
+        self._index = index
+        return index
+
+    def _has_build(self, version: str, platform_arch: str) -> Optional[bool]:
+        """Whether a mirror has the embeddable build, or None when it is unknown as no mirror answered"""
+        zip_name = f'python-{version}-embed-{platform_arch}.zip'
+        missing = True
+        for url in self.mirrors.urls(f'{version}/{zip_name}'):
+            status = head_status(url)
+            if status is not None and status < 400:
+                return True
+            if status not in MISSING_STATUSES:
+                missing = False
+        return False if missing else None
+
+    def resolve(self, spec: str, platform_arch: str) -> str:
+        """Returns the latest version matching spec with an embeddable build for platform_arch"""
+        if is_exact(spec):
+            return spec.strip()
+        clauses = parse_spec(spec)
+        index = self.load()
+        candidates = sorted(
+            (
+                version for version in index['versions']
+                if all(_clause_matches(version_tuple(version), *clause) for clause in clauses)
+            ),
+            key=version_tuple,
+            reverse=True,
+        )
+        for version in candidates:
+            key = f'{version}-{platform_arch}'
+            available = index['builds'].get(key)
+            if available is None and not self._offline:
+                # e.g. the directory of an upcoming release holds its release candidates only
+                available = self._has_build(version, platform_arch)
+                if available is not None:
+                    index['builds'][key] = available
+                    self._save(index)
+            if available is not False:
+                logger.info(f"Resolved python {spec} to {version}")
+                return version
+        raise ValueError(f'No embeddable python for {platform_arch} matches {spec!r}')
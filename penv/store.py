@@ -0,0 +1,221 @@
+"""Content-addressed store of site-packages files shared among environments."""
+import hashlib
+import json
+import logging
+import os
+import re
+import stat
+import threading
+from typing import Any, Dict, List, Optional, Set
+from .cache import sha256_file
+from .manifest import stat_matches
+from .template import Cloner, protect, remove_file, replace_file
+
+STORE_OBJECTS_DIR: str = 'objects'
+STORE_REFS_DIR: str = 'refs'
+# the files of an environment which are kept in the store
+STORE_PREFIX: str = 'Lib/site-packages/'
+OBJECT_RE = re.compile(r'[0-9a-f]{64}')
+
+logger = logging.getLogger(__name__)
+
+
+class PackageStore:
+    """Files kept once under ``objects/<sha256>`` and linked into environments
+
+    Like the store of pnpm: the files of site-packages which several
+    environments have in common take the disk space of one, and linking them
+    (see Cloner) costs no copy. Objects are read-only, so writing to a
+    hardlinked file of an environment fails instead of changing it in every
+    environment; a reflink (copy-on-write) shares nothing once written to.
+    Hardlinked objects are kept by gc while they have other links; the
+    objects an environment holds by reflink or copy are recorded under
+    ``refs/`` and kept while the environment exists.
+    """
+
+    def __init__(self, root: str, link_mode: str = 'auto'):
+        self.root = root
+        self.link_mode = link_mode
+        self.objects_dir = os.path.join(root, STORE_OBJECTS_DIR)
+        self.refs_dir = os.path.join(root, STORE_REFS_DIR)
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def _ref_path(self, env_dir: str) -> str:
+        key = hashlib.sha256(os.path.normcase(os.path.abspath(env_dir)).encode('utf-8')).hexdigest()
+        return os.path.join(self.refs_dir, f'{key}.json')
+
+    def _load_ref(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, 'r') as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return ref if isinstance(ref, dict) and 'env_dir' in ref else None
+
+    def _save_ref(self, env_dir: str, objects: Set[str]) -> None:
+        path = self._ref_path(env_dir)
+        if not objects:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(self.refs_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'env_dir': os.path.abspath(env_dir), 'objects': sorted(objects)}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def _publish(self, path: str, sha256: str, cloner: Cloner) -> None:
+        obj = self.object_path(sha256)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp_path = f'{obj}.tmp-{os.getpid()}-{threading.get_ident()}'
+        cloner(path, tmp_path)
+        try:
+            os.replace(tmp_path, obj)
+        except OSError:
+            # published concurrently; a read-only object can not be replaced on Windows
+            remove_file(tmp_path)
+            if not os.path.isfile(obj):
+                raise
+
+    def link(self, env_dir: str, files: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+        """Replace files of env_dir with links to their objects, adding the objects missing
+
+        files maps '/' separated paths relative to env_dir to their manifest
+        records (see index_files), whose sha256 is trusted while their size
+        and modification time match. The records are updated to the linked
+        files. Returns how many files were added to the store, linked from
+        it, or already linked.
+        """
+        cloner = Cloner(self.link_mode)
+        counts = {'added': 0, 'linked': 0, 'shared': 0}
+        referenced: Set[str] = set()
+        for rel, record in files.items():
+            path = os.path.join(env_dir, *rel.split('/'))
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            sha256 = record['sha256'] if stat_matches(record, st) else sha256_file(path)
+            obj = self.object_path(sha256)
+            if os.path.isfile(obj) and os.path.samestat(st, os.stat(obj)):
+                counts['shared'] += 1
+            elif not os.path.isfile(obj):
+                self._publish(path, sha256, cloner)
+                counts['added'] += 1
+            else:
+                tmp_path = f'{path}.penv-{os.getpid()}-{threading.get_ident()}'
+                try:
+                    cloner(obj, tmp_path)
+                except FileNotFoundError:
+                    # removed by a concurrent gc
+                    self._publish(path, sha256, cloner)
+                    counts['added'] += 1
+                else:
+                    # path may be a read-only link of a template
+                    replace_file(tmp_path, path)
+                    counts['linked'] += 1
+            # also made read-only again after a Windows tool cleared the flag to remove a link
+            protect(obj)
+            st = os.stat(path)
+            if not os.path.samestat(st, os.stat(obj)):
+                referenced.add(sha256)
+            record.update(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=sha256)
+        self._save_ref(env_dir, referenced)
+        logger.debug(f"Linked {env_dir} to the package store {self.root}: {counts} ({cloner.counts})")
+        return counts
+
+    def _objects(self) -> List[str]:
+        if not os.path.isdir(self.objects_dir):
+            return []
+        return sorted(
+            name
+            for prefix in os.listdir(self.objects_dir)
+            for name in os.listdir(os.path.join(self.objects_dir, prefix))
+            if OBJECT_RE.fullmatch(name)
+        )
+
+    def gc(self) -> Dict[str, int]:
+        """Remove the objects which no environment links any more
+
+        The records of removed environments are dropped first. Returns how
+        many records and objects were removed and the bytes freed.
+        """
+        counts = {'refs': 0, 'objects': 0, 'bytes': 0}
+        referenced: Set[str] = set()
+        if os.path.isdir(self.refs_dir):
+            for name in os.listdir(self.refs_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.refs_dir, name)
+                ref = self._load_ref(path)
+                if ref is None or not os.path.isdir(ref['env_dir']):
+                    os.remove(path)
+                    counts['refs'] += 1
+                    continue
+                referenced.update(ref.get('objects', []))
+        for sha256 in self._objects():
+            path = self.object_path(sha256)
+            st = os.stat(path)
+            if sha256 in referenced or st.st_nlink > 1:
+                continue
+            remove_file(path)
+            counts['objects'] += 1
+            counts['bytes'] += st.st_size
+            logger.debug(f"Removed unreferenced store object {sha256}")
+        return counts
+
+    def verify(self) -> List[str]:
+        """Re-hash every object, remove those which do not match and returns their hashes
+
+        Environments hardlinked to a removed object share its corruption and
+        need to be created again.
+        """
+        broken: List[str] = []
+        for sha256 in self._objects():
+            path = self.object_path(sha256)
+            if sha256_file(path) != sha256:
+                logger.warning(f"Store object {sha256} is corrupted")
+                remove_file(path)
+                broken.append(sha256)
+            else:
+                protect(path)
+        return broken
+
+
+def store_main(args=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='penv store',
+        description='Maintains the package store shared by environments created with --package-store.',
+    )
+    parser.add_argument(
+        'command',
+        choices=['gc', 'verify'],
+        help='remove the objects no environment links any more, or re-hash the objects.',
+    )
+    parser.add_argument(
+        '--package-store',
+        required=True,
+        dest='package_store',
+        help='The directory of the package store',
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        dest='log_level',
+        help='The logging level',
+    )
+    options = parser.parse_args(args)
+    logging.basicConfig(level=getattr(logging, options.log_level))
+    store = PackageStore(options.package_store)
+    if options.command == 'gc':
+        counts = store.gc()
+        print(f"removed {counts['objects']} objects ({counts['bytes']} bytes) and {counts['refs']} stale records")
+    elif options.command == 'verify':
+        broken = store.verify()
+        for sha256 in broken:
+            print(f'corrupted {sha256}')
+        if broken:
+            raise ValueError(f'{len(broken)} corrupted store objects were removed')
@@ -0,0 +1,296 @@
+"""Pre-patched environment templates cloned into new environments."""
+import errno
+import fnmatch
+import json
+import logging
+import os
+import shutil
+import stat
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+from .lock import LOCKS_DIR, FileLock
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+TEMPLATES_DIR: str = 'templates'
+TEMPLATE_TREE: str = 'tree'
+TEMPLATE_META: str = 'template.json'
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+# ioctl(2) request number of FICLONE on Linux
+FICLONE: int = getattr(fcntl, 'FICLONE', 0x40049409)
+# marshalled code objects can not be patched in place and importlib fixes up
+# co_filename of pycs on import anyway
+UNPATCHABLE_SUFFIXES = ('.pyc',)
+SCAN_CHUNK_SIZE: int = 1024 * 1024
+WRITE_BITS: int = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+# files which are edited in place, e.g. by hand; clone_tree copies them rather than linking
+EDITABLE_FILES = ('*._pth', 'pyvenv.cfg')
+
+logger = logging.getLogger(__name__)
+
+
+def remove_file(path: str) -> None:
+    """Remove path even if it is read-only, which Windows refuses to do"""
+    try:
+        os.remove(path)
+    except PermissionError:
+        os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IWUSR)
+        os.remove(path)
+
+
+def remove_tree(path: str) -> None:
+    """shutil.rmtree for trees holding read-only files linked from a store"""
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            remove_file(os.path.join(root, name))
+        for name in dirs:
+            d = os.path.join(root, name)
+            if os.path.islink(d):
+                os.remove(d)
+            else:
+                os.rmdir(d)
+    os.rmdir(path)
+
+
+def replace_file(src: str, dst: str) -> None:
+    """os.replace, also over a read-only dst which Windows refuses to replace"""
+    try:
+        os.replace(src, dst)
+    except PermissionError:
+        os.chmod(dst, stat.S_IMODE(os.lstat(dst).st_mode) | stat.S_IWUSR)
+        os.replace(src, dst)
+
+
+def protect(path: str) -> None:
+    """Make path read-only, so that a file linked into several trees is not written through one of them"""
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & WRITE_BITS:
+        os.chmod(path, mode & ~WRITE_BITS)
+
+
+def reflink(src: str, dst: str) -> None:
+    """Clone src into dst sharing the extents (copy-on-write)"""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported on this platform', src)
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+class Cloner:
+    """Links files with the first mechanism the file system supports"""
+
+    def __init__(self, mode: str = 'auto'):
+        if mode not in LINK_MODES:
+            raise ValueError(f'Unknown link mode: {mode}')
+        if mode == 'auto':
+            self.methods = ['reflink', 'hardlink', 'copy']
+        else:
+            self.methods = [mode]
+        self.counts: Dict[str, int] = {}
+
+    def __call__(self, src: str, dst: str) -> None:
+        while True:
+            method = self.methods[0]
+            try:
+                if method == 'reflink':
+                    reflink(src, dst)
+                elif method == 'hardlink':
+                    os.link(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+            except OSError as e:
+                if len(self.methods) == 1:
+                    raise
+                logger.debug(f"{method} is not available ({e}); falling back to {self.methods[1]}")
+                self.methods.pop(0)
+                continue
+            self.counts[method] = self.counts.get(method, 0) + 1
+            return
+
+
+def clone_tree(src: str, dst: str, mode: str = 'auto', skip: Iterable[str] = ()) -> Dict[str, int]:
+    """Clone the tree src into dst by reflinks, hardlinks or copies
+
+    Hardlinked files are made read-only, so that writing to one in place
+    fails instead of changing it in every tree which shares it; the files
+    matching EDITABLE_FILES are copied instead. Files whose path relative
+    to src is in skip are not cloned.
+    Returns how many files were cloned by each method.
+    """
+    cloner = Cloner(mode)
+    skipped: Set[str] = {os.path.normcase(os.path.normpath(p)) for p in skip}
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        target_root = os.path.join(dst, rel_root) if rel_root != os.curdir else dst
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if os.path.normcase(rel) in skipped:
+                continue
+            target = os.path.join(target_root, name)
+            if os.path.lexists(target):
+                remove_file(target)
+            if any(fnmatch.fnmatch(name, pattern) for pattern in EDITABLE_FILES):
+                shutil.copy2(os.path.join(root, name), target)
+                cloner.counts['copy'] = cloner.counts.get('copy', 0) + 1
+                continue
+            cloner(os.path.join(root, name), target)
+            if cloner.methods[0] == 'hardlink':
+                # also made read-only again after a Windows tool cleared the flag to remove a link
+                protect(target)
+    return cloner.counts
+
+
+def _contains(path: str, needles: List[bytes]) -> bool:
+    overlap = max(len(n) for n in needles) - 1
+    tail = b''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SCAN_CHUNK_SIZE), b''):
+            data = tail + chunk
+            if any(n in data for n in needles):
+                return True
+            tail = data[-overlap:] if overlap else b''
+    return False
+
+
+def _path_variants(path: str) -> List[bytes]:
+    variants = {path, path.replace('\\', '/')}
+    return sorted({v.encode('utf-8') for v in variants}, key=len, reverse=True)
+
+
+def find_patch_points(root: str, origin: Optional[str] = None, only: Optional[Iterable[str]] = None) -> List[str]:
+    """Returns the files under root which refer to the absolute path origin
+
+    origin defaults to root itself. With only, just those paths relative to
+    root are scanned.
+    """
+    needles = _path_variants(os.path.abspath(origin or root))
+    if only is not None:
+        candidates = [os.path.join(root, rel) for rel in only]
+    else:
+        candidates = [os.path.join(dirpath, name) for dirpath, _, files in os.walk(root) for name in files]
+    found: List[str] = []
+    for path in candidates:
+        if path.endswith(UNPATCHABLE_SUFFIXES) or not os.path.isfile(path):
+            continue
+        if _contains(path, needles):
+            found.append(os.path.relpath(path, root))
+    return sorted(found)
+
+
+def relocate_file(src: str, dst: str, old: str, new: str) -> None:
+    """Write src to dst as a new file replacing the absolute path old with new"""
+    with open(src, 'rb') as f:
+        contents = f.read()
+    old_abs, new_abs = os.path.abspath(old), os.path.abspath(new)
+    replacements = {old_abs: new_abs, old_abs.replace('\\', '/'): new_abs.replace('\\', '/')}
+    for old_path, new_path in replacements.items():
+        contents = contents.replace(old_path.encode('utf-8'), new_path.encode('utf-8'))
+    if os.path.lexists(dst):
+        remove_file(dst)
+    with open(dst, 'wb') as f:
+        f.write(contents)
+    shutil.copymode(src, dst)
+
+
+def clone_relocated(
+    src: str,
+    dst: str,
+    origin: str,
+    patch_files: List[str],
+    mode: str = 'auto',
+    skip: Iterable[str] = (),
+) -> Dict[str, int]:
+    """Clone the tree src into dst and rewrite origin to dst in its patch_files
+
+    Only the patch_files (paths relative to src which refer to the absolute
+    path origin) are read; the other files are linked or copied as they are.
+    Files in skip are neither cloned nor patched.
+    Returns how many files were cloned by each method and how many were patched.
+    """
+    skip = list(skip)
+    counts = clone_tree(src, dst, mode=mode, skip=[*patch_files, *skip])
+    skipped = {os.path.normcase(os.path.normpath(p)) for p in skip}
+    for rel in patch_files:
+        if os.path.normcase(os.path.normpath(rel)) in skipped:
+            continue
+        relocate_file(os.path.join(src, rel), os.path.join(dst, rel), origin, dst)
+    counts['patched'] = len(patch_files)
+    return counts
+
+
+class TemplateCache:
+    """Finished environment trees kept under ``<cache_dir>/templates/<key>``
+
+    Each template holds the environment in ``tree/`` and, in ``template.json``,
+    the absolute path it was built at together with the files which refer to it.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.root = os.path.join(cache_dir, TEMPLATES_DIR)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lock(self, key: str) -> FileLock:
+        """Returns the lock under which the template for key is built"""
+        return FileLock(os.path.join(self.root, LOCKS_DIR, f'{key}.lock'))
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.path(key), TEMPLATE_META), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        meta['tree'] = os.path.join(self.path(key), TEMPLATE_TREE)
+        return meta
+
+    def build_dir(self, key: str) -> str:
+        """Returns a fresh directory to build the template tree for key in"""
+        path = os.path.join(self.root, f'{key}.build-{os.getpid()}')
+        if os.path.exists(path):
+            remove_tree(path)
+        os.makedirs(path)
+        return os.path.join(path, TEMPLATE_TREE)
+
+    def publish(self, key: str, tree: str, patch_files: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Record the patch points of a built tree (found by a scan unless given) and move it into place"""
+        build = os.path.dirname(tree)
+        meta: Dict[str, Any] = {
+            'origin': os.path.abspath(tree),
+            'patch_files': find_patch_points(tree) if patch_files is None else patch_files,
+            'created': time.time(),
+        }
+        with open(os.path.join(build, TEMPLATE_META), 'w') as f:
+            json.dump(meta, f, indent=2)
+        target = self.path(key)
+        if os.path.exists(target):
+            remove_tree(target)
+        os.replace(build, target)
+        logger.info(f"Published environment template {key}")
+        return self.load(key)  # type: ignore
+
+    def discard(self, tree: str) -> None:
+        shutil.rmtree(os.path.dirname(tree), ignore_errors=True)
+
+    def clone(
+        self,
+        meta: Dict[str, Any],
+        env_dir: str,
+        mode: str = 'auto',
+        skip: Iterable[str] = (),
+    ) -> Dict[str, int]:
+        """Clone a template into env_dir and re-patch its location-sensitive files
+
+        Files in skip are neither cloned nor patched; the caller regenerates them.
+        """
+        return clone_relocated(meta['tree'], env_dir, meta['origin'], meta['patch_files'], mode=mode, skip=skip)
@@ -0,0 +1,528 @@
+"""In-process installation of wheels into an embeddable python environment."""
+import base64
+import configparser
+import csv
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from .archive import extract_zip, member_path
+from .cache import sha256_file
+from .template import Cloner, protect, remove_file
+
+WHEEL_RE = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(-(?P<build>\d[^-]*))?'
+    r'-(?P<python>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$'
+)
+INSTALLER: str = 'penv'
+COPY_BUFFER_SIZE: int = 1024 * 1024
+DEFAULT_INSTALL_WORKERS: int = min(8, (os.cpu_count() or 1) + 2)
+# distlib launchers vendored by pip, keyed by platform architecture
+PLATFORM_TAGS: Dict[str, str] = {
+    'amd64': 'win_amd64',
+    'win32': 'win32',
+    'arm64': 'win_arm64',
+}
+REQUIREMENT_RE = re.compile(
+    r'^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(==\s*(?P<version>[^\s,]+))?$'
+)
+LAUNCHERS: Dict[str, Tuple[str, str]] = {
+    'amd64': ('t64.exe', 'w64.exe'),
+    'win32': ('t32.exe', 'w32.exe'),
+    'arm64': ('t64-arm.exe', 'w64-arm.exe'),
+}
+SCRIPT_TEMPLATE: str = '''# -*- coding: utf-8 -*-
+import re
+import sys
+from {module} import {import_name}
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit({func}())
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class WheelError(Exception):
+    pass
+
+
+class WheelInfo(NamedTuple):
+    path: str
+    name: str
+    version: str
+    python: str
+    abi: str
+    platform: str
+
+
+def normalize_name(name: str) -> str:
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_wheel_filename(path: str) -> WheelInfo:
+    match = WHEEL_RE.match(os.path.basename(path))
+    if match is None:
+        raise WheelError(f'Invalid wheel filename: {path}')
+    return WheelInfo(
+        path=path,
+        name=match.group('name'),
+        version=match.group('version'),
+        python=match.group('python'),
+        abi=match.group('abi'),
+        platform=match.group('platform'),
+    )
+
+
+def _version_key(version: str) -> Tuple[int, ...]:
+    return tuple(int(p) if p.isdigit() else -1 for p in re.split(r'[.+!-]', version))
+
+
+def ensurepip_wheel_dir() -> Optional[str]:
+    """Returns the directory of the wheels bundled with the host's ensurepip"""
+    try:
+        import ensurepip
+    except ImportError:
+        return None
+    path = os.path.join(os.path.dirname(ensurepip.__file__), '_bundled')
+    return path if os.path.isdir(path) else None
+
+
+def is_compatible(info: WheelInfo, python_version: str, platform_arch: str) -> bool:
+    """Whether the tags of a wheel fit the embeddable python of python_version on platform_arch"""
+    major, minor = python_version.split('.')[:2]
+    pythons = {f'py{major}', f'py{major}{minor}', f'cp{major}{minor}'}
+    abis = {'none', 'abi3', f'cp{major}{minor}'}
+    platforms = {'any', PLATFORM_TAGS.get(platform_arch, platform_arch)}
+    if 'abi3' in info.abi.split('.'):
+        # abi3 wheels built for an older CPython 3 work on newer ones
+        pythons.update(f'cp{major}{m}' for m in range(int(minor)))
+    return (
+        bool(pythons & set(info.python.split('.'))) and bool(abis & set(info.abi.split('.'))) and bool(platforms & set(info.platform.split('.')))
+    )
+
+
+def _wheels_in(d: str) -> List[WheelInfo]:
+    wheels: List[WheelInfo] = []
+    if not os.path.isdir(d):
+        return wheels
+    for filename in sorted(os.listdir(d)):
+        if filename.endswith('.whl'):
+            try:
+                wheels.append(parse_wheel_filename(os.path.join(d, filename)))
+            except WheelError:
+                continue
+    return wheels
+
+
+def find_wheels(
+    dirs: Iterable[str],
+    names: Iterable[str],
+    python_version: Optional[str] = None,
+    platform_arch: Optional[str] = None,
+) -> Dict[str, WheelInfo]:
+    """Find the newest wheel of each project in names among dirs
+
+    Earlier directories take precedence over later ones. With python_version
+    and platform_arch, incompatible wheels are ignored.
+    """
+    wanted = {normalize_name(n) for n in names}
+    found: Dict[str, WheelInfo] = {}
+    for d in dirs:
+        candidates: Dict[str, WheelInfo] = {}
+        for info in _wheels_in(d):
+            key = normalize_name(info.name)
+            if key not in wanted or key in found:
+                continue
+            if python_version and platform_arch and not is_compatible(info, python_version, platform_arch):
+                continue
+            if key not in candidates or _version_key(info.version) > _version_key(candidates[key].version):
+                candidates[key] = info
+        found.update(candidates)
+    return found
+
+
+class Requirement(NamedTuple):
+    name: str
+    version: Optional[str]
+
+
+def parse_requirements(path: str) -> List[Requirement]:
+    """Parse a requirements file of bare or '=='-pinned project names
+
+    Environment markers, extras and hashes are ignored and '-r' includes are
+    followed. Dependencies are not resolved, so the file should be complete
+    like the output of 'pip freeze'.
+    """
+    requirements: List[Requirement] = []
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        if line.startswith(('-r ', '--requirement ')):
+            include = line.split(None, 1)[1].strip()
+            requirements.extend(parse_requirements(os.path.join(os.path.dirname(path), include)))
+            continue
+        if line.startswith('-'):
+            logger.warning(f"Ignoring the option line {line!r} in {path}")
+            continue
+        line = line.split(';')[0].split(' --')[0].strip()
+        match = REQUIREMENT_RE.match(line)
+        if match is None:
+            raise WheelError(f'Unsupported requirement {line!r} in {path}: only NAME or NAME==VERSION')
+        requirements.append(Requirement(match.group('name'), match.group('version')))
+    return requirements
+
+
+def select_wheels(
+    requirements: Iterable[Requirement],
+    dirs: Iterable[str],
+    python_version: str,
+    platform_arch: str,
+) -> List[WheelInfo]:
+    """Returns the newest compatible wheel in dirs for each requirement"""
+    wheels = [
+        info for d in dirs for info in _wheels_in(d)
+        if is_compatible(info, python_version, platform_arch)
+    ]
+    selected: List[WheelInfo] = []
+    missing: List[str] = []
+    for req in requirements:
+        candidates = [
+            info for info in wheels
+            if normalize_name(info.name) == normalize_name(req.name) and (
+                req.version is None or _version_key(info.version) == _version_key(req.version)
+            )
+        ]
+        if not candidates:
+            missing.append(req.name if req.version is None else f'{req.name}=={req.version}')
+            continue
+        selected.append(max(candidates, key=lambda info: _version_key(info.version)))
+    if missing:
+        raise WheelError(f'No compatible wheel found for {", ".join(missing)}')
+    return selected
+
+
+def _record_hash(digest: bytes) -> str:
+    return 'sha256=' + base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def _write(dst: str, src: IO[bytes]) -> Tuple[str, int]:
+    """Write src to dst as a new file and returns its RECORD hash and size"""
+    h = hashlib.sha256()
+    size = 0
+    if os.path.lexists(dst):
+        os.remove(dst)
+    with open(dst, 'wb') as f:
+        for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), b''):
+            h.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return _record_hash(h.digest()), size
+
+
+def _file_record(path: str) -> Tuple[str, int]:
+    with open(path, 'rb') as f:
+        contents = f.read()
+    return _record_hash(hashlib.sha256(contents).digest()), len(contents)
+
+
+def _shebang(python_exe: str) -> bytes:
+    exe = f'"{python_exe}"' if ' ' in python_exe else python_exe
+    return b'#!' + exe.encode('utf-8') + b'\n'
+
+
+def write_entry_point(
+    scripts_dir: str,
+    name: str,
+    spec: str,
+    python_exe: str,
+    launcher: Optional[bytes] = None,
+) -> str:
+    """Write a console or gui script for the entry point spec ('module:attr')
+
+    With a distlib launcher, a Windows .exe is written like pip does;
+    otherwise a script with a shebang line.
+    Returns the path of the script.
+    """
+    module, _, attr = spec.partition(':')
+    attr = attr.split('[')[0].strip()
+    script = SCRIPT_TEMPLATE.format(
+        module=module.strip(),
+        import_name=attr.split('.')[0],
+        func=attr,
+    ).encode('utf-8')
+    if launcher is not None:
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('__main__.py', script)
+        path = os.path.join(scripts_dir, f'{name}.exe')
+        contents = launcher + _shebang(python_exe) + archive.getvalue()
+    else:
+        path = os.path.join(scripts_dir, name)
+        contents = _shebang(python_exe) + script
+    if os.path.lexists(path):
+        os.remove(path)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    if launcher is None:
+        os.chmod(path, 0o755)
+    return path
+
+
+def find_launchers(site_packages: str, platform_arch: str) -> Optional[Tuple[bytes, bytes]]:
+    """Returns the console and gui launchers vendored by pip in site_packages"""
+    names = LAUNCHERS.get(platform_arch)
+    if names is None:
+        return None
+    distlib = os.path.join(site_packages, 'pip', '_vendor', 'distlib')
+    try:
+        launchers = []
+        for name in names:
+            with open(os.path.join(distlib, name), 'rb') as f:
+                launchers.append(f.read())
+    except OSError:
+        return None
+    return launchers[0], launchers[1]
+
+
+class _ZipSource:
+    """Members of a wheel read from the wheel itself"""
+
+    def __init__(self, wheel: str):
+        self.zf = zipfile.ZipFile(wheel)
+
+    def names(self) -> List[str]:
+        return [info.filename for info in self.zf.infolist() if not info.is_dir()]
+
+    def open(self, name: str) -> IO[bytes]:
+        return self.zf.open(name)
+
+    def path(self, name: str) -> Optional[str]:
+        return None
+
+    def close(self) -> None:
+        self.zf.close()
+
+
+class _DirSource:
+    """Members of a wheel read from its unpacked tree"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def names(self) -> List[str]:
+        names: List[str] = []
+        for dirpath, _, files in os.walk(self.root):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            names.extend(name if rel == '.' else f'{rel}/{name}' for name in files)
+        return sorted(names)
+
+    def open(self, name: str) -> IO[bytes]:
+        return open(member_path(self.root, name), 'rb')
+
+    def path(self, name: str) -> Optional[str]:
+        return member_path(self.root, name)
+
+    def close(self) -> None:
+        pass
+
+
+def install_wheel(
+    wheel: str,
+    env_dir: str,
+    site_packages: str,
+    scripts_dir: str,
+    python_exe: str,
+    launchers: Optional[Tuple[bytes, bytes]] = None,
+    platform_arch: Optional[str] = None,
+    unpacked: Optional[str] = None,
+    link: Optional[Callable[[str, str], None]] = None,
+) -> List[str]:
+    """Unpack a wheel into site_packages and write its RECORD and scripts
+
+    Without launchers, those of pip in site_packages (which may just have
+    been unpacked) are used for platform_arch if it is given.
+    With unpacked, the members are taken from that unpacked tree of the wheel
+    and placed with link (e.g. a Cloner) instead of being decompressed again.
+    Returns the paths of the installed files.
+    """
+    info = parse_wheel_filename(wheel)
+    data_targets = {
+        'purelib': site_packages,
+        'platlib': site_packages,
+        'scripts': scripts_dir,
+        'headers': os.path.join(env_dir, 'Include', info.name),
+        'data': env_dir,
+    }
+    installed: List[Tuple[str, str, int]] = []
+    source: Union[_ZipSource, _DirSource] = _DirSource(unpacked) if unpacked is not None else _ZipSource(wheel)
+    try:
+        names = source.names()
+        top_level = {n.split('/')[0] for n in names if '/' in n}
+        dist_info = next((d + '/' for d in top_level if d.endswith('.dist-info')), None)
+        if dist_info is None:
+            raise WheelError(f'No .dist-info directory in {wheel}')
+        data_prefix = dist_info[:-len('.dist-info/')] + '.data/'
+        records: Dict[str, Tuple[str, int]] = {}
+        if dist_info + 'RECORD' in names and link is not None:
+            with source.open(dist_info + 'RECORD') as f:
+                for row in csv.reader(io.TextIOWrapper(f, encoding='utf-8')):
+                    if len(row) == 3 and row[1] and row[2].isdigit():
+                        records[row[0]] = (row[1], int(row[2]))
+        for name in names:
+            if name == dist_info + 'RECORD':
+                continue
+            if name.startswith(data_prefix):
+                scheme, _, rel = name[len(data_prefix):].partition('/')
+                if scheme not in data_targets:
+                    raise WheelError(f'Unknown data scheme {scheme!r} in {wheel}')
+                target = member_path(data_targets[scheme], rel)
+            else:
+                target = member_path(site_packages, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            src_path = source.path(name)
+            if name.startswith(data_prefix + 'scripts/'):
+                with source.open(name) as src:
+                    first = src.readline()
+                    if first.startswith(b'#!python'):
+                        first = _shebang(python_exe)
+                    digest, size = _write(target, io.BytesIO(first + src.read()))
+            elif link is not None and src_path is not None:
+                if os.path.lexists(target):
+                    remove_file(target)
+                link(src_path, target)
+                digest, size = records[name] if name in records else _file_record(target)
+            else:
+                with source.open(name) as src:
+                    digest, size = _write(target, src)
+            installed.append((target, digest, size))
+        entry_points = configparser.ConfigParser(delimiters=('=',))
+        entry_points.optionxform = str  # type: ignore
+        if dist_info + 'entry_points.txt' in names:
+            with source.open(dist_info + 'entry_points.txt') as f:
+                entry_points.read_string(f.read().decode('utf-8'))
+    finally:
+        source.close()
+    if launchers is None and platform_arch is not None:
+        launchers = find_launchers(site_packages, platform_arch)
+    for section, launcher in (('console_scripts', 0), ('gui_scripts', 1)):
+        if not entry_points.has_section(section):
+            continue
+        for name, spec in entry_points.items(section):
+            path = write_entry_point(
+                scripts_dir,
+                name,
+                spec,
+                python_exe,
+                launchers[launcher] if launchers is not None else None,
+            )
+            installed.append((path, *_file_record(path)))
+    dist_info_dir = member_path(site_packages, dist_info)
+    installer_path = os.path.join(dist_info_dir, 'INSTALLER')
+    with open(installer_path, 'w') as f:
+        f.write(INSTALLER + '\n')
+    installed.append((installer_path, *_file_record(installer_path)))
+    record_path = os.path.join(dist_info_dir, 'RECORD')
+    with open(record_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for path, digest, size in installed:
+            rel = os.path.relpath(path, site_packages).replace(os.sep, '/')
+            writer.writerow((rel, digest, size))
+        writer.writerow((os.path.relpath(record_path, site_packages).replace(os.sep, '/'), '', ''))
+    logger.debug(f"Installed {os.path.basename(wheel)} ({len(installed)} files)")
+    return [path for path, _, _ in installed] + [record_path]
+
+
+class WheelStore:
+    """Wheels unpacked once under ``<root>/<sha256 of the wheel>/``
+
+    Environments are populated by cloning the unpacked files (reflink,
+    hardlink or copy, see Cloner) instead of decompressing every wheel again.
+    Hardlinked files are made read-only like the objects of a PackageStore,
+    so that writing to one in an environment fails instead of changing the
+    store for every environment installed from it later.
+    """
+
+    def __init__(self, root: str, link_mode: str = 'auto'):
+        self.root = root
+        self.link_mode = link_mode
+
+    def unpacked(self, wheel: str) -> str:
+        """Returns the unpacked tree of wheel, unpacking it on first use"""
+        sha256 = sha256_file(wheel)
+        path = os.path.join(self.root, sha256[:2], sha256)
+        if os.path.isdir(path):
+            return path
+        tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        extract_zip(wheel, tmp_path)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # unpacked concurrently by someone else
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.debug(f"Unpacked {os.path.basename(wheel)} into the wheel store")
+        return path
+
+    def install(
+        self,
+        wheel: str,
+        env_dir: str,
+        site_packages: str,
+        scripts_dir: str,
+        python_exe: str,
+        launchers: Optional[Tuple[bytes, bytes]] = None,
+    ) -> List[str]:
+        cloner = Cloner(self.link_mode)
+
+        def link(src: str, dst: str) -> None:
+            cloner(src, dst)
+            if cloner.methods[0] == 'hardlink':
+                protect(dst)
+
+        return install_wheel(
+            wheel,
+            env_dir,
+            site_packages,
+            scripts_dir,
+            python_exe,
+            launchers=launchers,
+            unpacked=self.unpacked(wheel),
+            link=link,
+        )
+
+
+def install_wheels(
+    wheels: Iterable[str],
+    env_dir: str,
+    site_packages: str,
+    scripts_dir: str,
+    python_exe: str,
+    platform_arch: Optional[str] = None,
+    store: Optional[WheelStore] = None,
+    max_workers: int = DEFAULT_INSTALL_WORKERS,
+) -> List[str]:
+    """Install several wheels concurrently
+
+    The launchers of the entry point scripts are looked up in site_packages
+    once beforehand, so pip should already be installed.
+    Returns the paths of the installed files.
+    """
+    launchers = find_launchers(site_packages, platform_arch) if platform_arch is not None else None
+
+    def install(wheel: str) -> List[str]:
+        if store is not None:
+            return store.install(wheel, env_dir, site_packages, scripts_dir, python_exe, launchers)
+        return install_wheel(wheel, env_dir, site_packages, scripts_dir, python_exe, launchers)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return [path for paths in executor.map(install, wheels) for path in paths]
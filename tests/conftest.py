@@ -0,0 +1,39 @@
+import threading
+from http.server import ThreadingHTTPServer
+from functools import partial
+from typing import Generator, List
+from types import SimpleNamespace
+
+import pytest
+
+from tests.http_server import RangeRequestHandler
+
+
+@pytest.fixture(autouse=True)
+def downloads_dir(tmp_path, monkeypatch) -> str:
+    """Keep the interrupted downloads of a test from being resumed by other tests"""
+    path = str(tmp_path / 'downloads')
+    monkeypatch.setattr('penv.DOWNLOADS_DIR', path)
+    return path
+
+
+@pytest.fixture(scope='function')
+def http_server(tmp_path) -> Generator[SimpleNamespace, None, None]:
+    """A local stand-in for python.org serving files from a temporary directory"""
+    root = tmp_path / 'www'
+    root.mkdir()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=str(root)))
+    server.daemon_threads = True
+    requests: List[tuple] = []
+    server.requests = requests  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    try:
+        yield SimpleNamespace(
+            root=str(root),
+            url=f'http://127.0.0.1:{server.server_address[1]}',
+            requests=requests,
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,62 @@
+"""Local file server shared by the tests and the benchmarks."""
+import os
+import re
+from http.server import SimpleHTTPRequestHandler
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler with keep-alive and single Range support, like python.org
+
+    The requests are recorded as (method, path, Range header) in the
+    ``requests`` list of the server if it has one.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # noqa: A002
+        requests = getattr(self.server, 'requests', None)
+        if requests is not None:
+            requests.append((self.command, self.path, self.headers.get('Range')))
+
+    def send_head(self):  # type: ignore
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # a directory listing like https://www.python.org/ftp/python/
+            f = super().send_head()
+            self._remaining = len(f.getvalue()) if f is not None else 0
+            return f
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return None
+        size = os.path.getsize(path)
+        f = open(path, 'rb')
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            begin = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else size - 1
+            end = min(end, size - 1)
+            if begin >= size:
+                f.close()
+                self.send_error(416, 'Requested Range Not Satisfiable')
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {begin}-{end}/{size}')
+            f.seek(begin)
+            self._remaining = end - begin + 1
+        else:
+            self.send_response(200)
+            self._remaining = size
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(self._remaining))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = self._remaining
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
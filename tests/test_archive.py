@@ -0,0 +1,166 @@
+import io
+import mmap
+import os
+import pytest
+import zipfile
+from penv.archive import archive_entries, extract_zip, is_excluded, member_path, sync_zip
+from penv.download import Downloader, RangeFile
+
+
+def _make_zip(path: str, files: dict) -> str:
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('Lib/', '')
+        for name, payload in files.items():
+            zf.writestr(name, payload)
+    return path
+
+
+FILES = {
+    'python.exe': b'MZ' * 1000,
+    'python312._pth': b'python312.zip\n.\n#import site\n',
+    'Lib/empty.txt': b'',
+    'DLLs/_ssl.pyd': os.urandom(10_000),
+}
+
+
+def _assert_extracted(dest: str, files: dict) -> None:
+    for name, payload in files.items():
+        with open(os.path.join(dest, *name.split('/')), 'rb') as f:
+            assert f.read() == payload
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_extract_zip_from_path(tmp_path, max_workers: int):
+    archive = _make_zip(str(tmp_path / 'python.zip'), FILES)
+    written = extract_zip(archive, str(tmp_path / 'env'), max_workers=max_workers)
+    assert written == sum(len(p) for p in FILES.values())
+    _assert_extracted(str(tmp_path / 'env'), FILES)
+    assert os.path.isdir(tmp_path / 'env' / 'Lib')
+    # the archive is left where it was and nothing is copied next to the env
+    assert sorted(os.listdir(tmp_path)) == ['env', 'python.zip']
+
+
+def test_extract_zip_from_mmap(tmp_path):
+    archive = _make_zip(str(tmp_path / 'python.zip'), FILES)
+    with open(archive, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        extract_zip(m, str(tmp_path / 'env'), max_workers=4)
+    _assert_extracted(str(tmp_path / 'env'), FILES)
+
+
+def test_extract_zip_from_stream(tmp_path):
+    buffer = io.BytesIO()
+    _make_zip(buffer, FILES)  # type: ignore
+    extract_zip(buffer, str(tmp_path / 'env'), max_workers=4)
+    _assert_extracted(str(tmp_path / 'env'), FILES)
+
+
+def test_extract_zip_selected_members(tmp_path):
+    archive = _make_zip(str(tmp_path / 'python.zip'), FILES)
+    extract_zip(archive, str(tmp_path / 'env'), members=['python.exe'])
+    assert os.listdir(tmp_path / 'env') == ['python.exe']
+
+
+@pytest.mark.parametrize(
+    'name, expected',
+    [
+        ('python.exe', ['python.exe']),
+        ('Lib/site.py', ['Lib', 'site.py']),
+        ('../../evil.py', ['evil.py']),
+        ('/abs/evil.py', ['abs', 'evil.py']),
+        ('C:\\evil.py', ['evil.py']),
+    ]
+)
+def test_member_path(name: str, expected: list):
+    assert member_path('env', name) == os.path.join('env', *expected)
+
+
+def test_archive_entries(tmp_path):
+    archive = _make_zip(str(tmp_path / 'python.zip'), FILES)
+    entries = archive_entries(archive)
+    assert sorted(entries) == sorted(FILES)
+    assert entries['python.exe'] == {'size': 2000, 'crc32': zipfile.crc32(FILES['python.exe'])}
+
+
+def test_sync_zip(tmp_path):
+    # preparation
+    dest = str(tmp_path / 'env')
+    old_archive = _make_zip(str(tmp_path / 'old.zip'), {**FILES, 'python311.dll': b'old'})
+    entries, written, removed = sync_zip(old_archive, dest)
+    assert sorted(written) == sorted([*FILES, 'python311.dll'])
+    assert removed == []
+    with open(os.path.join(dest, 'python312._pth'), 'ab') as f:
+        f.write(b'patched\n')
+    shared = str(tmp_path / 'shared.exe')
+    os.link(os.path.join(dest, 'python.exe'), shared)
+    new_files = {**FILES, 'python.exe': b'MZ' * 1001, 'python312._pth': b'new\n', 'python312.dll': b'new'}
+    new_archive = _make_zip(str(tmp_path / 'new.zip'), new_files)
+    # execute
+    new_entries, written, removed = sync_zip(new_archive, dest, entries, skip=['*._pth'])
+    # assert
+    assert new_entries == archive_entries(new_archive)
+    assert sorted(written) == ['python.exe', 'python312.dll']
+    assert removed == ['python311.dll']
+    _assert_extracted(dest, {k: v for k, v in new_files.items() if k != 'python312._pth'})
+    with open(os.path.join(dest, 'python312._pth'), 'rb') as f:
+        assert f.read().endswith(b'patched\n')
+    # the hardlinked file was replaced, not rewritten
+    with open(shared, 'rb') as f:
+        assert f.read() == FILES['python.exe']
+
+
+def test_sync_zip_restores_missing_files(tmp_path):
+    dest = str(tmp_path / 'env')
+    archive = _make_zip(str(tmp_path / 'python.zip'), FILES)
+    entries, _, _ = sync_zip(archive, dest)
+    os.remove(os.path.join(dest, 'DLLs', '_ssl.pyd'))
+    with open(os.path.join(dest, 'python.exe'), 'wb') as f:
+        f.write(b'MZ')
+    _, written, _ = sync_zip(archive, dest, entries)
+    assert sorted(written) == ['DLLs/_ssl.pyd', 'python.exe']
+    _assert_extracted(dest, FILES)
+
+
+@pytest.mark.parametrize(
+    'key, exclude, expected',
+    [
+        ('DLLs/_ssl.pyd', ['_ssl.pyd'], True),
+        ('DLLs/_SSL.pyd', ['*.pyd'], True),
+        ('DLLs/_ssl.pyd', ['Lib/*'], False),
+        ('python.exe', ['*.exe'], False),
+        ('python312.zip', ['*'], False),
+        ('pythonw.exe', ['*.exe'], True),
+    ]
+)
+def test_is_excluded(key: str, exclude: list, expected: bool):
+    assert is_excluded(key, exclude) == expected
+
+
+def test_sync_zip_exclude(tmp_path):
+    dest = str(tmp_path / 'env')
+    archive = _make_zip(str(tmp_path / 'python.zip'), FILES)
+    entries, written, _ = sync_zip(archive, dest, exclude=['*.pyd', 'python.exe'])
+    assert sorted(written) == sorted(set(FILES) - {'DLLs/_ssl.pyd'})
+    assert not os.path.exists(os.path.join(dest, 'DLLs', '_ssl.pyd'))
+    # a narrower profile adds the members, a wider one removes them
+    entries, written, removed = sync_zip(archive, dest, entries)
+    assert (written, removed) == (['DLLs/_ssl.pyd'], [])
+    _, written, removed = sync_zip(archive, dest, entries, exclude=['*.txt'])
+    assert (written, removed) == ([], ['Lib/empty.txt'])
+
+
+def test_extract_zip_from_range_file(http_server, tmp_path):
+    # preparation
+    files = {**FILES, 'DLLs/big.pyd': os.urandom(1_000_000)}
+    archive = _make_zip(os.path.join(http_server.root, 'python.zip'), files)
+    wanted = {k: v for k, v in files.items() if k != 'DLLs/big.pyd'}
+    # execute
+    with Downloader(connections=2, segment_size=1000) as d:
+        remote = RangeFile(f'{http_server.url}/python.zip', d)
+        _, written, _ = sync_zip(remote, str(tmp_path / 'env'), exclude=['big.pyd'])
+    # assert
+    assert sorted(written) == sorted(wanted)
+    _assert_extracted(str(tmp_path / 'env'), wanted)
+    assert remote.size == os.path.getsize(archive)
+    # the excluded member was not transferred
+    assert remote.transferred < 100_000
+    assert all(method in ('HEAD', 'GET') and (method == 'HEAD' or rng) for method, _, rng in http_server.requests)
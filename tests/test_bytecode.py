@@ -0,0 +1,62 @@
+import os
+import pytest
+import subprocess
+import sys
+from types import SimpleNamespace
+from penv import EmbeddableEnvBuilder
+from penv.bytecode import compileall_args, count_bytecode
+
+
+def _make_site_packages(env_dir: str) -> str:
+    site_packages = os.path.join(env_dir, 'Lib', 'site-packages')
+    os.makedirs(os.path.join(site_packages, 'pkg'))
+    for name in ('__init__.py', 'a.py', 'b.py'):
+        with open(os.path.join(site_packages, 'pkg', name), 'w') as f:
+            f.write('x = 1\n')
+    with open(os.path.join(site_packages, 'mod.py'), 'w') as f:
+        f.write('y = 2\n')
+    return site_packages
+
+
+def test_compileall_args():
+    assert compileall_args('site-packages') == ['-m', 'compileall', '-q', '-j', '0', 'site-packages']
+    assert compileall_args('site-packages', 'unchecked-hash', workers=2) == [
+        '-m', 'compileall', '-q', '-j', '2', '--invalidation-mode', 'unchecked-hash', 'site-packages',
+    ]
+    with pytest.raises(ValueError):
+        compileall_args('site-packages', 'never')
+
+
+@pytest.mark.parametrize('invalidation_mode, flags', [('timestamp', 0), ('unchecked-hash', 1)])
+def test_compileall_args_compile(tmp_path, invalidation_mode: str, flags: int):
+    site_packages = _make_site_packages(str(tmp_path))
+    assert count_bytecode(site_packages) == 0
+    subprocess.check_call([sys.executable, *compileall_args(site_packages, invalidation_mode, workers=2)])
+    assert count_bytecode(site_packages) == 4
+    pycache = os.path.join(site_packages, 'pkg', '__pycache__')
+    with open(os.path.join(pycache, sorted(os.listdir(pycache))[0]), 'rb') as f:
+        # the PEP 552 flags word follows the magic number
+        assert int.from_bytes(f.read(8)[4:], 'little') == flags
+
+
+def test_embeddable_env_builder_compile_site_packages(tmp_path, mocker, caplog):
+    # preparation
+    site_packages = _make_site_packages(str(tmp_path))
+    with open(os.path.join(site_packages, 'broken.py'), 'w') as f:
+        f.write('print "python 2"\n')
+
+    def call_new_python(self, context, *py_args, **kwargs):
+        subprocess.check_output([sys.executable, *py_args], **kwargs)
+
+    mock_call = mocker.patch.object(EmbeddableEnvBuilder, '_call_new_python', autospec=True, side_effect=call_new_python)
+    builder = EmbeddableEnvBuilder(compile_bytecode=True, invalidation_mode='unchecked-hash')
+    context = SimpleNamespace(env_dir=str(tmp_path))
+    # execute
+    with caplog.at_level('INFO', logger='penv'):
+        compiled = builder.compile_site_packages(context)
+    # assert
+    assert compiled == 4
+    assert '--invalidation-mode' in mock_call.call_args[0]
+    assert 'could not be compiled' in caplog.text
+    assert f'Compiled 4 files in {site_packages}' in caplog.text
+    assert builder._template_key().endswith('-pyc-unchecked-hash')
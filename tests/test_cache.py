@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import pytest
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import penv
+from penv import EmbeddableEnvBuilder, main
+from penv.cache import ArchiveCache, INDEX_FILE, parse_size
+from penv.download import Downloader
+
+
+def _make_file(path: str, payload: bytes) -> str:
+    with open(path, 'wb') as f:
+        f.write(payload)
+    return path
+
+
+@pytest.mark.parametrize(
+    'value, expected',
+    [
+        ('0', 0),
+        ('1024', 1024),
+        ('10K', 10 * 1024),
+        ('500M', 500 * 1024 ** 2),
+        ('2GiB', 2 * 1024 ** 3),
+    ]
+)
+def test_parse_size(value: str, expected: int):
+    assert parse_size(value) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size('big')
+
+
+def test_archive_cache_add_and_lookup(tmp_path):
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    payload = b'embeddable python'
+    path = _make_file(str(tmp_path / 'python.zip'), payload)
+    assert cache.lookup('python.zip') is None
+    stored = cache.add('python.zip', path, python_version='3.12.1', platform_arch='amd64')
+    sha256 = hashlib.sha256(payload).hexdigest()
+    assert stored == cache.object_path(sha256)
+    assert not os.path.exists(path)
+    assert cache.lookup('python.zip') == stored
+    with open(tmp_path / 'cache' / INDEX_FILE) as f:
+        entry = json.load(f)['entries']['python.zip']
+    assert entry['sha256'] == sha256
+    assert entry['size'] == len(payload)
+    assert entry['python_version'] == '3.12.1'
+    assert entry['platform_arch'] == 'amd64'
+
+
+def test_archive_cache_fetch_hashes_while_streaming(http_server: SimpleNamespace, tmp_path):
+    payload = os.urandom(50_000)
+    _make_file(os.path.join(http_server.root, 'python.zip'), payload)
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    with Downloader(connections=4, segment_size=4096) as d:
+        stored = cache.fetch('python.zip', f'{http_server.url}/python.zip', d)
+    assert stored == cache.object_path(hashlib.sha256(payload).hexdigest())
+    with open(stored, 'rb') as f:
+        assert f.read() == payload
+    assert os.listdir(cache.tmp_dir) == []
+
+
+def test_archive_cache_fetch_resumes_interrupted_download(http_server: SimpleNamespace, tmp_path):
+    payload = os.urandom(5000)
+    _make_file(os.path.join(http_server.root, 'python.zip'), payload)
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    os.makedirs(cache.tmp_dir)
+    # left by a fetch which was interrupted
+    _make_file(os.path.join(cache.tmp_dir, 'python.zip.part'), payload[:3000])
+    with open(os.path.join(cache.tmp_dir, 'python.zip.part.json'), 'w') as f:
+        json.dump({'mode': 'stream', 'size': 5000, 'etag': None}, f)
+    with Downloader(connections=1) as d:
+        stored = cache.fetch('python.zip', f'{http_server.url}/python.zip', d)
+    assert stored == cache.object_path(hashlib.sha256(payload).hexdigest())
+    assert ('GET', '/python.zip', 'bytes=3000-') in http_server.requests
+    assert os.listdir(cache.tmp_dir) == []
+
+
+def test_archive_cache_prune_removes_stale_downloads(tmp_path):
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    os.makedirs(cache.tmp_dir)
+    stale = _make_file(os.path.join(cache.tmp_dir, 'a.zip.part'), b'a')
+    os.utime(stale, (time.time() - 8 * 24 * 3600,) * 2)
+    recent = _make_file(os.path.join(cache.tmp_dir, 'b.zip.part'), b'b')
+    locked = _make_file(os.path.join(cache.tmp_dir, 'c.zip.part'), b'c')
+    os.utime(locked, (time.time() - 8 * 24 * 3600,) * 2)
+    with cache.lock('c.zip'):
+        cache.prune()
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)
+    assert os.path.exists(locked)
+
+
+def test_archive_cache_lookup_drops_truncated_object(tmp_path):
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    stored = cache.add('python.zip', _make_file(str(tmp_path / 'python.zip'), b'0123456789'))
+    with open(stored, 'wb') as f:
+        f.write(b'01234')
+    assert cache.lookup('python.zip') is None
+    assert cache.entries() == []
+
+
+def test_archive_cache_lru_eviction(tmp_path):
+    cache = ArchiveCache(str(tmp_path / 'cache'), max_size=25)
+    for i, name in enumerate(['a.zip', 'b.zip', 'c.zip']):
+        cache.add(name, _make_file(str(tmp_path / name), bytes([i]) * 10))
+        if name == 'b.zip':
+            # use a.zip so that b.zip becomes the least recently used one
+            assert cache.lookup('a.zip') is not None
+    assert {e.name for e in cache.entries()} == {'a.zip', 'c.zip'}
+    assert not os.path.exists(cache.object_path(hashlib.sha256(bytes([1]) * 10).hexdigest()))
+
+
+def test_archive_cache_deduplicates_identical_archives(tmp_path):
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    a = cache.add('a.zip', _make_file(str(tmp_path / 'a.zip'), b'same'))
+    b = cache.add('b.zip', _make_file(str(tmp_path / 'b.zip'), b'same'))
+    assert a == b
+    assert cache.prune(max_size=4) == []
+
+
+def test_archive_cache_verify(tmp_path):
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    good = cache.add('good.zip', _make_file(str(tmp_path / 'good.zip'), b'good'))
+    bad = cache.add('bad.zip', _make_file(str(tmp_path / 'bad.zip'), b'bad!'))
+    with open(bad, 'wb') as f:
+        f.write(b'evil')
+    assert cache.verify() == ['bad.zip']
+    assert [e.name for e in cache.entries()] == ['good.zip']
+    assert os.path.exists(good)
+    assert not os.path.exists(bad)
+
+
+def test_main_cache_subcommand(tmp_path, capsys):
+    cache_dir = str(tmp_path / 'cache')
+    ArchiveCache(cache_dir).add('a.zip', _make_file(str(tmp_path / 'a.zip'), b'a' * 10))
+    ArchiveCache(cache_dir).add('b.zip', _make_file(str(tmp_path / 'b.zip'), b'b' * 10))
+    main(['cache', 'list', '--cache-dir', cache_dir])
+    assert {line.split('\t')[0] for line in capsys.readouterr().out.splitlines()} == {'a.zip', 'b.zip'}
+    main(['cache', 'verify', '--cache-dir', cache_dir])
+    main(['cache', 'prune', '--cache-dir', cache_dir, '--max-size', '10'])
+    assert len(ArchiveCache(cache_dir).entries()) == 1
+
+
+def test_archive_cache_download_is_shared_by_builders(tmp_path, mocker):
+    # preparation
+    cache_dir = str(tmp_path / 'cache')
+    zip_name = 'python-3.8.5-embed-amd64.zip'
+
+    def fake_download(url, dest, downloader, hasher, mirrors):
+        time.sleep(0.05)
+        hasher.update(b'zip')
+        _make_file(dest, b'zip')
+
+    mock_download = mocker.patch('penv.cache.download', side_effect=fake_download)
+    # builders do not share their in-process flights, like separate processes
+    builders = [EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', cache_dir=cache_dir) for _ in range(4)]
+    # execute
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        paths = list(executor.map(lambda builder: builder._cached_archive(zip_name, 'https://example.com/' + zip_name), builders))
+    # assert
+    assert mock_download.call_count == 1
+    assert len(set(paths)) == 1
+    assert ArchiveCache(cache_dir).lookup(zip_name) == paths[0]
+
+
+def test_archive_cache_prune_keeps_object_which_can_not_be_removed(tmp_path, mocker):
+    cache = ArchiveCache(str(tmp_path / 'cache'), max_size=10)
+    first = cache.add('a.zip', _make_file(str(tmp_path / 'a.zip'), b'a' * 10))
+    # a.zip is open in another process on Windows
+    remove = os.remove
+
+    def locked_remove(path):
+        if path == first:
+            raise PermissionError(path)
+        remove(path)
+
+    mocker.patch('penv.cache.os.remove', side_effect=locked_remove)
+    cache.add('b.zip', _make_file(str(tmp_path / 'b.zip'), b'b' * 10))
+    assert [entry.name for entry in cache.entries()] == ['b.zip']
+    assert os.path.exists(first)
+    mocker.stopall()
+    cache.prune()
+    assert not os.path.exists(first)
+
+
+def test_embeddable_env_builder_fetches_archive_evicted_while_extracted(tmp_path, mocker):
+    # preparation
+    cache_dir = str(tmp_path / 'cache')
+    zip_name = 'python-3.8.5-embed-amd64.zip'
+    with zipfile.ZipFile(tmp_path / zip_name, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+    with open(tmp_path / zip_name, 'rb') as f:
+        payload = f.read()
+    cache = ArchiveCache(cache_dir)
+    cache.add(zip_name, str(tmp_path / zip_name))
+
+    def fake_download(url, dest, downloader, hasher, mirrors):
+        hasher.update(payload)
+        _make_file(dest, payload)
+
+    mock_download = mocker.patch('penv.cache.download', side_effect=fake_download)
+    sync_zip = penv.sync_zip
+
+    def evicted_once(source, *args, **kwargs):
+        if mock_sync_zip.call_count == 1:
+            # pruned by another process since the lookup
+            cache.prune(0)
+            raise FileNotFoundError(source)
+        return sync_zip(source, *args, **kwargs)
+
+    mock_sync_zip = mocker.patch('penv.sync_zip', side_effect=evicted_once)
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', cache_dir=cache_dir)
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    # execute
+    builder.setup_python(context)
+    # assert
+    assert mock_sync_zip.call_count == 2
+    assert mock_download.call_count == 1
+    assert os.path.exists(os.path.join(context.env_dir, 'python.exe'))
@@ -0,0 +1,122 @@
+import os
+import zipfile
+import pytest
+import penv.clone
+from penv import EmbeddableEnvBuilder, main
+from penv.cache import ArchiveCache
+from penv.clone import clone_env
+from penv.manifest import load_manifest, record_files, verify_env
+
+
+def _make_env(env_dir: str, record_patch_files: bool = True) -> None:
+    os.makedirs(os.path.join(env_dir, 'Scripts'))
+    with open(os.path.join(env_dir, 'python.exe'), 'wb') as f:
+        f.write(b'MZ' * 1000)
+    with open(os.path.join(env_dir, 'Scripts', 'pip.exe'), 'wb') as f:
+        f.write(b'#!' + os.path.join(env_dir, 'python.exe').encode() + b'\n')
+    extra = {'origin': env_dir, 'patch_files': [os.path.join('Scripts', 'pip.exe')]} if record_patch_files else None
+    record_files(env_dir, extra=extra)
+
+
+@pytest.mark.parametrize('record_patch_files', [True, False])
+def test_clone_env(tmp_path, record_patch_files: bool):
+    # preparation
+    src, dst = str(tmp_path / 'golden'), str(tmp_path / 'user1')
+    _make_env(src, record_patch_files)
+    # execute
+    counts = clone_env(src, dst, mode='hardlink')
+    # assert
+    assert counts == {'hardlink': 1, 'patched': 1}
+    assert os.path.samefile(os.path.join(src, 'python.exe'), os.path.join(dst, 'python.exe'))
+    with open(os.path.join(dst, 'Scripts', 'pip.exe'), 'rb') as f:
+        assert f.read() == b'#!' + os.path.join(dst, 'python.exe').encode() + b'\n'
+    with open(os.path.join(src, 'Scripts', 'pip.exe'), 'rb') as f:
+        assert f.read() == b'#!' + os.path.join(src, 'python.exe').encode() + b'\n'
+    manifest = load_manifest(dst)
+    assert manifest is not None
+    assert manifest['origin'] == dst
+    assert manifest['patch_files'] == [os.path.join('Scripts', 'pip.exe')]
+    assert verify_env(dst).ok
+
+
+def test_clone_env_errors(tmp_path):
+    src, dst = str(tmp_path / 'golden'), str(tmp_path / 'user1')
+    os.makedirs(src)
+    with pytest.raises(ValueError, match='not an environment'):
+        clone_env(src, dst)
+    _make_env(str(tmp_path / 'other'))
+    os.makedirs(dst)
+    with open(os.path.join(dst, 'file'), 'w') as f:
+        f.write('')
+    with pytest.raises(ValueError, match='not empty'):
+        clone_env(str(tmp_path / 'other'), dst)
+
+
+def test_clone_main(tmp_path):
+    src, dst = str(tmp_path / 'golden'), str(tmp_path / 'user1')
+    _make_env(src)
+    main(['clone', src, dst, '--link-mode', 'copy'])
+    # a clone of a clone is relocated from its own location
+    main(['clone', dst, str(tmp_path / 'user2')])
+    with open(os.path.join(tmp_path, 'user2', 'Scripts', 'pip.exe'), 'rb') as f:
+        assert str(tmp_path / 'user2').encode() in f.read()
+
+
+def test_embeddable_env_builder_records_patch_points(tmp_path, mocker):
+    # preparation
+    zip_path = str(tmp_path / 'python-3.8.5-embed-amd64.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+    cache_dir = str(tmp_path / 'cache')
+    ArchiveCache(cache_dir).add('python-3.8.5-embed-amd64.zip', zip_path)
+
+    def install(self, context):
+        with open(os.path.join(context.env_dir, 'Scripts', 'tool.exe'), 'w') as f:
+            f.write(f'#!{context.env_exe}\n')
+
+    mocker.patch.object(EmbeddableEnvBuilder, 'post_setup', autospec=True, side_effect=install)
+    mocker.patch.object(EmbeddableEnvBuilder, '_patch_scripts', autospec=True)
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', cache_dir=cache_dir)
+    env1, env2 = str(tmp_path / 'env1'), str(tmp_path / 'env2')
+    # execute
+    builder.create(env1)
+    builder.create(env2)
+    # assert
+    for env_dir in (env1, env2):
+        manifest = load_manifest(env_dir)
+        assert manifest is not None
+        assert manifest['origin'] == env_dir
+        assert os.path.join('Scripts', 'tool.exe') in manifest['patch_files']
+    # cloned from the template, whose copy of tool.exe was relocated
+    with open(os.path.join(env2, 'Scripts', 'tool.exe')) as f:
+        assert env2 in f.read()
+
+
+def test_embeddable_env_builder_leaves_patch_points_to_clone(tmp_path, mocker):
+    # preparation
+    zip_path = str(tmp_path / 'python-3.8.5-embed-amd64.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+    cache_dir = str(tmp_path / 'cache')
+    ArchiveCache(cache_dir).add('python-3.8.5-embed-amd64.zip', zip_path)
+
+    def install(self, context):
+        with open(os.path.join(context.env_dir, 'Scripts', 'tool.exe'), 'w') as f:
+            f.write(f'#!{context.env_exe}\n')
+
+    mocker.patch.object(EmbeddableEnvBuilder, 'post_setup', autospec=True, side_effect=install)
+    mocker.patch.object(EmbeddableEnvBuilder, '_patch_scripts', autospec=True)
+    scan = mocker.spy(penv.clone, 'find_patch_points')
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', cache_dir=cache_dir, use_templates=False)
+    src, dst = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    # execute
+    builder.create(src)
+    # assert: a create without a template does not read every file for its patch points
+    assert load_manifest(src)['patch_files'] is None  # type: ignore
+    clone_env(src, dst, mode='copy')
+    assert scan.call_count == 1
+    assert os.path.join('Scripts', 'tool.exe') in load_manifest(dst)['patch_files']  # type: ignore
+    with open(os.path.join(dst, 'Scripts', 'tool.exe')) as f:
+        assert dst in f.read()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+import pytest
+import sys
+import threading
+from typing import Generator
+from types import SimpleNamespace
+from penv import EmbeddableEnvBuilder, _parse_options, main
+from penv.daemon import Daemon, parse_address, request, token_path
+
+
+@pytest.fixture(scope='function')
+def daemon(tmp_path, monkeypatch) -> Generator[SimpleNamespace, None, None]:
+    monkeypatch.setattr('penv.daemon.TOKEN_DIR', str(tmp_path / 'tokens'))
+    monkeypatch.delenv('PENV_DAEMON_TOKEN', raising=False)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    instance = Daemon(jobs=2)
+    server = asyncio.run_coroutine_threadsafe(instance.start('127.0.0.1:0'), loop).result()
+    try:
+        yield SimpleNamespace(daemon=instance, address=f"127.0.0.1:{server.sockets[0].getsockname()[1]}")
+    finally:
+        server.close()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        instance.close()
+
+
+def test_parse_address():
+    assert parse_address('127.0.0.1:7439') == ('tcp', ('127.0.0.1', 7439))
+    assert parse_address(':7439') == ('tcp', ('127.0.0.1', 7439))
+    if sys.platform != 'win32':
+        assert parse_address('/run/penv.sock') == ('unix', '/run/penv.sock')
+
+
+def test_main_daemon(daemon: SimpleNamespace, tmp_path, mocker):
+    # preparation
+    mocker.patch('penv.os.name', 'nt')
+
+    def fake_create(self, env_dir):
+        with self.profiler.phase('create', env_dir):
+            if os.path.basename(env_dir) == 'broken':
+                raise RuntimeError('boom')
+
+    mock_create = mocker.patch.object(EmbeddableEnvBuilder, 'create', autospec=True, side_effect=fake_create)
+    profile_json = str(tmp_path / 'profile.json')
+    # execute
+    with pytest.raises(Exception, match='Failed to create 1 of 2 environments'):
+        main(['env1', 'broken', '--python-version', '3.8.5', '--daemon', daemon.address, '--profile-json', profile_json])
+    main(['env2', '--python-version', '3.8.5', '--daemon', daemon.address, '--jobs', '4'])
+    main(['env3', '--python-version', '3.8.6', '--daemon', daemon.address])
+    # assert
+    assert sorted(call.args[1] for call in mock_create.call_args_list) == [
+        os.path.join(os.getcwd(), d) for d in ('broken', 'env1', 'env2', 'env3')
+    ]
+    # the builder is reused by requests with the same build options
+    assert len(daemon.daemon.builders) == 2
+    with open(profile_json) as f:
+        assert sorted(os.path.basename(r['env_dir']) for r in json.load(f)['records']) == ['broken', 'env1']
+    assert all(not builder.profiler.records for builder in daemon.daemon.builders.values())
+
+
+def test_daemon_resolves_python_version_per_request(daemon: SimpleNamespace, tmp_path, mocker):
+    # preparation
+    mocker.patch('penv.os.name', 'nt')
+    mocker.patch('penv.daemon.ReleaseIndex.resolve', side_effect=['3.12.0', '3.12.0', '3.12.1'])
+    mock_create = mocker.patch.object(EmbeddableEnvBuilder, 'create', autospec=True)
+    # execute
+    for env in ('env1', 'env2', 'env3'):
+        main([env, '--python-version', '3.12', '--daemon', daemon.address])
+    # assert
+    assert [call.args[0].python_version for call in mock_create.call_args_list] == ['3.12.0', '3.12.0', '3.12.1']
+    # the builder of the previous release is dropped
+    assert [builder.python_version for builder in daemon.daemon.builders.values()] == ['3.12.1']
+
+
+def test_daemon_rejects_invalid_requests(daemon: SimpleNamespace, tmp_path):
+    options = vars(_parse_options([str(tmp_path / 'env')]))
+    replies = list(request(daemon.address, {**options, 'upgrade': True, 'clear': True}))
+    assert replies == [{'done': True, 'error': 'you cannot supply --upgrade and --clear together.'}]
+    assert list(request(daemon.address, {'dirs': [str(tmp_path / 'env')]}))[-1]['error'] == 'invalid options'
+    assert 'absolute path' in list(request(daemon.address, {**options, 'dirs': ['env']}))[-1]['error']
+
+
+def test_daemon_requires_its_token(daemon: SimpleNamespace, tmp_path, monkeypatch):
+    path = token_path(daemon.address)
+    with open(path) as f:
+        assert f.read() == daemon.daemon.token
+    if sys.platform != 'win32':
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    options = vars(_parse_options([str(tmp_path / 'env')]))
+    monkeypatch.setenv('PENV_DAEMON_TOKEN', 'guess')
+    assert list(request(daemon.address, options))[-1]['error'] == 'invalid token'
+    monkeypatch.delenv('PENV_DAEMON_TOKEN')
+    os.remove(path)
+    assert list(request(daemon.address, options))[-1]['error'] == 'invalid token'
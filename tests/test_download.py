@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List
+from penv.download import Downloader, DownloadError, DownloadProgress, SingleFlight, download
+
+
+def _write_payload(root: str, name: str, size: int) -> bytes:
+    payload = os.urandom(size)
+    with open(os.path.join(root, name), 'wb') as f:
+        f.write(payload)
+    return payload
+
+
+@pytest.mark.parametrize(
+    'size, segment_size, connections',
+    [
+        (1000, 4096, 4),
+        (100_000, 4096, 4),
+        (100_000, 4096, 1),
+        (0, 4096, 4),
+    ]
+)
+def test_downloader_fetch(
+    http_server: SimpleNamespace,
+    tmp_path,
+    size: int,
+    segment_size: int,
+    connections: int,
+):
+    payload = _write_payload(http_server.root, 'python.zip', size)
+    dest = str(tmp_path / 'python.zip')
+    progress: List[DownloadProgress] = []
+    with Downloader(connections=connections, segment_size=segment_size, progress=progress.append) as d:
+        assert d.fetch(f'{http_server.url}/python.zip', dest) == size
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert not os.path.exists(dest + '.part')
+    assert not os.path.exists(dest + '.part.json')
+    if size:
+        assert progress[-1].downloaded == size
+        assert progress[-1].total == size
+        assert progress[-1].rate >= 0
+
+
+def test_downloader_fetch_uses_ranges(http_server: SimpleNamespace, tmp_path):
+    _write_payload(http_server.root, 'python.zip', 10_000)
+    with Downloader(connections=4, segment_size=1000) as d:
+        d.fetch(f'{http_server.url}/python.zip', str(tmp_path / 'python.zip'))
+    ranges = [r for method, _, r in http_server.requests if method == 'GET']
+    assert len(ranges) == 10
+    assert 'bytes=0-999' in ranges
+    assert 'bytes=9000-9999' in ranges
+
+
+def test_downloader_resumes_segments(http_server: SimpleNamespace, tmp_path):
+    payload = _write_payload(http_server.root, 'python.zip', 10_000)
+    dest = str(tmp_path / 'python.zip')
+    # simulate an interrupted download where segments 0 and 1 are finished
+    with open(dest + '.part', 'wb') as f:
+        f.write(payload[:2000])
+        f.truncate(10_000)
+    with open(dest + '.part.json', 'w') as f:
+        json.dump({'mode': 'segmented', 'size': 10_000, 'etag': None, 'segment_size': 1000, 'done': [0, 1]}, f)
+    with Downloader(connections=2, segment_size=1000) as d:
+        d.fetch(f'{http_server.url}/python.zip', dest)
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    ranges = [r for method, _, r in http_server.requests if method == 'GET']
+    assert len(ranges) == 8
+    assert 'bytes=0-999' not in ranges
+
+
+def test_downloader_resumes_stream(http_server: SimpleNamespace, tmp_path):
+    payload = _write_payload(http_server.root, 'get-pip.py', 5000)
+    dest = str(tmp_path / 'get-pip.py')
+    with open(dest + '.part', 'wb') as f:
+        f.write(payload[:3000])
+    with open(dest + '.part.json', 'w') as f:
+        json.dump({'mode': 'stream', 'size': 5000, 'etag': None}, f)
+    with Downloader(connections=1) as d:
+        d.fetch(f'{http_server.url}/get-pip.py', dest)
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert ('GET', '/get-pip.py', 'bytes=3000-') in http_server.requests
+    assert not os.path.exists(dest + '.part.json')
+
+
+@pytest.mark.parametrize(
+    'state',
+    [
+        None,
+        # left by another file
+        {'mode': 'stream', 'size': 4000, 'etag': None},
+        # left by a segmented transfer, which truncated the part to the full size
+        {'mode': 'segmented', 'size': 5000, 'etag': None, 'segment_size': 1000, 'done': [0]},
+    ]
+)
+def test_downloader_restarts_stream_of_other_part(http_server: SimpleNamespace, tmp_path, state):
+    payload = _write_payload(http_server.root, 'get-pip.py', 5000)
+    dest = str(tmp_path / 'get-pip.py')
+    with open(dest + '.part', 'wb') as f:
+        f.write(payload[:1000] if state and state['mode'] == 'segmented' else os.urandom(3000))
+        f.truncate(5000 if state and state['mode'] == 'segmented' else 3000)
+    if state is not None:
+        with open(dest + '.part.json', 'w') as f:
+            json.dump(state, f)
+    hasher = hashlib.sha256()
+    with Downloader(connections=1) as d:
+        d.fetch(f'{http_server.url}/get-pip.py', dest, hasher=hasher)
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert hasher.hexdigest() == hashlib.sha256(payload).hexdigest()
+    assert [r for method, _, r in http_server.requests if method == 'GET'] == [None]
+
+
+def test_downloader_reuses_connections(http_server: SimpleNamespace, tmp_path):
+    _write_payload(http_server.root, 'a.zip', 100)
+    _write_payload(http_server.root, 'b.zip', 100)
+    with Downloader(connections=1) as d:
+        d.fetch(f'{http_server.url}/a.zip', str(tmp_path / 'a.zip'))
+        d.fetch(f'{http_server.url}/b.zip', str(tmp_path / 'b.zip'))
+        assert d._pool._idle[('http', http_server.url[len('http://'):])].qsize() == 1
+
+
+def test_downloader_not_found(http_server: SimpleNamespace, tmp_path):
+    with pytest.raises(DownloadError):
+        download(f'{http_server.url}/missing.zip', str(tmp_path / 'missing.zip'))
+    assert not os.path.exists(tmp_path / 'missing.zip')
+
+
+@pytest.mark.parametrize('connections', [1, 3])
+def test_downloader_fetch_hashes_resumed_download(http_server: SimpleNamespace, tmp_path, connections: int):
+    payload = _write_payload(http_server.root, 'python.zip', 10_000)
+    dest = str(tmp_path / 'python.zip')
+    with open(dest + '.part', 'wb') as f:
+        f.write(payload[:2000])
+        if connections > 1:
+            f.truncate(10_000)
+    with open(dest + '.part.json', 'w') as f:
+        if connections > 1:
+            json.dump({'mode': 'segmented', 'size': 10_000, 'etag': None, 'segment_size': 1000, 'done': [1, 0]}, f)
+        else:
+            json.dump({'mode': 'stream', 'size': 10_000, 'etag': None}, f)
+    hasher = hashlib.sha256()
+    with Downloader(connections=connections, segment_size=1000) as d:
+        d.fetch(f'{http_server.url}/python.zip', dest, hasher=hasher)
+    assert hasher.hexdigest() == hashlib.sha256(payload).hexdigest()
+
+
+def test_single_flight_shares_in_flight_calls():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls: List[int] = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(flights.do, 'key', slow)
+        started.wait(5)
+        followers = [executor.submit(flights.do, 'key', slow) for _ in range(3)]
+        time.sleep(0.05)
+        release.set()
+        assert leader.result() == 42
+        assert [f.result() for f in followers] == [42, 42, 42]
+    assert len(calls) == 1
+    # a finished call is not memoized
+    assert flights.do('key', lambda: 0) == 0
+
+
+def test_single_flight_shares_exceptions():
+    flights = SingleFlight()
+
+    def fail():
+        raise DownloadError('boom')
+
+    with pytest.raises(DownloadError):
+        flights.do('key', fail)
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import pathlib
+from types import SimpleNamespace
+import pytest
+import penv.cache
+from penv import EmbeddableEnvBuilder, main
+from penv.cache import ArchiveCache
+from penv.hashes import HashIndex, HashMismatch
+
+PAYLOAD = b'embeddable python'
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def _write_index(path: str, files: dict) -> str:
+    with open(path, 'w') as f:
+        json.dump({'version': 1, 'files': files}, f)
+    return path
+
+
+def test_hash_index(tmp_path):
+    index = HashIndex.load(_write_index(str(tmp_path / 'hashes.json'), {'python.zip': SHA256.upper()}))
+    assert index.expected('python.zip') == SHA256
+    index.check('python.zip', SHA256)
+    with pytest.raises(HashMismatch, match='instead of the pinned'):
+        index.check('python.zip', '0' * 64)
+    with pytest.raises(HashMismatch, match='not pinned'):
+        index.expected('get-pip.py')
+    assert index.update(HashIndex({'python.zip': SHA256, 'get-pip.py': '1' * 64})) == 1
+    index.save()
+    assert HashIndex.load(str(tmp_path / 'hashes.json')).files == {'python.zip': SHA256, 'get-pip.py': '1' * 64}
+    with pytest.raises(ValueError, match='not a version 1'):
+        HashIndex.parse('{"files": {}}')
+
+
+def test_hash_index_reload(tmp_path):
+    path = _write_index(str(tmp_path / 'hashes.json'), {'python.zip': SHA256})
+    index = HashIndex.load(path)
+    assert not index.reload()
+    _write_index(path, {'python.zip': '0' * 64})
+    # a change within the resolution of the file system clock
+    os.utime(path, ns=(index.mtime + 1, index.mtime + 1))  # type: ignore
+    assert index.reload()
+    assert index.expected('python.zip') == '0' * 64
+    assert not index.reload()
+
+
+def test_template_key_depends_on_pinned_hashes(tmp_path):
+    zip_name = 'python-3.8.5-embed-amd64.zip'
+    keys = [
+        EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', with_pip=True, hash_index=hash_index)._template_key()
+        for hash_index in (
+            None,
+            _write_index(str(tmp_path / 'a.json'), {zip_name: SHA256, 'get-pip.py': '1' * 64}),
+            _write_index(str(tmp_path / 'b.json'), {zip_name: SHA256, 'get-pip.py': '2' * 64}),
+            _write_index(str(tmp_path / 'c.json'), {zip_name: SHA256, 'get-pip.py': '2' * 64, 'other.zip': SHA256}),
+        )
+    ]
+    assert len(set(keys[:3])) == 3
+    # pins of other downloads do not matter
+    assert keys[2] == keys[3]
+
+
+def test_archive_cache_fetch_checks_pinned_hash(http_server, tmp_path, mocker):
+    # preparation
+    with open(os.path.join(http_server.root, 'python.zip'), 'wb') as f:
+        f.write(PAYLOAD)
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    url = f'{http_server.url}/python.zip'
+    # execute & assert
+    with pytest.raises(HashMismatch):
+        cache.fetch('python.zip', url, expected_sha256='0' * 64)
+    assert cache.entries() == []
+    assert os.listdir(cache.tmp_dir) == []
+    cache.fetch('python.zip', url, expected_sha256=SHA256)
+    assert cache.entries()[0].verified
+    # a verified entry is not read again
+    spy = mocker.spy(penv.cache, 'sha256_file')
+    assert cache.lookup('python.zip', SHA256) is not None
+    assert not spy.called
+    # another pin drops the entry so that the archive is downloaded and checked again
+    assert cache.lookup('python.zip', '0' * 64) is None
+    assert cache.entries() == []
+
+
+def test_archive_cache_lookup_verifies_unverified_entry_once(tmp_path, mocker):
+    cache = ArchiveCache(str(tmp_path / 'cache'))
+    with open(tmp_path / 'python.zip', 'wb') as f:
+        f.write(PAYLOAD)
+    cache.add('python.zip', str(tmp_path / 'python.zip'))
+    spy = mocker.spy(penv.cache, 'sha256_file')
+    assert cache.lookup('python.zip', SHA256) is not None
+    assert cache.lookup('python.zip', SHA256) is not None
+    assert spy.call_count == 1
+    assert cache.entries()[0].verified
+
+
+@pytest.mark.parametrize('pinned, ok', [(hashlib.sha256(b'print(1)\n').hexdigest(), True), ('0' * 64, False)])
+def test_embeddable_env_builder_checks_get_pip(http_server, tmp_path, mocker, pinned: str, ok: bool):
+    # preparation
+    with open(os.path.join(http_server.root, 'get-pip.py'), 'wb') as f:
+        f.write(b'print(1)\n')
+    hash_index = _write_index(str(tmp_path / 'hashes.json'), {'get-pip.py': pinned})
+    mock_call = mocker.patch.object(EmbeddableEnvBuilder, '_call_new_python', autospec=True)
+    builder = EmbeddableEnvBuilder(
+        python_version='3.8.5',
+        platform_arch='amd64',
+        get_pip_mirrors=[http_server.url],
+        hash_index=hash_index,
+    )
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    # execute & assert
+    if ok:
+        builder._setup_pip(context)
+        assert mock_call.called
+    else:
+        with pytest.raises(HashMismatch):
+            builder._setup_pip(context)
+        # get-pip.py is never run
+        assert not mock_call.called
+        assert not os.path.exists(os.path.join(builder._artifacts_root(), pinned, 'get-pip.py'))
+
+
+def test_embeddable_env_builder_checks_artifact_again_after_reload(http_server, tmp_path):
+    # preparation
+    with open(os.path.join(http_server.root, 'get-pip.py'), 'wb') as f:
+        f.write(b'print(1)\n')
+    sha256 = hashlib.sha256(b'print(1)\n').hexdigest()
+    path = _write_index(str(tmp_path / 'hashes.json'), {'get-pip.py': sha256})
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', hash_index=path)
+    url = f'{http_server.url}/get-pip.py'
+    assert builder._artifact(url, 'get-pip.py') == builder._artifact(url, 'get-pip.py')
+    index = builder.hash_index
+    assert index is not None
+    # execute & assert: the pin changed
+    _write_index(path, {'get-pip.py': '0' * 64})
+    os.utime(path, ns=(index.mtime + 1, index.mtime + 1))  # type: ignore
+    assert index.reload()
+    with pytest.raises(HashMismatch, match='instead of the pinned'):
+        builder._artifact(url, 'get-pip.py')
+    # execute & assert: the pin was revoked
+    _write_index(path, {})
+    os.utime(path, ns=(index.mtime + 2, index.mtime + 2))  # type: ignore
+    assert index.reload()
+    with pytest.raises(HashMismatch, match='not pinned'):
+        builder._artifact(url, 'get-pip.py')
+
+
+def test_hashes_main(tmp_path, capsys):
+    hash_index = str(tmp_path / 'hashes.json')
+    with open(tmp_path / 'get-pip.py', 'wb') as f:
+        f.write(PAYLOAD)
+    main(['hashes', 'add', str(tmp_path / 'get-pip.py'), '--hash-index', hash_index])
+    remote = _write_index(str(tmp_path / 'remote.json'), {'python.zip': '1' * 64})
+    main(['hashes', 'refresh', pathlib.Path(remote).as_uri(), '--hash-index', hash_index])
+    capsys.readouterr()
+    main(['hashes', 'list', '--hash-index', hash_index])
+    assert capsys.readouterr().out.splitlines() == [f'get-pip.py\t{SHA256}', f"python.zip\t{'1' * 64}"]
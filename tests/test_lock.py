@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import penv
+from penv.lock import FileLock
+
+
+def test_file_lock_excludes_other_holders(tmp_path):
+    path = str(tmp_path / 'locks' / 'index.json.lock')
+    lock = FileLock(path)
+    with lock:
+        with lock:
+            assert not FileLock(path).acquire(timeout=0)
+        assert not FileLock(path).acquire(timeout=0)
+    other = FileLock(path)
+    assert other.acquire(timeout=0)
+    other.release()
+
+
+def test_file_lock_waits_for_other_process(tmp_path):
+    # preparation
+    path = str(tmp_path / 'python.zip.lock')
+    script = (
+        'import sys, time\n'
+        'from penv.lock import FileLock\n'
+        'with FileLock(sys.argv[1]):\n'
+        '    print("locked", flush=True)\n'
+        '    time.sleep(0.5)\n'
+    )
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.dirname(penv.__file__))}
+    proc = subprocess.Popen([sys.executable, '-c', script, path], stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        assert proc.stdout is not None
+        assert proc.stdout.readline().strip() == 'locked'
+        # execute
+        assert not FileLock(path).acquire(timeout=0)
+        lock = FileLock(path)
+        # assert
+        assert lock.acquire(timeout=30)
+        lock.release()
+    finally:
+        proc.wait()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import pytest
+from penv import main
+from penv.manifest import (
+    MANIFEST_FILE,
+    hash_file,
+    index_files,
+    load_manifest,
+    record_files,
+    save_manifest,
+    verify_env,
+)
+
+
+def _make_env(env_dir: str) -> None:
+    os.makedirs(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg'))
+    with open(os.path.join(env_dir, 'python.exe'), 'wb') as f:
+        f.write(b'MZ' * 1000)
+    with open(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', '__init__.py'), 'w') as f:
+        f.write('x = 1\n')
+    with open(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', 'data.bin'), 'wb') as f:
+        f.write(os.urandom(100_000))
+
+
+def test_save_and_load_manifest(tmp_path):
+    assert load_manifest(str(tmp_path)) is None
+    save_manifest(str(tmp_path), {'python_version': '3.12.1'})
+    assert load_manifest(str(tmp_path)) == {'python_version': '3.12.1', 'version': 1}
+    with open(tmp_path / MANIFEST_FILE, 'w') as f:
+        json.dump({'version': 0}, f)
+    assert load_manifest(str(tmp_path)) is None
+
+
+def test_hash_file(tmp_path):
+    payload = os.urandom(10_000)
+    with open(tmp_path / 'file', 'wb') as f:
+        f.write(payload)
+    assert hash_file(str(tmp_path / 'file'), buffer_size=1000) == hashlib.sha256(payload).hexdigest()
+
+
+def test_index_files_reuses_matching_records(tmp_path, mocker):
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    files = index_files(env_dir)
+    assert sorted(files) == ['Lib/site-packages/pkg/__init__.py', 'Lib/site-packages/pkg/data.bin', 'python.exe']
+    assert files['python.exe']['sha256'] == hashlib.sha256(b'MZ' * 1000).hexdigest()
+    with open(os.path.join(env_dir, 'python.exe'), 'wb') as f:
+        f.write(b'MZ')
+    spy = mocker.patch('penv.manifest.hash_file', side_effect=hash_file)
+    updated = index_files(env_dir, files)
+    assert [call.args[0] for call in spy.call_args_list] == [os.path.join(env_dir, 'python.exe')]
+    assert updated['python.exe']['size'] == 2
+
+
+def test_verify_env(tmp_path):
+    # preparation
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    record_files(env_dir)
+    assert verify_env(env_dir).ok
+    assert verify_env(env_dir).hashed == 0
+    # same size and new contents
+    with open(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', '__init__.py'), 'w') as f:
+        f.write('x = 2\n')
+    # rewritten with the same contents
+    with open(os.path.join(env_dir, 'python.exe'), 'wb') as f:
+        f.write(b'MZ' * 1000)
+    for rel in ('python.exe', 'Lib/site-packages/pkg/__init__.py'):
+        # a rewrite within the same clock tick may keep the modification time
+        path = os.path.join(env_dir, *rel.split('/'))
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    os.remove(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', 'data.bin'))
+    with open(os.path.join(env_dir, 'evil.dll'), 'wb') as f:
+        f.write(b'MZ')
+    os.makedirs(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', '__pycache__'))
+    with open(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', '__pycache__', '__init__.cpython-312.pyc'), 'wb') as f:
+        f.write(b'pyc')
+    # execute
+    result = verify_env(env_dir)
+    # assert
+    assert not result.ok
+    assert result.missing == ['Lib/site-packages/pkg/data.bin']
+    assert result.modified == ['Lib/site-packages/pkg/__init__.py']
+    assert result.extra == ['evil.dll']
+    assert result.checked == 3
+    assert result.hashed == 2
+
+
+def test_verify_env_without_manifest(tmp_path):
+    with pytest.raises(ValueError):
+        verify_env(str(tmp_path))
+
+
+def test_main_verify(tmp_path, capsys):
+    good, bad = str(tmp_path / 'good'), str(tmp_path / 'bad')
+    for env_dir in (good, bad):
+        _make_env(env_dir)
+        record_files(env_dir)
+    os.remove(os.path.join(bad, 'python.exe'))
+    with pytest.raises(ValueError, match='1 of 2 environments'):
+        main(['verify', good, bad])
+    reports = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r['env_dir'], r['ok'], r['missing']) for r in reports] == [
+        (good, True, []),
+        (bad, False, ['python.exe']),
+    ]
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import pathlib
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Generator
+
+import pytest
+
+from penv import EmbeddableEnvBuilder
+from penv.download import Downloader, DownloadError
+from penv.mirrors import MirrorList, probe
+
+
+class StallingHandler(BaseHTTPRequestHandler):
+    """Announces the whole file, then stops sending after half of it"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def _send_head(self) -> bytes:
+        payload: bytes = self.server.payload  # type: ignore
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Accept-Ranges', 'none')
+        self.end_headers()
+        return payload
+
+    def do_HEAD(self):
+        self._send_head()
+
+    def do_GET(self):
+        payload = self._send_head()
+        self.wfile.write(payload[:len(payload) // 2])
+        self.wfile.flush()
+        time.sleep(2)
+
+
+@pytest.fixture(scope='function')
+def stalling_server() -> Generator[SimpleNamespace, None, None]:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StallingHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    try:
+        yield SimpleNamespace(server=server, url=f'http://127.0.0.1:{server.server_address[1]}')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _write_payload(root: str, name: str, size: int) -> bytes:
+    payload = os.urandom(size)
+    with open(os.path.join(root, name), 'wb') as f:
+        f.write(payload)
+    return payload
+
+
+def test_downloader_fails_over_stalled_transfer(http_server, stalling_server, tmp_path):
+    # preparation
+    payload = _write_payload(http_server.root, 'python.zip', 100_000)
+    stalling_server.server.payload = payload
+    dest = str(tmp_path / 'python.zip')
+    hasher = hashlib.sha256()
+    # execute
+    with Downloader(connections=1, timeout=0.5) as d:
+        d.fetch(f'{stalling_server.url}/python.zip', dest, hasher=hasher, mirrors=[f'{http_server.url}/python.zip'])
+    # assert
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert hasher.hexdigest() == hashlib.sha256(payload).hexdigest()
+    # resumed from the bytes received from the stalled mirror
+    assert ('GET', '/python.zip', 'bytes=50000-') in http_server.requests
+
+
+def test_downloader_fails_over_to_file_url(http_server, tmp_path):
+    payload = _write_payload(str(tmp_path), 'local.zip', 10_000)
+    dest = str(tmp_path / 'python.zip')
+    hasher = hashlib.sha256()
+    with Downloader(connections=4, segment_size=1000) as d:
+        d.fetch(f'{http_server.url}/python.zip', dest, hasher=hasher, mirrors=[(tmp_path / 'local.zip').as_uri()])
+    with open(dest, 'rb') as f:
+        assert f.read() == payload
+    assert hasher.hexdigest() == hashlib.sha256(payload).hexdigest()
+
+
+def test_downloader_rejects_mirror_with_other_size(http_server, stalling_server, tmp_path):
+    stalling_server.server.payload = os.urandom(20)
+    _write_payload(str(tmp_path), 'local.zip', 10)
+    with pytest.raises(DownloadError, match='bytes instead of'):
+        with Downloader(connections=1, timeout=0.5) as d:
+            d.fetch(
+                f'{stalling_server.url}/python.zip',
+                str(tmp_path / 'python.zip'),
+                mirrors=[f'{http_server.url}/missing.zip', (tmp_path / 'local.zip').as_uri()],
+            )
+
+
+def test_probe(http_server, tmp_path):
+    _write_payload(http_server.root, 'python.zip', 10)
+    assert probe(f'{http_server.url}/python.zip') is not None
+    assert probe(f'{http_server.url}/missing.zip') is None
+    assert probe(pathlib.Path(http_server.root, 'python.zip').as_uri()) is not None
+    assert probe('http://127.0.0.1:1/python.zip', timeout=0.5) is None
+
+
+def test_mirror_list_ranks_and_remembers_latencies(tmp_path, mocker):
+    # preparation
+    latencies = {'slow': 0.5, 'fast': 0.1, 'down': None}
+    mock_probe = mocker.patch('penv.mirrors.probe', side_effect=lambda url, timeout: latencies[url.split('/')[2]])
+    state_path = str(tmp_path / 'mirrors.json')
+    mirrors = ['http://down', 'http://slow', 'http://fast']
+    # execute
+    urls = MirrorList(mirrors, state_path=state_path).urls('3.8.5/python.zip')
+    # assert
+    assert urls == ['http://fast/3.8.5/python.zip', 'http://slow/3.8.5/python.zip', 'http://down/3.8.5/python.zip']
+    assert mock_probe.call_count == 3
+    # the latencies are reused by other builders until they expire; a failure only for the file it was probed for
+    assert MirrorList(mirrors, state_path=state_path).urls('get-pip.py')[0] == 'http://fast/get-pip.py'
+    assert mock_probe.call_count == 4
+    MirrorList(mirrors, state_path=state_path, ttl=-1).urls('get-pip.py')
+    assert mock_probe.call_count == 7
+
+
+def test_mirror_list_remembers_missing_files_per_path(tmp_path, mocker):
+    # preparation: the fast mirror lacks one version
+    latencies = {'slow': 0.5, 'fast': 0.1}
+    mock_probe = mocker.patch(
+        'penv.mirrors.probe',
+        side_effect=lambda url, timeout: None if url.startswith('http://fast/3.12.2/') else latencies[url.split('/')[2]],
+    )
+    state_path = str(tmp_path / 'mirrors.json')
+    mirrors = ['http://slow', 'http://fast']
+    # execute
+    missing = MirrorList(mirrors, state_path=state_path).urls('3.12.2/python.zip')
+    other = MirrorList(mirrors, state_path=state_path).urls('3.12.1/python.zip')
+    # assert
+    assert missing[0] == 'http://slow/3.12.2/python.zip'
+    assert other[0] == 'http://fast/3.12.1/python.zip'
+    # only the fast mirror, which had no latency yet, was probed again
+    assert mock_probe.call_count == 3
+    # the failure is reused for its path
+    assert MirrorList(mirrors, state_path=state_path).urls('3.12.2/python.zip') == missing
+    assert mock_probe.call_count == 3
+
+
+def test_mirror_list_single_mirror_is_not_probed(mocker):
+    mock_probe = mocker.patch('penv.mirrors.probe')
+    assert MirrorList(['https://bootstrap.pypa.io/']).urls('get-pip.py') == ['https://bootstrap.pypa.io/get-pip.py']
+    assert not mock_probe.called
+
+
+def test_embeddable_env_builder_python_mirrors(http_server, tmp_path):
+    # preparation
+    os.makedirs(os.path.join(http_server.root, '3.8.5'))
+    with zipfile.ZipFile(os.path.join(http_server.root, '3.8.5', 'python-3.8.5-embed-amd64.zip'), 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+    cache_dir = str(tmp_path / 'cache')
+    builder = EmbeddableEnvBuilder(
+        python_version='3.8.5',
+        platform_arch='amd64',
+        cache_dir=cache_dir,
+        python_mirrors=['http://127.0.0.1:1', http_server.url],
+    )
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    # execute
+    builder.setup_python(context)
+    # assert
+    assert os.path.exists(os.path.join(context.env_dir, 'python.exe'))
+    assert os.path.exists(os.path.join(cache_dir, 'mirrors.json'))
@@ -0,0 +1,104 @@
+import gzip
+import os
+import pytest
+import tarfile
+import zipfile
+from penv import main
+from penv.manifest import MANIFEST_FILE, load_manifest, record_files, verify_env
+from penv.pack import pack_env, pack_format
+
+
+def _make_env(env_dir: str) -> None:
+    os.makedirs(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg'))
+    os.makedirs(os.path.join(env_dir, 'Include'))
+    with open(os.path.join(env_dir, 'python.exe'), 'wb') as f:
+        f.write(b'MZ' * 10_000)
+    with open(os.path.join(env_dir, 'python312.zip'), 'wb') as f:
+        f.write(os.urandom(50_000))
+    for name in ('a.py', 'b.py'):
+        with open(os.path.join(env_dir, 'Lib', 'site-packages', 'pkg', name), 'w') as f:
+            f.write('x = 1\n' * 100)
+    record_files(env_dir)
+
+
+@pytest.mark.parametrize(
+    'output, expected',
+    [('env.zip', 'zip'), ('env.tar', 'tar'), ('env.tar.gz', 'tar.gz'), ('env.TGZ', 'tar.gz'), ('env', 'zip')]
+)
+def test_pack_format(output: str, expected: str):
+    assert pack_format(output) == expected
+
+
+def test_pack_env_zip(tmp_path):
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    result = pack_env(env_dir, str(tmp_path / 'env.zip'), max_workers=4)
+    # a.py and b.py are identical: compressed once, but stored twice as zip members can not share data
+    assert (result.files, result.duplicates) == (4, 1)
+    assert result.bytes_out == os.path.getsize(tmp_path / 'env.zip')
+    with zipfile.ZipFile(tmp_path / 'env.zip') as zf:
+        assert zf.testzip() is None
+        names = zf.namelist()
+        assert names == [
+            'env/Include/', 'env/Lib/', 'env/Lib/site-packages/', 'env/Lib/site-packages/pkg/',
+            'env/Lib/site-packages/pkg/a.py', 'env/Lib/site-packages/pkg/b.py',
+            'env/python.exe', 'env/python312.zip', f'env/{MANIFEST_FILE}',
+        ]
+        assert zf.getinfo('env/python.exe').compress_type == zipfile.ZIP_DEFLATED
+        # random bytes do not compress
+        assert zf.getinfo('env/python312.zip').compress_type == zipfile.ZIP_STORED
+        zf.extractall(tmp_path / 'unpacked')
+    # the packed manifest verifies the unpacked environment
+    assert verify_env(str(tmp_path / 'unpacked' / 'env')).ok
+
+
+def test_pack_env_zip64(tmp_path, mocker):
+    mocker.patch('penv.pack.ZIP64_LIMIT', 1000)
+    mocker.patch('penv.pack.ZIP_MAX_ENTRIES', 3)
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    pack_env(env_dir, str(tmp_path / 'env.zip'), max_workers=2)
+    with zipfile.ZipFile(tmp_path / 'env.zip') as zf:
+        assert zf.testzip() is None
+        assert len(zf.namelist()) == 9
+        assert zf.getinfo('env/python312.zip').file_size == 50_000
+        zf.extractall(tmp_path / 'unpacked')
+    assert verify_env(str(tmp_path / 'unpacked' / 'env')).ok
+
+
+def test_pack_env_tar_gz(tmp_path, mocker):
+    mocker.patch('penv.pack.GZIP_BLOCK_SIZE', 4096)
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    result = pack_env(env_dir, str(tmp_path / 'env.tar.gz'), prefix='', max_workers=4)
+    assert (result.files, result.duplicates) == (4, 1)
+    # several gzip members
+    with open(tmp_path / 'env.tar.gz', 'rb') as f:
+        assert f.read().count(b'\x1f\x8b\x08') > 1
+    with tarfile.open(tmp_path / 'env.tar.gz', 'r:gz') as tf:
+        link = tf.getmember('Lib/site-packages/pkg/b.py')
+        assert link.islnk() and link.linkname == 'Lib/site-packages/pkg/a.py'
+        assert tf.getmember('python.exe').uid == 0
+        tf.extractall(tmp_path / 'unpacked')
+    with open(tmp_path / 'unpacked' / 'Lib' / 'site-packages' / 'pkg' / 'b.py') as f:
+        assert f.read() == 'x = 1\n' * 100
+    assert load_manifest(str(tmp_path / 'unpacked'))['files'] == load_manifest(env_dir)['files']  # type: ignore
+
+
+@pytest.mark.parametrize('name', ['env.zip', 'env.tar', 'env.tar.gz'])
+def test_pack_env_is_reproducible(tmp_path, monkeypatch, name: str):
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000000')
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    pack_env(env_dir, str(tmp_path / f'1-{name}'), prefix='env', max_workers=1)
+    pack_env(env_dir, str(tmp_path / f'2-{name}'), prefix='env', max_workers=8)
+    with open(tmp_path / f'1-{name}', 'rb') as f1, open(tmp_path / f'2-{name}', 'rb') as f2:
+        assert f1.read() == f2.read()
+
+
+def test_main_pack(tmp_path):
+    env_dir = str(tmp_path / 'env')
+    _make_env(env_dir)
+    main(['pack', env_dir, str(tmp_path / 'out.bin'), '--format', 'tar.gz', '--level', '1', '--jobs', '2'])
+    with gzip.open(tmp_path / 'out.bin') as f:
+        assert tarfile.open(fileobj=f, mode='r|').next().name == 'env/Include'  # type: ignore
@@ -1,11 +1,18 @@
+import asyncio
 import logging
 import os
 import pytest
 import shutil
 import subprocess
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator, Optional, Tuple
 from types import SimpleNamespace
+import penv
 from penv import EmbeddableEnvBuilder, main
+from penv.cache import ArchiveCache
+from penv.manifest import load_manifest
 
 
 TEMP_DIR: str = 'temp_dir'
@@ -94,7 +101,7 @@ def test_embeddable_env_builder(
 @pytest.mark.parametrize(
     'cache_dir',
     [
-        '.',
+        'cache_dir',
         None,
     ]
 )
@@ -102,9 +109,15 @@ def test_embeddable_env_builder_setup_python(
     dir_removed_after_test: str,
     mock_embed_python_zip: Tuple[str, str, str],
     cache_dir: Optional[str],
+    tmp_path,
     mocker
 ):
     # preparation
+    if cache_dir is not None:
+        cache_dir = str(tmp_path / cache_dir)
+        zip_name = f'{mock_embed_python_zip[2]}.zip'
+        shutil.copyfile(zip_name, str(tmp_path / zip_name))
+        ArchiveCache(cache_dir).add(zip_name, str(tmp_path / zip_name))
     builder = EmbeddableEnvBuilder(
         clear=True,
         upgrade=True,
@@ -118,10 +131,16 @@ def test_embeddable_env_builder_setup_python(
     context.env_dir = dir_removed_after_test
     short_version: str = ''.join(mock_embed_python_zip[0].split(".")[:-1])
     # mock
-    mocker.patch('penv.subprocess.run')
+    mock_download = mocker.patch(
+        'penv.download',
+        side_effect=lambda url, dest, downloader, mirrors: shutil.copyfile(f'{mock_embed_python_zip[2]}.zip', dest),
+    )
+    mocker.patch('penv.cache.download')
     # execute
     builder.setup_python(context)
     # assert
+    assert mock_download.called == (cache_dir is None)
+    assert not os.path.exists(f'python-{mock_embed_python_zip[0]}-embed-{mock_embed_python_zip[1]}.zip.part')
     assert os.path.exists(context.env_dir)
     assert os.path.exists(os.path.join(context.env_dir, 'Include'))
     assert os.path.exists(os.path.join(context.env_dir, 'Lib', 'site-packages'))
@@ -136,6 +155,7 @@ def test_embeddable_env_builder_setup_python(
 def test_embeddable_env_builder_setup_pip(
     dir_removed_after_test: str,
     mock_embed_python_zip: Tuple[str, str, str],
+    downloads_dir: str,
     mocker
 ):
     # preparation
@@ -151,24 +171,22 @@ def test_embeddable_env_builder_setup_pip(
     context = SimpleNamespace()
     context.env_dir = dir_removed_after_test
     # mock
-    mock_run = mocker.MagicMock()
-    mocker.patch('penv.subprocess.run', side_effect=mock_run)
+    mock_download = mocker.patch('penv.download', side_effect=lambda url, dest, downloader, mirrors: open(dest, 'w').close())
     builder._call_new_python = mocker.MagicMock()  # type: ignore
     # execute
     builder._setup_pip(context)
     # assert
-    assert mock_run.call_args_list[0] == (
-        ([
-            'curl',
-            '-fsL',
+    get_pip_path = os.path.join(builder._artifacts_dir, 'get-pip.py')  # type: ignore
+    assert mock_download.call_args_list[0] == (
+        (
             'https://bootstrap.pypa.io/get-pip.py',
-            '-o',
-            os.path.join(dir_removed_after_test, 'get-pip.py'),
-        ],),
-        {'check': True},
+            os.path.join(downloads_dir, 'get-pip.py'),
+            None,
+        ),
+        {'mirrors': []},
     )
     assert builder._call_new_python.call_args_list[0] == (  # type: ignore
-        (context, os.path.join(dir_removed_after_test, 'get-pip.py')),
+        (context, get_pip_path),
         {'stderr': subprocess.STDOUT}
     )
 
@@ -213,3 +231,215 @@ def test_main(dir_removed_after_test: str):
         '--platform-arch', 'amd64',
     ]
     main(args)
+
+
+def test_embeddable_env_builder_shares_downloads(mocker):
+    # preparation
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64')
+
+    def fake_download(url, dest, downloader, mirrors):
+        time.sleep(0.05)
+        with open(dest, 'w') as f:
+            f.write(url)
+
+    mock_download = mocker.patch('penv.download', side_effect=fake_download)
+    # execute
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        paths = list(executor.map(
+            lambda _: builder._artifact('https://bootstrap.pypa.io/get-pip.py', 'get-pip.py'),
+            range(8),
+        ))
+    # assert
+    assert mock_download.call_count == 1
+    assert len(set(paths)) == 1
+    assert os.path.exists(paths[0])
+
+
+def test_main_jobs_reports_each_dir(mocker, caplog):
+    # preparation
+    mocker.patch('penv.os.name', 'nt')
+
+    def fake_create(self, env_dir):
+        if env_dir == 'broken':
+            raise RuntimeError('boom')
+
+    mock_create = mocker.patch.object(EmbeddableEnvBuilder, 'create', autospec=True, side_effect=fake_create)
+    # execute
+    with caplog.at_level(logging.INFO, logger='penv'):
+        with pytest.raises(Exception, match='Failed to create 1 of 3 environments: broken'):
+            main(['env1', 'broken', 'env2', '--jobs', '3', '--python-version', '3.8.5'])
+    # assert
+    assert sorted(call.args[1] for call in mock_create.call_args_list) == ['broken', 'env1', 'env2']
+    assert 'Created env1' in caplog.text
+    assert 'Created env2' in caplog.text
+    assert 'Failed to create broken: boom' in caplog.text
+
+
+def test_embeddable_env_builder_setup_python_upgrade(tmp_path, mocker):
+    # preparation
+    def make_zip(python_version: str, files: dict) -> str:
+        path = str(tmp_path / f'python-{python_version}-embed-amd64.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+            for name, payload in files.items():
+                zf.writestr(name, payload)
+        return path
+
+    make_zip('3.8.5', {'python.exe': 'old', 'python38.zip': 'stdlib', 'old.pyd': 'old'})
+    make_zip('3.8.6', {'python.exe': 'new', 'python38.zip': 'stdlib'})
+    mocker.patch(
+        'penv.download',
+        side_effect=lambda url, dest, downloader, mirrors: shutil.copyfile(str(tmp_path / os.path.basename(url)), dest),
+    )
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64').setup_python(context)
+    with open(os.path.join(context.env_dir, 'Lib', 'site-packages', 'mod.py'), 'w') as f:
+        f.write('x = 1\n')
+    with open(os.path.join(context.env_dir, 'python38._pth')) as f:
+        pth = f.read()
+    mock_sync_zip = mocker.spy(penv, 'sync_zip')
+    # execute
+    EmbeddableEnvBuilder(python_version='3.8.6', platform_arch='amd64', upgrade=True).setup_python(context)
+    # assert
+    assert mock_sync_zip.spy_return[1] == ['python.exe']
+    assert mock_sync_zip.spy_return[2] == ['old.pyd']
+    with open(os.path.join(context.env_dir, 'python.exe')) as f:
+        assert f.read() == 'new'
+    with open(os.path.join(context.env_dir, 'python38._pth')) as f:
+        assert f.read() == pth
+    assert os.path.exists(os.path.join(context.env_dir, 'Lib', 'site-packages', 'mod.py'))
+    assert load_manifest(context.env_dir)['python_version'] == '3.8.6'  # type: ignore
+
+
+def test_embeddable_env_builder_setup_python_upgrade_minor_version(tmp_path, mocker):
+    # preparation
+    for python_version, short in (('3.11.9', '311'), ('3.12.1', '312')):
+        with zipfile.ZipFile(str(tmp_path / f'python-{python_version}-embed-amd64.zip'), 'w') as zf:
+            zf.writestr(f'python{short}._pth', f'python{short}.zip\n.\n#import site\n')
+            zf.writestr(f'python{short}.zip', 'stdlib')
+    mocker.patch(
+        'penv.download',
+        side_effect=lambda url, dest, downloader, mirrors: shutil.copyfile(str(tmp_path / os.path.basename(url)), dest),
+    )
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    EmbeddableEnvBuilder(python_version='3.11.9', platform_arch='amd64').setup_python(context)
+    # execute
+    EmbeddableEnvBuilder(python_version='3.12.1', platform_arch='amd64', upgrade=True).setup_python(context)
+    # assert
+    assert not os.path.exists(os.path.join(context.env_dir, 'python311._pth'))
+    assert not os.path.exists(os.path.join(context.env_dir, 'python311.zip'))
+    with open(os.path.join(context.env_dir, 'python312._pth')) as f:
+        assert 'python312.zip' in f.read()
+
+
+def test_embeddable_env_builder_create_many(tmp_path, mocker):
+    # preparation
+    zip_path = str(tmp_path / 'python-3.8.5-embed-amd64.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+
+    def fake_download(url, dest, downloader, mirrors):
+        time.sleep(0.05)
+        shutil.copyfile(zip_path, dest)
+
+    mock_download = mocker.patch('penv.download', side_effect=fake_download)
+    mocker.patch.object(EmbeddableEnvBuilder, '_patch_scripts', autospec=True)
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', prompt='base')
+    env1, env2 = str(tmp_path / 'env1'), str(tmp_path / 'env2')
+    records: list = []
+    # execute
+    futures = builder.create_many([env1, (env2, {'prompt': 'other'})], max_workers=2, progress=records.append)
+    # assert
+    assert [future.result() for future in futures] == [None, None]
+    assert mock_download.call_count == 1
+    with open(os.path.join(env1, 'activate')) as f:
+        assert "('base')" in f.read()
+    with open(os.path.join(env2, 'activate')) as f:
+        assert "('other')" in f.read()
+    assert sorted(r.env_dir for r in records if r.phase == 'create') == [env1, env2]
+    assert {'download', 'extract', 'setup_python'} <= {r.phase for r in records}
+    assert not builder.profiler._listeners
+
+
+def test_embeddable_env_builder_create_many_survives_progress_errors(mocker):
+    # preparation
+    def fake_create(self, env_dir):
+        with self.profiler.phase('create', os.path.abspath(env_dir)):
+            pass
+
+    mocker.patch.object(EmbeddableEnvBuilder, 'create', autospec=True, side_effect=fake_create)
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64')
+
+    def progress(record):
+        raise RuntimeError('boom')
+
+    # execute
+    futures = builder.create_many(['env1', ('env2', {'prompt': 'other'})], max_workers=2, progress=progress)
+    # assert
+    assert [future.result() for future in futures] == [None, None]
+
+
+def test_embeddable_env_builder_acreate_many(mocker):
+    # preparation
+    def fake_create(self, env_dir):
+        if env_dir == 'broken':
+            raise RuntimeError('boom')
+
+    mocker.patch.object(EmbeddableEnvBuilder, 'create', autospec=True, side_effect=fake_create)
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64')
+    # execute
+    results = asyncio.run(builder.acreate_many(['env1', 'broken'], max_workers=2))
+    # assert
+    assert results[0] is None
+    assert isinstance(results[1], RuntimeError)
+
+
+def test_embeddable_env_builder_derive():
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', exclude=['_ssl.pyd'])
+    derived = builder.derive(python_version='3.9.1', requirements='requirements.txt')
+    assert (derived.python_version, derived.requirements) == ('3.9.1', 'requirements.txt')
+    assert builder.python_version == '3.8.5'
+    assert derived._flights is builder._flights
+    assert derived._artifacts_dir == builder._artifacts_dir
+    assert derived.profiler is not builder.profiler
+    derived.exclude.append('_sqlite3.pyd')
+    assert builder.exclude == ['_ssl.pyd']
+    assert builder.derive(exclude=None).exclude == []
+    with pytest.raises(AssertionError):
+        builder.derive(cache_dir='elsewhere')
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_embeddable_env_builder_setup_python_slim(http_server, tmp_path, use_cache: bool):
+    # preparation
+    os.makedirs(os.path.join(http_server.root, '3.8.5'))
+    zip_path = os.path.join(http_server.root, '3.8.5', 'python-3.8.5-embed-amd64.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+        zf.writestr('pythonw.exe', os.urandom(500_000))
+        zf.writestr('_sqlite3.pyd', os.urandom(500_000))
+        zf.writestr('_ssl.pyd', 'ssl')
+    builder = EmbeddableEnvBuilder(
+        python_version='3.8.5',
+        platform_arch='amd64',
+        cache_dir=str(tmp_path / 'cache') if use_cache else None,
+        python_mirrors=[http_server.url],
+        slim=True,
+        exclude=['_ssl.pyd'],
+    )
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    # execute
+    builder.setup_python(context)
+    # assert
+    assert sorted(n for n in os.listdir(context.env_dir) if os.path.isfile(os.path.join(context.env_dir, n))) == [
+        'penv-manifest.json', 'python.exe', 'python38._pth',
+    ]
+    assert sorted(load_manifest(context.env_dir)['archive']) == ['python.exe', 'python38._pth']  # type: ignore
+    downloaded = sum(r.counters.get('bytes_downloaded', 0) for r in builder.profiler.records if r.phase == 'setup_python')
+    if use_cache:
+        assert downloaded == os.path.getsize(zip_path)
+    else:
+        assert downloaded < 100_000
+    assert '-slim-' in builder._template_key()
@@ -0,0 +1,95 @@
+import json
+import os
+import pytest
+import shutil
+import zipfile
+from typing import List
+from penv import EmbeddableEnvBuilder, main
+from penv.profiling import PhaseRecord, Profiler
+
+
+def test_profiler_nested_phases():
+    records: List[PhaseRecord] = []
+    profiler = Profiler(callback=records.append)
+    with profiler.phase('create', 'env'):
+        with profiler.phase('download', 'env'):
+            profiler.count('bytes_downloaded', 100)
+        profiler.count('subprocess_time', 0.5)
+    assert [record.phase for record in records] == ['download', 'create']
+    assert records[0].counters == {'bytes_downloaded': 100}
+    assert records[1].counters == {'bytes_downloaded': 100, 'subprocess_time': 0.5}
+    assert records[1].elapsed >= records[0].elapsed
+    assert profiler.records == records
+    # counters outside of a phase are dropped
+    profiler.count('bytes_downloaded', 1)
+
+
+def test_profiler_records_errors():
+    profiler = Profiler()
+    with pytest.raises(RuntimeError):
+        with profiler.phase('setup_pip', 'env'):
+            raise RuntimeError('boom')
+    assert profiler.records[0].counters == {'error': 'RuntimeError'}
+
+
+def test_profiler_summary_and_dump(tmp_path):
+    profiler = Profiler()
+    for env_dir in ('env1', 'env2'):
+        with profiler.phase('extract', env_dir):
+            profiler.count('bytes_extracted', 10)
+    summary = profiler.summary()
+    assert summary['extract']['count'] == 2
+    assert summary['extract']['counters'] == {'bytes_extracted': 20}
+    profiler.dump(str(tmp_path / 'profile.json'))
+    with open(tmp_path / 'profile.json') as f:
+        data = json.load(f)
+    assert data['version'] == 1
+    assert [record['env_dir'] for record in data['records']] == ['env1', 'env2']
+
+
+def test_embeddable_env_builder_records_phases(tmp_path, mocker):
+    # preparation
+    zip_path = str(tmp_path / 'python-3.8.5-embed-amd64.zip')
+    pth = 'python38.zip\n.\n#import site\n'
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', pth)
+        zf.writestr('python.exe', 'MZ' * 500)
+    mocker.patch('penv.download', side_effect=lambda url, dest, downloader, mirrors: shutil.copyfile(zip_path, dest))
+    mocker.patch.object(EmbeddableEnvBuilder, '_patch_scripts', autospec=True)
+    records: List[PhaseRecord] = []
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', profiler=Profiler(records.append))
+    env_dir = str(tmp_path / 'env')
+    # execute
+    builder.create(env_dir)
+    # assert
+    phases = {record.phase: record for record in records}
+    assert list(phases) == [
+        'ensure_directories', 'download', 'extract', 'setup_python', 'setup_scripts', 'post_setup', 'manifest', 'create',
+    ]
+    assert all(record.env_dir == env_dir for record in records)
+    assert phases['download'].counters == {'bytes_downloaded': os.path.getsize(zip_path)}
+    assert phases['extract'].counters == {'files_extracted': 2, 'bytes_extracted': 1000 + len(pth)}
+    assert phases['create'].counters['bytes_downloaded'] == os.path.getsize(zip_path)
+
+
+def test_main_profile_json(tmp_path, mocker):
+    # preparation
+    mocker.patch('penv.os.name', 'nt')
+
+    def fake_create(self, env_dir):
+        with self.profiler.phase('create', env_dir):
+            if env_dir == 'broken':
+                raise RuntimeError('boom')
+
+    mocker.patch.object(EmbeddableEnvBuilder, 'create', autospec=True, side_effect=fake_create)
+    profile_json = str(tmp_path / 'profile.json')
+    # execute
+    with pytest.raises(Exception):
+        main(['env1', 'broken', '--python-version', '3.8.5', '--profile-json', profile_json])
+    # assert
+    with open(profile_json) as f:
+        records = json.load(f)['records']
+    assert sorted((r['env_dir'], r['counters'].get('error')) for r in records) == [
+        ('broken', 'RuntimeError'),
+        ('env1', None),
+    ]
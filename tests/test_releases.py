@@ -0,0 +1,132 @@
+import json
+import os
+import pytest
+import zipfile
+from types import SimpleNamespace
+from penv import EmbeddableEnvBuilder
+from penv.mirrors import MirrorList
+from penv.releases import ReleaseIndex, is_exact, short_version, version_matches
+
+
+@pytest.mark.parametrize(
+    'version, spec, expected',
+    [
+        ('3.12.1', '3.12', True),
+        ('3.12.1', '3.11', False),
+        ('3.12.1', '3', True),
+        ('3.12.1', '3.12.1', True),
+        ('3.12.1', '>=3.11,<3.13', True),
+        ('3.13.0', '>=3.11,<3.13', False),
+        ('3.12.4', '==3.12.*', True),
+        ('3.12.4', '!=3.12.4', False),
+        ('3.11.9', '~=3.11.2', True),
+        ('3.12.0', '~=3.11.2', False),
+        ('3.12.0', '~=3.11', True),
+    ]
+)
+def test_version_matches(version: str, spec: str, expected: bool):
+    assert version_matches(version, spec) == expected
+
+
+@pytest.mark.parametrize('spec', ['3.x', '>=3.11;<3.13', '>=3.*', '~=3'])
+def test_version_matches_invalid(spec: str):
+    with pytest.raises(ValueError):
+        version_matches('3.12.1', spec)
+
+
+def test_is_exact_and_short_version():
+    assert is_exact('3.12.1')
+    assert not is_exact('3.12')
+    assert short_version('3.12.1') == '312'
+
+
+def _make_release(root: str, version: str, platform_arch: str = 'amd64') -> None:
+    os.makedirs(os.path.join(root, version), exist_ok=True)
+    with zipfile.ZipFile(os.path.join(root, version, f'python-{version}-embed-{platform_arch}.zip'), 'w') as zf:
+        zf.writestr(f'python{short_version(version)}._pth', 'python.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+
+
+def test_release_index_resolves_latest_build(http_server: SimpleNamespace, tmp_path):
+    # preparation
+    for version in ('3.11.9', '3.12.0', '3.12.1'):
+        _make_release(http_server.root, version)
+    # an upcoming release without its final build yet
+    os.makedirs(os.path.join(http_server.root, '3.12.2'))
+    path = str(tmp_path / 'releases.json')
+    index = ReleaseIndex(MirrorList([http_server.url]), path=path)
+    # execute and assert
+    assert index.resolve('3.12', 'amd64') == '3.12.1'
+    assert index.resolve('<3.12', 'amd64') == '3.11.9'
+    assert index.resolve('3.12.7', 'amd64') == '3.12.7'
+    with pytest.raises(ValueError, match='No embeddable python'):
+        index.resolve('3.10', 'amd64')
+    # resolved again from the cached index without any request
+    del http_server.requests[:]
+    assert ReleaseIndex(MirrorList([http_server.url]), path=path).resolve('3.12', 'amd64') == '3.12.1'
+    assert http_server.requests == []
+
+
+def test_release_index_offline(tmp_path):
+    # preparation
+    root = str(tmp_path / 'python')
+    _make_release(root, '3.12.1')
+    path = str(tmp_path / 'releases.json')
+    ReleaseIndex(MirrorList([(tmp_path / 'python').as_uri()]), path=path).load()
+    # execute: the index has expired and the mirror is unreachable
+    index = ReleaseIndex(MirrorList(['http://127.0.0.1:1']), path=path, ttl=-1)
+    # assert
+    assert index.resolve('3.12', 'amd64') == '3.12.1'
+    with pytest.raises(ValueError, match='No release index'):
+        ReleaseIndex(MirrorList(['http://127.0.0.1:1'])).resolve('3.12', 'amd64')
+
+
+def test_release_index_expires_in_memory(tmp_path):
+    root = str(tmp_path / 'python')
+    _make_release(root, '3.12.1')
+    index = ReleaseIndex(MirrorList([(tmp_path / 'python').as_uri()]))
+    assert index.resolve('3.12', 'amd64') == '3.12.1'
+    _make_release(root, '3.12.2')
+    assert index.resolve('3.12', 'amd64') == '3.12.1'
+    index.ttl = -1
+    assert index.resolve('3.12', 'amd64') == '3.12.2'
+
+
+def test_release_index_records_definite_answers_only(http_server: SimpleNamespace, tmp_path, mocker):
+    # preparation
+    for version in ('3.12.0', '3.12.1'):
+        _make_release(http_server.root, version)
+    path = str(tmp_path / 'releases.json')
+    index = ReleaseIndex(MirrorList([http_server.url]), path=path)
+    index.load()
+    # execute: the mirror could not be asked
+    mocker.patch('penv.releases.head_status', return_value=None)
+    assert index.resolve('3.12', 'amd64') == '3.12.1'
+    # assert
+    with open(path) as f:
+        assert json.load(f)['builds'] == {}
+    # execute: the mirror answers that there is no such build
+    mocker.patch('penv.releases.head_status', side_effect=lambda url: 404 if '3.12.1' in url else 200)
+    assert index.resolve('3.12', 'amd64') == '3.12.0'
+    # assert
+    with open(path) as f:
+        assert json.load(f)['builds'] == {'3.12.1-amd64': False, '3.12.0-amd64': True}
+
+
+def test_embeddable_env_builder_resolves_python_version(http_server: SimpleNamespace, tmp_path):
+    # preparation
+    for version in ('3.12.0', '3.12.1', '3.13.0'):
+        _make_release(http_server.root, version)
+    # execute
+    builder = EmbeddableEnvBuilder(
+        python_version='>=3.12,<3.13',
+        platform_arch='amd64',
+        cache_dir=str(tmp_path / 'cache'),
+        python_mirrors=[http_server.url],
+    )
+    context = SimpleNamespace(env_dir=str(tmp_path / 'env'))
+    builder.setup_python(context)
+    # assert
+    assert builder.python_version == '3.12.1'
+    with open(os.path.join(context.env_dir, 'python312._pth')) as f:
+        assert 'import site' in f.read()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import stat
+import zipfile
+from penv import EmbeddableEnvBuilder, main
+from penv.manifest import record_files, verify_env
+from penv.store import PackageStore
+
+
+def _make_env(env_dir: str, files: dict) -> dict:
+    for rel, payload in files.items():
+        path = os.path.join(env_dir, *rel.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(payload)
+    return record_files(env_dir)['files']
+
+
+def test_package_store_link_shares_files(tmp_path):
+    # preparation
+    store = PackageStore(str(tmp_path / 'store'), link_mode='hardlink')
+    env1, env2 = str(tmp_path / 'env1'), str(tmp_path / 'env2')
+    files1 = _make_env(env1, {'Lib/site-packages/a.py': 'a = 1\n', 'Lib/site-packages/b.py': 'b = 1\n'})
+    files2 = _make_env(env2, {'Lib/site-packages/a.py': 'a = 1\n', 'Lib/site-packages/c.py': 'c = 1\n'})
+    # execute
+    counts1 = store.link(env1, files1)
+    counts2 = store.link(env2, files2)
+    # assert
+    assert counts1 == {'added': 2, 'linked': 0, 'shared': 0}
+    assert counts2 == {'added': 1, 'linked': 1, 'shared': 0}
+    a1, a2 = os.path.join(env1, 'Lib', 'site-packages', 'a.py'), os.path.join(env2, 'Lib', 'site-packages', 'a.py')
+    assert os.path.samefile(a1, a2)
+    assert os.path.samefile(a1, store.object_path(files1['Lib/site-packages/a.py']['sha256']))
+    # the shared copy is read-only
+    assert not os.stat(a1).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    assert files2['Lib/site-packages/a.py']['mtime_ns'] == os.stat(a2).st_mtime_ns
+    assert store.link(env2, files2) == {'added': 0, 'linked': 0, 'shared': 2}
+    # hardlinks need no record
+    assert not os.path.exists(store.refs_dir) or not os.listdir(store.refs_dir)
+
+
+def test_package_store_gc(tmp_path):
+    # preparation
+    hardlinked = PackageStore(str(tmp_path / 'store'), link_mode='hardlink')
+    copied = PackageStore(str(tmp_path / 'store'), link_mode='copy')
+    env1, env2 = str(tmp_path / 'env1'), str(tmp_path / 'env2')
+    hardlinked.link(env1, _make_env(env1, {'Lib/site-packages/a.py': 'a = 1\n'}))
+    copied.link(env2, _make_env(env2, {'Lib/site-packages/b.py': 'b = 1\n'}))
+    # execute & assert
+    assert hardlinked.gc() == {'refs': 0, 'objects': 0, 'bytes': 0}
+    shutil.rmtree(env1)
+    assert hardlinked.gc() == {'refs': 0, 'objects': 1, 'bytes': 6}
+    shutil.rmtree(env2)
+    assert hardlinked.gc() == {'refs': 1, 'objects': 1, 'bytes': 6}
+    assert hardlinked._objects() == []
+
+
+def test_package_store_verify(tmp_path):
+    store = PackageStore(str(tmp_path / 'store'), link_mode='copy')
+    env_dir = str(tmp_path / 'env')
+    files = _make_env(env_dir, {'Lib/site-packages/a.py': 'a = 1\n', 'Lib/site-packages/b.py': 'b = 1\n'})
+    store.link(env_dir, files)
+    sha256 = files['Lib/site-packages/a.py']['sha256']
+    path = store.object_path(sha256)
+    os.chmod(path, 0o644)
+    with open(path, 'w') as f:
+        f.write('a = 2\n')
+    assert store.verify() == [sha256]
+    assert store._objects() == [files['Lib/site-packages/b.py']['sha256']]
+
+
+def test_embeddable_env_builder_package_store(tmp_path, mocker):
+    # preparation
+    zip_path = str(tmp_path / 'python-3.8.5-embed-amd64.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+    mocker.patch('penv.download', side_effect=lambda url, dest, downloader, mirrors: shutil.copyfile(zip_path, dest))
+
+    def install(self, context):
+        with open(os.path.join(context.env_dir, 'Lib', 'site-packages', 'mod.py'), 'w') as f:
+            f.write('x = 1\n')
+
+    mocker.patch.object(EmbeddableEnvBuilder, 'post_setup', autospec=True, side_effect=install)
+    store_dir = str(tmp_path / 'store')
+    builder = EmbeddableEnvBuilder(
+        python_version='3.8.5',
+        platform_arch='amd64',
+        link_mode='hardlink',
+        package_store=store_dir,
+    )
+    env1, env2 = str(tmp_path / 'env1'), str(tmp_path / 'env2')
+    # execute
+    builder.create(env1)
+    builder.create(env2)
+    # assert
+    assert os.path.samefile(
+        os.path.join(env1, 'Lib', 'site-packages', 'mod.py'),
+        os.path.join(env2, 'Lib', 'site-packages', 'mod.py'),
+    )
+    assert verify_env(env1).ok and verify_env(env2).ok
+    assert {'store'} <= {r.phase for r in builder.profiler.records}
+    # the read-only links are cleared like any other file
+    builder.clear = True
+    builder.create(env1)
+    shutil.rmtree(env1)
+    shutil.rmtree(env2)
+    main(['store', 'gc', '--package-store', store_dir])
+    assert PackageStore(store_dir)._objects() == []
@@ -0,0 +1,161 @@
+import os
+import stat
+import zipfile
+import pytest
+from penv import EmbeddableEnvBuilder
+from penv.cache import ArchiveCache
+from penv.manifest import load_manifest, verify_env
+from penv.template import TemplateCache, clone_tree, find_patch_points, relocate_file
+
+
+def _make_tree(root: str, origin: str) -> None:
+    os.makedirs(os.path.join(root, 'Lib', 'site-packages'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'Scripts'), exist_ok=True)
+    with open(os.path.join(root, 'python.exe'), 'wb') as f:
+        f.write(b'MZ\x00' * 100)
+    with open(os.path.join(root, 'Lib', 'site-packages', 'mod.py'), 'w') as f:
+        f.write('x = 1\n')
+    with open(os.path.join(root, 'Scripts', 'pip.exe'), 'wb') as f:
+        f.write(b'MZ\x00launcher#!' + os.path.join(origin, 'python.exe').encode() + b'\nPK\x05\x06')
+    with open(os.path.join(root, 'Lib', 'site-packages', 'cached.pyc'), 'wb') as f:
+        f.write(origin.encode())
+
+
+@pytest.mark.parametrize('mode', ['auto', 'hardlink', 'copy'])
+def test_clone_tree(tmp_path, mode: str):
+    src = str(tmp_path / 'src')
+    _make_tree(src, src)
+    counts = clone_tree(src, str(tmp_path / 'dst'), mode=mode, skip=[os.path.join('Scripts', 'pip.exe')])
+    assert sum(counts.values()) == 3
+    with open(tmp_path / 'dst' / 'Lib' / 'site-packages' / 'mod.py') as f:
+        assert f.read() == 'x = 1\n'
+    assert not os.path.exists(tmp_path / 'dst' / 'Scripts' / 'pip.exe')
+    if mode == 'hardlink':
+        assert os.path.samefile(tmp_path / 'dst' / 'python.exe', tmp_path / 'src' / 'python.exe')
+    if mode == 'copy':
+        assert not os.path.samefile(tmp_path / 'dst' / 'python.exe', tmp_path / 'src' / 'python.exe')
+
+
+def test_clone_tree_protects_hardlinks(tmp_path):
+    src, dst = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    _make_tree(src, src)
+    with open(os.path.join(src, 'python312._pth'), 'w') as f:
+        f.write('python312.zip\n.\n')
+    counts = clone_tree(src, dst, mode='hardlink')
+    assert counts == {'hardlink': 4, 'copy': 1}
+    # writing to a shared file fails instead of changing the source tree
+    assert not os.stat(os.path.join(dst, 'python.exe')).st_mode & stat.S_IWUSR
+    assert not os.stat(os.path.join(src, 'python.exe')).st_mode & stat.S_IWUSR
+    # the ._pth file is copied, so that it can be edited
+    with open(os.path.join(dst, 'python312._pth'), 'a') as f:
+        f.write('import site\n')
+    with open(os.path.join(src, 'python312._pth')) as f:
+        assert f.read() == 'python312.zip\n.\n'
+    # the read-only files are replaced by cloning again
+    clone_tree(src, dst, mode='hardlink')
+
+
+def test_clone_tree_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        clone_tree(str(tmp_path), str(tmp_path / 'dst'), mode='symlink')
+
+
+def test_find_patch_points(tmp_path):
+    src = str(tmp_path / 'src')
+    _make_tree(src, src)
+    assert find_patch_points(src) == [os.path.join('Scripts', 'pip.exe')]
+
+
+def test_relocate_file(tmp_path):
+    src = str(tmp_path / 'src')
+    _make_tree(src, src)
+    dst = str(tmp_path / 'dst')
+    os.makedirs(dst)
+    relocate_file(os.path.join(src, 'Scripts', 'pip.exe'), os.path.join(dst, 'pip.exe'), src, dst)
+    with open(os.path.join(dst, 'pip.exe'), 'rb') as f:
+        contents = f.read()
+    assert os.path.join(dst, 'python.exe').encode() in contents
+    assert os.path.join(src, 'python.exe').encode() not in contents
+
+
+def test_template_cache_publish_and_clone(tmp_path):
+    templates = TemplateCache(str(tmp_path / 'cache'))
+    assert templates.load('3.12.1-amd64-pip') is None
+    tree = templates.build_dir('3.12.1-amd64-pip')
+    _make_tree(tree, tree)
+    meta = templates.publish('3.12.1-amd64-pip', tree)
+    assert meta == templates.load('3.12.1-amd64-pip')
+    assert meta['patch_files'] == [os.path.join('Scripts', 'pip.exe')]
+    assert not os.path.exists(os.path.dirname(tree))
+    env_dir = str(tmp_path / 'env')
+    counts = templates.clone(meta, env_dir, mode='hardlink')
+    assert counts == {'hardlink': 3, 'patched': 1}
+    with open(os.path.join(env_dir, 'Scripts', 'pip.exe'), 'rb') as f:
+        assert os.path.join(env_dir, 'python.exe').encode() in f.read()
+    # the patched file is a new file, so the template is left untouched
+    with open(os.path.join(meta['tree'], 'Scripts', 'pip.exe'), 'rb') as f:
+        assert os.path.join(meta['origin'], 'python.exe').encode() in f.read()
+
+
+def test_embeddable_env_builder_create_from_template(tmp_path, mocker):
+    # preparation
+    def setup_python(self, context):
+        _make_tree(context.env_dir, context.env_dir)
+
+    mock_setup_python = mocker.patch.object(EmbeddableEnvBuilder, 'setup_python', autospec=True, side_effect=setup_python)
+    mock_setup_pip = mocker.patch.object(EmbeddableEnvBuilder, '_setup_pip', autospec=True)
+    mock_patch_scripts = mocker.patch.object(EmbeddableEnvBuilder, '_patch_scripts', autospec=True)
+    builder = EmbeddableEnvBuilder(
+        with_pip=True,
+        python_version='3.8.5',
+        platform_arch='amd64',
+        cache_dir=str(tmp_path / 'cache'),
+        link_mode='copy',
+    )
+    # execute
+    builder.create(str(tmp_path / 'env1'))
+    builder.create(str(tmp_path / 'env2'))
+    # assert
+    assert mock_setup_python.call_count == 1
+    assert mock_setup_pip.call_count == 1
+    assert mock_patch_scripts.call_count == 3
+    assert TemplateCache(str(tmp_path / 'cache')).load('3.8.5-amd64-pip-get-pip') is not None
+    for env in ('env1', 'env2'):
+        env_dir = str(tmp_path / env)
+        assert os.path.exists(os.path.join(env_dir, 'python.exe'))
+        with open(os.path.join(env_dir, 'Scripts', 'pip.exe'), 'rb') as f:
+            assert os.path.join(env_dir, 'python.exe').encode() in f.read()
+        with open(os.path.join(env_dir, 'activate')) as f:
+            contents = f.read()
+            assert env_dir in contents
+            assert os.path.join(str(tmp_path), 'cache') not in contents
+        assert verify_env(env_dir).ok
+
+
+def test_embeddable_env_builder_clones_template_with_read_only_links(tmp_path, mocker):
+    # preparation
+    zip_path = str(tmp_path / 'python-3.8.5-embed-amd64.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('python38._pth', 'python38.zip\n.\n#import site\n')
+        zf.writestr('python.exe', 'MZ')
+    cache_dir = str(tmp_path / 'cache')
+    ArchiveCache(cache_dir).add('python-3.8.5-embed-amd64.zip', zip_path)
+    mocker.patch.object(EmbeddableEnvBuilder, '_patch_scripts', autospec=True)
+    replace = os.replace
+
+    def windows_replace(src, dst):
+        # Windows refuses to replace a read-only file
+        if os.path.exists(dst) and not os.stat(dst).st_mode & stat.S_IWUSR:
+            raise PermissionError(dst)
+        replace(src, dst)
+
+    mocker.patch('os.replace', side_effect=windows_replace)
+    builder = EmbeddableEnvBuilder(python_version='3.8.5', platform_arch='amd64', cache_dir=cache_dir, link_mode='hardlink')
+    env_dir = str(tmp_path / 'env')
+    # execute
+    builder.create(env_dir)
+    # assert
+    assert load_manifest(env_dir)['origin'] == env_dir  # type: ignore
+    assert os.stat(os.path.join(env_dir, 'penv-manifest.json')).st_mode & stat.S_IWUSR
+    assert not os.stat(os.path.join(env_dir, 'python.exe')).st_mode & stat.S_IWUSR
+    assert verify_env(env_dir).ok
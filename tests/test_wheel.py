@@ -0,0 +1,281 @@
+import csv
+import os
+import pytest
+import stat
+import zipfile
+from types import SimpleNamespace
+from penv import EmbeddableEnvBuilder
+from penv.wheel import (
+    Requirement,
+    WheelError,
+    WheelStore,
+    ensurepip_wheel_dir,
+    find_launchers,
+    find_wheels,
+    install_wheel,
+    install_wheels,
+    is_compatible,
+    parse_requirements,
+    parse_wheel_filename,
+    select_wheels,
+)
+
+
+def _make_wheel(directory: str, name: str, version: str, launchers: bool = False, tags: str = 'py3-none-any') -> str:
+    path = os.path.join(directory, f'{name}-{version}-{tags}.whl')
+    dist_info = f'{name}-{version}.dist-info'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(f'{name}/__init__.py', f'__version__ = {version!r}\n')
+        zf.writestr(f'{name}/__main__.py', 'def main():\n    return 0\n')
+        if launchers:
+            for exe in ('t64.exe', 'w64.exe'):
+                zf.writestr(f'{name}/_vendor/distlib/{exe}', b'MZ' + exe.encode())
+        zf.writestr(f'{name}-{version}.data/scripts/{name}-tool', '#!python\nprint("tool")\n')
+        zf.writestr(f'{dist_info}/METADATA', f'Name: {name}\nVersion: {version}\n')
+        zf.writestr(f'{dist_info}/entry_points.txt', f'[console_scripts]\n{name} = {name}.__main__:main\n')
+        zf.writestr(f'{dist_info}/RECORD', f'{name}/__init__.py,sha256=x,10\n')
+    return path
+
+
+def _make_env(tmp_path, name: str = 'env'):
+    env_dir = str(tmp_path / name)
+    site_packages = os.path.join(env_dir, 'Lib', 'site-packages')
+    scripts_dir = os.path.join(env_dir, 'Scripts')
+    os.makedirs(site_packages)
+    os.makedirs(scripts_dir)
+    return env_dir, site_packages, scripts_dir, os.path.join(env_dir, 'python.exe')
+
+
+def test_parse_wheel_filename():
+    info = parse_wheel_filename('dir/pip-24.0-py3-none-any.whl')
+    assert (info.name, info.version, info.python, info.abi, info.platform) == ('pip', '24.0', 'py3', 'none', 'any')
+    with pytest.raises(WheelError):
+        parse_wheel_filename('pip.zip')
+
+
+def test_find_wheels(tmp_path):
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    os.makedirs(first)
+    os.makedirs(second)
+    _make_wheel(first, 'pip', '23.0')
+    _make_wheel(first, 'pip', '23.10')
+    _make_wheel(second, 'pip', '99.0')
+    _make_wheel(second, 'setuptools', '69.0')
+    _make_wheel(second, 'other', '1.0')
+    wheels = find_wheels([first, second, str(tmp_path / 'missing')], ['pip', 'setuptools'])
+    assert sorted(wheels) == ['pip', 'setuptools']
+    assert wheels['pip'].version == '23.10'
+    assert wheels['setuptools'].version == '69.0'
+
+
+def test_install_wheel(tmp_path):
+    env_dir, site_packages, scripts_dir, python_exe = _make_env(tmp_path)
+    # pip provides the launchers for the entry points of itself and later wheels
+    install_wheel(
+        _make_wheel(str(tmp_path), 'pip', '24.0', launchers=True),
+        env_dir,
+        site_packages,
+        scripts_dir,
+        python_exe,
+        platform_arch='amd64',
+    )
+    assert os.path.exists(os.path.join(scripts_dir, 'pip.exe'))
+    launchers = find_launchers(site_packages, 'amd64')
+    assert launchers == (b'MZt64.exe', b'MZw64.exe')
+    installed = install_wheel(
+        _make_wheel(str(tmp_path), 'setuptools', '69.0'),
+        env_dir,
+        site_packages,
+        scripts_dir,
+        python_exe,
+        launchers=launchers,
+    )
+    assert os.path.join(site_packages, 'setuptools', '__init__.py') in installed
+    with open(os.path.join(scripts_dir, 'setuptools-tool'), 'rb') as f:
+        assert f.readline() == f'#!{python_exe}\n'.encode()
+    with open(os.path.join(scripts_dir, 'setuptools.exe'), 'rb') as f:
+        exe = f.read()
+    assert exe.startswith(b'MZt64.exe#!' + python_exe.encode() + b'\n')
+    with zipfile.ZipFile(os.path.join(scripts_dir, 'setuptools.exe')) as zf:
+        assert b'from setuptools.__main__ import main' in zf.read('__main__.py')
+    dist_info = os.path.join(site_packages, 'setuptools-69.0.dist-info')
+    with open(os.path.join(dist_info, 'INSTALLER')) as f:
+        assert f.read() == 'penv\n'
+    with open(os.path.join(dist_info, 'RECORD')) as f:
+        rows = {row[0]: row for row in csv.reader(f)}
+    assert rows['setuptools/__init__.py'][1].startswith('sha256=')
+    assert '../../Scripts/setuptools.exe' in rows
+    assert rows['setuptools-69.0.dist-info/RECORD'] == ['setuptools-69.0.dist-info/RECORD', '', '']
+
+
+@pytest.mark.skipif(ensurepip_wheel_dir() is None, reason='ensurepip is not bundled')
+def test_embeddable_env_builder_setup_pip_from_wheels(tmp_path, mocker):
+    # preparation
+    builder = EmbeddableEnvBuilder(
+        with_pip=True,
+        python_version='3.8.5',
+        platform_arch='amd64',
+        pip_bootstrap='wheels',
+        wheelhouse=str(tmp_path / 'wheelhouse'),
+    )
+    env_dir = str(tmp_path / 'env')
+    os.makedirs(os.path.join(env_dir, 'Lib', 'site-packages'))
+    os.makedirs(os.path.join(env_dir, 'Scripts'))
+    context = SimpleNamespace(env_dir=env_dir, env_exe=os.path.join(env_dir, 'python.exe'))
+    mock_run = mocker.patch('penv.subprocess.run')
+    mock_download = mocker.patch('penv.download')
+    # execute
+    builder._setup_pip(context)
+    # assert
+    assert not mock_run.called
+    assert not mock_download.called
+    site_packages = os.path.join(env_dir, 'Lib', 'site-packages')
+    assert os.path.exists(os.path.join(site_packages, 'pip', '__init__.py'))
+    assert any(d.startswith('pip-') and d.endswith('.dist-info') for d in os.listdir(site_packages))
+    assert os.path.exists(os.path.join(env_dir, 'Scripts', 'pip.exe'))
+
+
+@pytest.mark.parametrize(
+    'filename, python_version, platform_arch, expected',
+    [
+        ('a-1.0-py3-none-any.whl', '3.12.1', 'amd64', True),
+        ('a-1.0-py2.py3-none-any.whl', '3.12', 'amd64', True),
+        ('a-1.0-cp312-cp312-win_amd64.whl', '3.12.1', 'amd64', True),
+        ('a-1.0-cp312-cp312-win_amd64.whl', '3.11.1', 'amd64', False),
+        ('a-1.0-cp312-cp312-win_amd64.whl', '3.12.1', 'win32', False),
+        ('a-1.0-cp312-cp312-manylinux2014_x86_64.whl', '3.12.1', 'amd64', False),
+        ('a-1.0-cp38-abi3-win_amd64.whl', '3.12.1', 'amd64', True),
+        ('a-1.0-cp313-abi3-win_amd64.whl', '3.12.1', 'amd64', False),
+        ('a-1.0-cp312-cp312-win_arm64.whl', '3.12.1', 'arm64', True),
+    ]
+)
+def test_is_compatible(filename: str, python_version: str, platform_arch: str, expected: bool):
+    assert is_compatible(parse_wheel_filename(filename), python_version, platform_arch) == expected
+
+
+def test_parse_requirements(tmp_path):
+    with open(tmp_path / 'base.txt', 'w') as f:
+        f.write('six==1.16.0\n')
+    with open(tmp_path / 'requirements.txt', 'w') as f:
+        f.write(
+            '# comment\n'
+            '-r base.txt\n'
+            '--index-url https://example.com\n'
+            'requests[socks]==2.31.0 ; python_version >= "3.8"  # pinned\n'
+            'idna\n'
+            'certifi==2024.2.2 --hash=sha256:abc\n'
+        )
+    assert parse_requirements(str(tmp_path / 'requirements.txt')) == [
+        Requirement('six', '1.16.0'),
+        Requirement('requests', '2.31.0'),
+        Requirement('idna', None),
+        Requirement('certifi', '2024.2.2'),
+    ]
+
+
+def test_parse_requirements_unsupported(tmp_path):
+    with open(tmp_path / 'requirements.txt', 'w') as f:
+        f.write('requests>=2\n')
+    with pytest.raises(WheelError):
+        parse_requirements(str(tmp_path / 'requirements.txt'))
+
+
+def test_select_wheels(tmp_path):
+    _make_wheel(str(tmp_path), 'six', '1.15.0')
+    _make_wheel(str(tmp_path), 'six', '1.16.0')
+    _make_wheel(str(tmp_path), 'numpy', '1.26.0', tags='cp312-cp312-win_amd64')
+    _make_wheel(str(tmp_path), 'numpy', '1.26.0', tags='cp311-cp311-win_amd64')
+    selected = select_wheels(
+        [Requirement('six', '1.15.0'), Requirement('NumPy', None)],
+        [str(tmp_path)],
+        '3.12.1',
+        'amd64',
+    )
+    assert [os.path.basename(info.path) for info in selected] == [
+        'six-1.15.0-py3-none-any.whl',
+        'numpy-1.26.0-cp312-cp312-win_amd64.whl',
+    ]
+    with pytest.raises(WheelError, match='six==2.0'):
+        select_wheels([Requirement('six', '2.0')], [str(tmp_path)], '3.12.1', 'amd64')
+
+
+@pytest.mark.parametrize('use_store', [False, True])
+def test_install_wheels(tmp_path, use_store: bool):
+    wheelhouse = str(tmp_path / 'wheelhouse')
+    os.makedirs(wheelhouse)
+    wheels = [_make_wheel(wheelhouse, name, '1.0') for name in ('alpha', 'beta', 'gamma')]
+    store = WheelStore(str(tmp_path / 'store'), link_mode='hardlink') if use_store else None
+    for env in ('env1', 'env2'):
+        env_dir, site_packages, scripts_dir, python_exe = _make_env(tmp_path, env)
+        installed = install_wheels(wheels, env_dir, site_packages, scripts_dir, python_exe, store=store, max_workers=3)
+        for name in ('alpha', 'beta', 'gamma'):
+            assert os.path.join(site_packages, name, '__init__.py') in installed
+            assert os.path.exists(os.path.join(scripts_dir, name))
+            assert os.path.exists(os.path.join(site_packages, f'{name}-1.0.dist-info', 'RECORD'))
+    if use_store:
+        # one unpacked tree per wheel; two hashes may share a prefix directory
+        assert sum(len(os.listdir(tmp_path / 'store' / prefix)) for prefix in os.listdir(tmp_path / 'store')) == 3
+        assert os.path.samefile(
+            tmp_path / 'env1' / 'Lib' / 'site-packages' / 'alpha' / '__init__.py',
+            tmp_path / 'env2' / 'Lib' / 'site-packages' / 'alpha' / '__init__.py',
+        )
+        # the unpacked files shared with the store are read-only
+        assert not os.stat(tmp_path / 'env1' / 'Lib' / 'site-packages' / 'alpha' / '__init__.py').st_mode & stat.S_IWUSR
+        # the files written per environment are not
+        assert os.stat(tmp_path / 'env1' / 'Lib' / 'site-packages' / 'alpha-1.0.dist-info' / 'RECORD').st_mode & stat.S_IWUSR
+
+
+def test_embeddable_env_builder_install_requirements(tmp_path):
+    # preparation
+    wheelhouse = str(tmp_path / 'wheelhouse')
+    os.makedirs(wheelhouse)
+    _make_wheel(wheelhouse, 'alpha', '1.0')
+    _make_wheel(wheelhouse, 'beta', '2.0')
+    with open(tmp_path / 'requirements.txt', 'w') as f:
+        f.write('alpha==1.0\nbeta\n')
+    builder = EmbeddableEnvBuilder(
+        python_version='3.8.5',
+        platform_arch='amd64',
+        wheelhouse=wheelhouse,
+        requirements=str(tmp_path / 'requirements.txt'),
+        cache_dir=str(tmp_path / 'cache'),
+    )
+    env_dir, site_packages, _, python_exe = _make_env(tmp_path)
+    context = SimpleNamespace(env_dir=env_dir, env_exe=python_exe)
+    # execute
+    builder.install_requirements(context)
+    # assert
+    assert os.path.exists(os.path.join(site_packages, 'alpha', '__init__.py'))
+    assert os.path.exists(os.path.join(site_packages, 'beta-2.0.dist-info', 'INSTALLER'))
+    assert os.path.isdir(tmp_path / 'cache' / 'wheels')
+    assert builder._template_key().startswith('3.8.5-amd64-nopip-req-')
+
+
+def test_template_key_depends_on_picked_wheels(tmp_path, mocker):
+    # preparation
+    mocker.patch('penv.ensurepip_wheel_dir', return_value=None)
+    wheelhouse = str(tmp_path / 'wheelhouse')
+    os.makedirs(wheelhouse)
+    requirements = str(tmp_path / 'requirements.txt')
+    with open(requirements, 'w') as f:
+        f.write('alpha\n')
+    old_pip, old_alpha = _make_wheel(wheelhouse, 'pip', '23.0', launchers=True), _make_wheel(wheelhouse, 'alpha', '1.0')
+    builder = EmbeddableEnvBuilder(
+        python_version='3.8.5',
+        platform_arch='amd64',
+        with_pip=True,
+        pip_bootstrap='wheels',
+        wheelhouse=wheelhouse,
+        requirements=requirements,
+    )
+    keys = [builder._template_key()]
+    # execute: the wheelhouse is updated while the requirements file stays the same
+    os.remove(old_alpha)
+    _make_wheel(wheelhouse, 'alpha', '1.1')
+    keys.append(builder._template_key())
+    os.remove(old_pip)
+    _make_wheel(wheelhouse, 'pip', '24.0', launchers=True)
+    keys.append(builder._template_key())
+    # assert
+    assert len(set(keys)) == 3
+    assert builder._template_key() == keys[-1]